@@ -0,0 +1,119 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# A local stand-in for the Telegram Bot API. It answers the methods the bot uses and can add latency, errors and
+# flood limits (HTTP 429) to the answers
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive like api.telegram.org does
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def _read_params(self):
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length', 0))
+        if length > 0:
+            body = self.rfile.read(length).decode('utf-8')
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body))
+        return url.path.rsplit('/', 1)[-1], params
+
+    def _handle(self):
+        server = self.server
+        method, params = self._read_params()
+        if server.latency:
+            time.sleep(server.latency)
+
+        answer = server.answer(method, params)
+        status = answer.get('error_code', 200)
+        body = json.dumps(answer).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, error_rate=0.0, flood_rate=0.0, retry_after=1, blocked_rate=0.0, host='127.0.0.1',
+                 port=0):
+        super().__init__((host, port), _RequestHandler)
+        self.latency = latency  # Seconds added to every answer
+        self.error_rate = error_rate  # Share of sendMessage calls answered with HTTP 500
+        self.flood_rate = flood_rate  # Share of sendMessage calls answered with HTTP 429
+        self.retry_after = retry_after
+        self.blocked_rate = blocked_rate  # Share of chats which blocked the bot. They are always answered with HTTP 403
+        self.requests = {}  # Method -> number of calls
+        self.sent_messages = 0
+        self.errors = 0
+        self.floods = 0
+        self.blocked = 0
+        self.connections = 0  # Connections accepted from clients
+        self._message_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def api_url(self):
+        return 'http://{}:{}/bot{{0}}/{{1}}'.format(*self.server_address)
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def answer(self, method, params):
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            if method != 'sendMessage':
+                return {'ok': True, 'result': [] if method == 'getUpdates' else True}
+
+            if int(params.get('chat_id', 0)) % 1000 < self.blocked_rate * 1000:
+                self.blocked += 1
+                return {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+            dice = random.random()
+            if dice < self.flood_rate:
+                self.floods += 1
+                return {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after {}'.format(
+                    self.retry_after), 'parameters': {'retry_after': self.retry_after}}
+            if dice < self.flood_rate + self.error_rate:
+                self.errors += 1
+                return {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}
+
+            self.sent_messages += 1
+            self._message_id += 1
+            message_id = self._message_id
+        return {'ok': True, 'result': {
+            'message_id': message_id, 'date': int(time.time()), 'text': params.get('text', ''),
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'slumometer'},
+            'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}}}
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='fake-telegram', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def stats(self):
+        with self._lock:
+            return {'requests': dict(self.requests), 'sent_messages': self.sent_messages, 'errors': self.errors,
+                    'floods': self.floods, 'blocked': self.blocked, 'connections': self.connections}
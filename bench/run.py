@@ -0,0 +1,339 @@
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Load and benchmark suite. Runs the bot against a local fake Telegram API and writes the results as JSON, so they can
+# be compared between versions:
+#
+#     python3 bench/run.py --chats 100000 --latency 0.02 --output bench.json
+#
+# The storage backend is chosen with the same environment variables as the bot, e.g. SLUMOMETER_STORAGE=sqlite
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [_ROOT, os.path.join(_ROOT, 'slumometer')]
+
+from telebot import apihelper, types  # noqa: E402
+from common import MOSCOW_TIMEZONE  # noqa: E402
+from fake_telegram import FakeTelegramServer  # noqa: E402
+
+_BENCHMARK_TOKEN = 'BENCHMARK'
+_SENSOR_BATCH = 50  # Readings in a datagram
+_SENSOR_WINDOW = 2000  # Readings sent but not taken in yet
+
+
+def _percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    return {
+        'count': len(samples),
+        'mean': statistics.mean(samples),
+        'p50': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        'max': samples[-1],
+    }
+
+
+def _git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+# bot.py reads its arguments on import
+def _import_bot():
+    argv = sys.argv
+    sys.argv = ['bot.py', _BENCHMARK_TOKEN]
+    try:
+        import bot
+    finally:
+        sys.argv = argv
+    bot.bot.threaded = False  # Handlers run in the calling thread, so their latency can be measured
+    return bot
+
+
+def _make_update(update_id, chat_id, text):
+    command = text.split(' ')[0]
+    return types.Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'text': text,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]}})
+
+
+# Every benchmark seeds the chats it needs, so it gives the same result when it is run alone
+def _seed_chats(storage, chats):
+    storage.subscribed_chats = list(range(1, chats + 1))
+    storage.chats_to_notify = storage.subscribed_chats.copy()
+
+
+def bench_storage(bot, chats):
+    storage = bot.storage
+    _seed_chats(storage, chats)
+
+    started = time.perf_counter()
+    storage.save()
+    storage.flush()
+    save_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    storage.load()
+    load_time = time.perf_counter() - started
+    return {'chats': chats, 'save_seconds': save_time, 'load_seconds': load_time}
+
+
+def bench_broadcast(bot, server, chats):
+    storage = bot.storage
+    _seed_chats(storage, chats)
+    now = datetime.now()
+    storage.time_next_change = [now.timestamp(), (now + timedelta(hours=8)).timestamp()]
+    sent_before = server.stats()['sent_messages']
+
+    started = time.perf_counter()
+    next_alarm_datetime = now + timedelta(hours=1)
+    recipients = [(chat_id, next_alarm_datetime) for chat_id in storage.chats_to_notify]
+    report = bot.EventHandler().on_user_notification(bot.scheduler.USER_NOTIFY_TYPE_USUAL, next_alarm_datetime,
+                                                     True, now, recipients)
+    duration = time.perf_counter() - started
+    return {'recipients': report.total, 'delivered': report.sent, 'failed': report.failed, 'seconds': duration,
+            'messages_per_second': report.total / duration if duration else None,
+            'api_messages': server.stats()['sent_messages'] - sent_before}
+
+
+def bench_handlers(bot, clients, commands_per_client):
+    commands = ('/status', '/subscribe', '/linen_changed', '/unsubscribe', '/help')
+    latencies = {command: [] for command in commands}
+    errors = []
+    latencies_lock = threading.Lock()
+
+    def client(index):
+        for i in range(commands_per_client):
+            command = commands[i % len(commands)]
+            # Every command comes from another chat, so per-chat throttling doesn't drop them
+            chat_id = 10 ** 9 + index * commands_per_client + i
+            update = _make_update(index * commands_per_client + i + 1, chat_id, command)
+            started = time.perf_counter()
+            try:
+                bot.bot.process_new_updates([update])
+            except apihelper.ApiException:  # The reply got an injected error
+                with latencies_lock:
+                    errors.append(command)
+                continue
+            elapsed = time.perf_counter() - started
+            with latencies_lock:
+                latencies[command].append(elapsed)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    total = sum(len(samples) for samples in latencies.values())
+    dropped = {reason: bot.metrics.UPDATES_DROPPED.get(reason=reason)
+               for reason in ('duplicate', 'throttled', 'collapsed')}
+    return {'clients': clients, 'commands': total, 'errors': len(errors), 'dropped': dropped, 'seconds': duration,
+            'commands_per_second': total / duration,
+            'latency_seconds': {command: _percentiles(samples) for command, samples in latencies.items()}}
+
+
+# Sends `messages` messages from `threads` new threads in every round, like broadcasts do, and reports the latency of a
+# call and how many connections were opened for them
+def bench_transport(bot, server, threads, messages, rounds):
+    latencies = []
+    latencies_lock = threading.Lock()
+    connections_before = server.stats()['connections']
+    opened_before = bot.transport.connections_opened()
+    retries_before = sum(bot.metrics.API_RETRIES.get(reason=reason) for reason in ('connect', 'network', 'server'))
+
+    def sender(index):
+        for i in range(index, messages, threads):
+            started = time.perf_counter()
+            try:
+                bot.bot.send_message(i + 1, 'transport benchmark')
+            except apihelper.ApiException:
+                pass  # An injected error
+            with latencies_lock:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        senders = [threading.Thread(target=sender, args=(index,)) for index in range(threads)]
+        for thread in senders:
+            thread.start()
+        for thread in senders:
+            thread.join()
+    duration = time.perf_counter() - started
+    return {'threads': threads, 'rounds': rounds, 'messages': messages * rounds, 'seconds': duration,
+            'messages_per_second': messages * rounds / duration, 'latency_seconds': _percentiles(latencies),
+            'pool_size': bot.transport.pool_size,
+            'connections_opened': bot.transport.connections_opened() - opened_before,
+            'server_connections': server.stats()['connections'] - connections_before,
+            'retries': sum(bot.metrics.API_RETRIES.get(reason=reason) for reason in ('connect', 'network', 'server'))
+            - retries_before}
+
+
+class _JitterCallback:
+    def __init__(self, alarms):
+        self.lateness = []
+        self.recipients = []  # Number of recipients of every fired alarm
+        self.done = threading.Event()
+        self._alarms = alarms
+
+    def on_user_notification(self, alarm_type, next_alarm_datetime, is_first_alarm, alarm_datetime, recipients,
+                             tenant=None):
+        self.lateness.append(time.time() - alarm_datetime.timestamp())
+        self.recipients.append(len(recipients))
+        if len(self.lateness) == self._alarms:
+            self.done.set()
+
+
+# Fires `alarms` alarms `interval` seconds apart through the scheduler of the bot: its job store, the timeline trigger
+# and the choice of recipients. The change day is replaced with alarms starting in a second, the last one ends it.
+# Every chat gets every alarm: the default times are the minutes of the alarms, and every tenth chat chooses them as its
+# own times, so the alarms take chats from the slots of the wheel too
+def bench_scheduler_jitter(bot, chats, alarms, interval):
+    scheduler = bot.scheduler
+    storage = bot.storage
+    _seed_chats(storage, chats)
+    start = time.time() + 1
+    timeline = [[scheduler.USER_NOTIFY_TYPE_USUAL, start + i * interval] for i in range(alarms - 1)]
+    timeline.append([scheduler.USER_NOTIFY_TYPE_LAST, start + (alarms - 1) * interval])
+    alarm_minutes = sorted({moscow_datetime.hour * 60 + moscow_datetime.minute for moscow_datetime in (
+        datetime.fromtimestamp(timestamp, MOSCOW_TIMEZONE) for alarm_type, timestamp in timeline)})
+    storage.default_times = alarm_minutes
+    for chat_id in range(1, chats + 1, 10):
+        storage.set_chat_schedule(chat_id, {'times': alarm_minutes, 'quiet': None})
+    callback = _JitterCallback(alarms)
+
+    scheduler.set_callback(callback)
+    scheduler.init(storage)
+    storage.time_next_change = [start, timeline[-1][1]]
+    storage.notification_timeline = []
+    storage.notification_index = 0
+    build_notification_timeline = scheduler._build_notification_timeline
+    scheduler._build_notification_timeline = lambda tenant, time_next_change: timeline
+    try:
+        scheduler._reschedule_remaining_alarms(scheduler._tenants[scheduler.DEFAULT_TENANT])
+    finally:
+        scheduler._build_notification_timeline = build_notification_timeline
+    callback.done.wait(timeout=alarms * interval + 10)
+    scheduler.shutdown()
+    return {'alarms': alarms, 'fired': len(callback.lateness), 'recipients': sum(callback.recipients),
+            'recipients_per_alarm': callback.recipients, 'lateness_seconds': _percentiles(callback.lateness)}
+
+
+# Sends readings of `rooms` rooms over UDP in datagrams of _SENSOR_BATCH lines, one reading per room and second, and
+# measures how many readings per second are taken in and how long a check of all rooms takes
+def bench_sensors(bot, rooms, readings):
+    sensors = bot.sensors
+    sensors.listen('127.0.0.1', 0)
+    start = time.time() - readings // rooms
+    lines = ['{} {:.1f} {:.1f} {:.0f} {:.0f}'.format(reading % rooms, 22 + reading % 7, 50 + reading % 11,
+                                                     600 + reading % 900, start + reading // rooms)
+             for reading in range(readings)]
+    accepted = bot.metrics.SENSOR_READINGS.get(result='accepted')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    started = time.perf_counter()
+    received = 0
+    deadline = time.perf_counter() + 60
+    for i in range(0, readings, _SENSOR_BATCH):
+        # Datagrams which don't fit into the buffer of the socket are lost, so only a window of them is in flight
+        while i - received > _SENSOR_WINDOW and time.perf_counter() < deadline:
+            time.sleep(0.0005)
+            received = bot.metrics.SENSOR_READINGS.get(result='accepted') - accepted
+        sock.sendto('\n'.join(lines[i:i + _SENSOR_BATCH]).encode(), ('127.0.0.1', sensors.port))
+    while received < readings and time.perf_counter() < deadline:
+        time.sleep(0.0005)
+        received = bot.metrics.SENSOR_READINGS.get(result='accepted') - accepted
+    duration = time.perf_counter() - started
+    sock.close()
+
+    check_started = time.perf_counter()
+    alerts = sensors.check(timestamp=start + readings // rooms + 60)
+    check_duration = time.perf_counter() - check_started
+    sensors.close()
+    return {'rooms': rooms, 'readings': readings, 'received': received, 'seconds': duration,
+            'readings_per_second': received / duration, 'check_seconds': check_duration, 'alerts': len(alerts)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks slumometer against a local fake Telegram API')
+    parser.add_argument('--chats', type=int, default=10000, help='number of synthetic subscribed chats')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the fake API waits before answering')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of sends answered with HTTP 500')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='share of sends answered with HTTP 429')
+    parser.add_argument('--blocked-rate', type=float, default=0.0, help='share of chats which blocked the bot')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='global send rate limit, messages per second (Telegram quota by default)')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients sending commands')
+    parser.add_argument('--commands', type=int, default=100, help='commands sent by every client')
+    parser.add_argument('--alarms', type=int, default=20, help='alarms fired to measure scheduler jitter')
+    parser.add_argument('--rooms', type=int, default=300, help='rooms which send sensor readings')
+    parser.add_argument('--readings', type=int, default=100000, help='sensor readings sent over UDP')
+    parser.add_argument('--senders', type=int, default=32, help='threads sending messages in every transport round')
+    parser.add_argument('--messages', type=int, default=1000, help='messages sent in every transport round')
+    parser.add_argument('--rounds', type=int, default=5, help='transport rounds, each with new sender threads')
+    parser.add_argument('--skip', action='append', default=[],
+                        choices=('storage', 'broadcast', 'handlers', 'transport', 'scheduler', 'sensors'),
+                        help='benchmarks to skip')
+    parser.add_argument('--output', default='-', help='file to write JSON results to, stdout by default')
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(latency=args.latency, error_rate=args.error_rate, flood_rate=args.flood_rate,
+                                blocked_rate=args.blocked_rate).start()
+    os.environ['SLUMOMETER_API_URL'] = server.api_url
+    os.chdir(tempfile.mkdtemp(prefix='slumometer-bench-'))  # The bot keeps its data in ./data
+
+    bot = _import_bot()
+    bot.storage.load()
+    bot.outbox.open()
+    bot.history.open()
+    if args.rate is not None:
+        bot.broadcaster._bucket = bot.broadcast.TokenBucket(args.rate)
+
+    results = {
+        'version': _git_version(),
+        'python': platform.python_version(),
+        'started_at': datetime.now().isoformat(),
+        'parameters': vars(args),
+        'storage_backend': type(bot.storage).__name__,
+    }
+    if 'storage' not in args.skip:
+        results['storage'] = bench_storage(bot, args.chats)
+    if 'broadcast' not in args.skip:
+        results['broadcast'] = bench_broadcast(bot, server, args.chats)
+    if 'handlers' not in args.skip:
+        results['handlers'] = bench_handlers(bot, args.clients, args.commands)
+    if 'transport' not in args.skip:
+        results['transport'] = bench_transport(bot, server, args.senders, args.messages, args.rounds)
+    if 'scheduler' not in args.skip:
+        results['scheduler'] = bench_scheduler_jitter(bot, args.chats, args.alarms, 0.1)
+    if 'sensors' not in args.skip:
+        results['sensors'] = bench_sensors(bot, args.rooms, args.readings)
+    results['fake_api'] = server.stats()
+
+    server.stop()
+    output = json.dumps(results, indent=2)
+    if args.output == '-':
+        print(output)
+    else:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import argparse
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+# Simulates a whole change day on a virtual clock and writes the fired alarms, their recipients and the replies as JSON.
+# The output depends only on the arguments, so it can be compared between versions to catch scheduling regressions:
+#
+#     python3 bench/simulate.py --chats 10000 --reply-rate 0.3 --output day.json
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [_ROOT, os.path.join(_ROOT, 'slumometer')]
+
+from common import MOSCOW_TIMEZONE  # noqa: E402
+from slumometer.simulation import Simulation  # noqa: E402
+
+
+def _moscow_datetime(date, time):
+    moscow_datetime = MOSCOW_TIMEZONE.localize(datetime.strptime('{} {}'.format(date, time), '%Y-%m-%d %H:%M'))
+    return datetime.fromtimestamp(moscow_datetime.timestamp())  # Local time, as the scheduler expects
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a linen change day on a virtual clock')
+    parser.add_argument('--chats', type=int, default=10000, help='number of subscribed chats')
+    parser.add_argument('--reply-rate', type=float, default=0.3,
+                        help='probability that a chat answers /linen_changed after a reminder')
+    parser.add_argument('--reply-delay', type=float, default=30, help='maximal delay of a reply in minutes')
+    parser.add_argument('--custom-times-rate', type=float, default=0.0,
+                        help='share of chats which choose their own reminder times with /times')
+    parser.add_argument('--date', default='2019-09-30', help='date of the change, YYYY-MM-DD')
+    parser.add_argument('--start', default='09:00', help='start of the change in Moscow time, HH:MM')
+    parser.add_argument('--end', default='16:30', help='end of the change in Moscow time, HH:MM')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='-', help='file to write JSON results to, stdout by default')
+    args = parser.parse_args()
+
+    change_start = _moscow_datetime(args.date, args.start)
+    change_end = _moscow_datetime(args.date, args.end)
+    custom_times = [datetime.strptime(t, '%H:%M').time() for t in ('07:30', '09:45', '12:00', '14:20', '19:00')]
+    simulation = Simulation(args.chats, reply_rate=args.reply_rate, reply_delay=timedelta(minutes=args.reply_delay),
+                            custom_times_rate=args.custom_times_rate, custom_times=custom_times, seed=args.seed,
+                            start=change_start - timedelta(days=1))
+    try:
+        results = simulation.run(change_start, change_end)
+    finally:
+        simulation.shutdown()
+    results['parameters'] = vars(args)
+
+    output = json.dumps(results, indent=2)
+    if args.output == '-':
+        print(output)
+    else:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
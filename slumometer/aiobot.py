@@ -0,0 +1,152 @@
+import asyncio
+import functools
+import logging
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from requests.exceptions import ConnectionError as NetworkError
+from telebot import types, util
+from telebot.apihelper import ApiException
+
+LOG = logging.getLogger("slumometer.aiobot")
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.INFO)
+
+API_URL = "https://api.telegram.org/bot{0}/{1}"
+_REQUEST_TIMEOUT = 30
+_POLLING_TIMEOUT = 20
+_POLLING_ERROR_DELAY = 3
+_MAX_CONNECTIONS = 100
+_HANDLER_WORKERS = 4
+
+
+# A bot for the asyncio mode. It has the part of the telebot.TeleBot interface which bot.py uses, so the same message
+# handlers are registered on either bot. Handlers write the storage, so they run on handler_workers threads and the loop
+# only does the requests: send_message and reply_to schedule a request on the loop and return at once. Handlers of one
+# chat run one after another, in the order the updates came
+class AsyncBot:
+    def __init__(self, token, api_url=API_URL, max_connections=_MAX_CONNECTIONS, handler_workers=_HANDLER_WORKERS):
+        self.token = token
+        self.last_update_id = 0
+        self._api_url = api_url
+        self._max_connections = max_connections
+        self._handlers = []  # (commands, handler)
+        self._session = None
+        self._loop = None
+        self._tasks = set()  # Running tasks scheduled by the bot. The loop keeps only weak references to them
+        self._executor = ThreadPoolExecutor(handler_workers, thread_name_prefix='update-worker')
+        self._chat_tasks = {}  # Chat id -> task of the last handler of the chat
+
+    def message_handler(self, commands):
+        def decorator(handler):
+            self._handlers.append((commands, handler))
+            return handler
+        return decorator
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._max_connections),
+                                              timeout=aiohttp.ClientTimeout(total=_REQUEST_TIMEOUT))
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._session.close()
+        self._executor.shutdown(wait=False)
+
+    # Errors are reported the same way pyTelegramBotAPI does: ApiException for answers with `ok` equal to false and
+    # a requests' ConnectionError for network problems, so callers handle both bots alike
+    async def _request(self, method, request_timeout=_REQUEST_TIMEOUT, **params):
+        params = {name: value for name, value in params.items() if value is not None}
+        try:
+            async with self._session.post(self._api_url.format(self.token, method), json=params,
+                                          timeout=aiohttp.ClientTimeout(total=request_timeout)) as response:
+                answer = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            raise NetworkError('{} failed: {!r}'.format(method, e)) from e
+        if not answer.get('ok'):
+            raise ApiException('Error code: {} Description: {}'.format(answer.get('error_code'),
+                                                                         answer.get('description')), method, answer)
+        return answer['result']
+
+    async def async_send_message(self, chat_id, text, parse_mode=None, reply_to_message_id=None, **kwargs):
+        return await self._request('sendMessage', chat_id=chat_id, text=text, parse_mode=parse_mode,
+                                   reply_to_message_id=reply_to_message_id, **kwargs)
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self._create_task(self.async_send_message(chat_id, text, **kwargs))
+
+    def reply_to(self, message, text, **kwargs):
+        return self.send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+    # Called from another thread, e.g. by the webhook server, it schedules the task on the loop and returns None
+    def _create_task(self, coroutine):
+        if not self._in_loop():
+            self._loop.call_soon_threadsafe(self._create_task, coroutine)
+            return None
+        task = self._loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+        return task
+
+    def _on_task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            LOG.warning("Task failed: {}".format(task.exception()))
+
+    def _in_loop(self):
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    # May be called from any thread, e.g. by the webhook server
+    def process_new_updates(self, updates):
+        if self._in_loop():
+            self._process_new_updates(updates)
+        else:
+            self._loop.call_soon_threadsafe(self._process_new_updates, updates)
+
+    def _process_new_updates(self, updates):
+        for update in updates:
+            if update.update_id > self.last_update_id:
+                self.last_update_id = update.update_id
+            if update.message is not None:
+                self._notify_handlers(update.message)
+
+    def _notify_handlers(self, message):
+        if message.content_type != 'text':
+            return
+        command = util.extract_command(message.text)
+        for commands, handler in self._handlers:
+            if command in commands:
+                chat_id = message.chat.id
+                task = self._create_task(self._run_handler(handler, message, self._chat_tasks.get(chat_id)))
+                self._chat_tasks[chat_id] = task
+                task.add_done_callback(functools.partial(self._on_handler_done, chat_id))
+                return
+
+    async def _run_handler(self, handler, message, previous_task):
+        if previous_task is not None:
+            await asyncio.wait([previous_task])
+        try:
+            result = await self._loop.run_in_executor(self._executor, handler, message)
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception:
+            LOG.exception("Handler {} failed".format(handler.__name__))
+
+    def _on_handler_done(self, chat_id, task):
+        if self._chat_tasks.get(chat_id) is task:
+            del self._chat_tasks[chat_id]
+
+    async def polling(self):
+        await self._request('deleteWebhook')
+        while True:
+            try:
+                updates = await self._request('getUpdates', request_timeout=_POLLING_TIMEOUT + 10,
+                                              offset=self.last_update_id + 1, timeout=_POLLING_TIMEOUT)
+            except (ApiException, NetworkError) as e:
+                LOG.warning("Failed to get updates: {}".format(e))
+                await asyncio.sleep(_POLLING_ERROR_DELAY)
+                continue
+            self.process_new_updates([types.Update.de_json(update) for update in updates])
@@ -1,8 +1,14 @@
+import asyncio
+import functools
 import telebot
 import sys
 import os
+import signal
+import secrets
 import logging
-from slumometer import storage, scheduler, localization as loc
+import threading
+from slumometer import aiobot, storage, scheduler, broadcast, outbox, webhook, localization, metrics, middleware, \
+    cluster, history, sensors, dorms, transport
 from datetime import datetime
 from common import MOSCOW_TIMEZONE
 
@@ -17,87 +23,208 @@ if len(sys.argv) < 2 and __name__ == '__main__':
     sys.exit(1)
 bot_token = sys.argv[1]
 admin_key = sys.argv[2] if len(sys.argv) > 2 else '11235'
+# Webhook mode: Telegram POSTs updates to SLUMOMETER_WEBHOOK_URL, which must be proxied to SLUMOMETER_WEBHOOK_PORT.
+# Long polling is used if the URL is not set
+webhook_url = os.environ.get('SLUMOMETER_WEBHOOK_URL')
+webhook_port = int(os.environ.get('SLUMOMETER_WEBHOOK_PORT', 8443))
+webhook_secret = os.environ.get('SLUMOMETER_WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+# Asyncio mode: handlers, scheduler jobs and sends share one event loop instead of a thread each
+async_mode = os.environ.get('SLUMOMETER_ASYNC') == '1'
+# A chat which was unavailable (blocked the bot or was deleted) in this many broadcasts in a row is unsubscribed
+max_chat_failures = int(os.environ.get('SLUMOMETER_MAX_CHAT_FAILURES', 2))
+# Metrics are served on http://127.0.0.1:<SLUMOMETER_METRICS_PORT>/metrics if the port is set
+metrics_port = os.environ.get('SLUMOMETER_METRICS_PORT')
+# Sensors send readings to UDP port SLUMOMETER_SENSORS_PORT of SLUMOMETER_SENSORS_HOST if the port is set. Chats get
+# alerts when the slum index of their room reaches SLUMOMETER_SLUM_THRESHOLD
+sensors_port = os.environ.get('SLUMOMETER_SENSORS_PORT')
+sensors_host = os.environ.get('SLUMOMETER_SENSORS_HOST', '127.0.0.1')
+slum_threshold = float(os.environ.get('SLUMOMETER_SLUM_THRESHOLD', sensors.DEFAULT_THRESHOLD))
+# Multi-process mode: SLUMOMETER_WORKERS processes accept webhook updates on the same port and share the SQLite storage.
+# One of them runs the scheduler, and every one sends its partition of each broadcast
+worker_count = int(os.environ.get('SLUMOMETER_WORKERS', 1))
+worker_index = 0  # Index of this worker process
+# Handlers of different chats run in parallel on SLUMOMETER_UPDATE_WORKERS threads, each chat on one of them
+update_workers = int(os.environ.get('SLUMOMETER_UPDATE_WORKERS', middleware.DEFAULT_UPDATE_WORKERS))
+# Dormitories served by the bot as 'name[:admin key],...', see dorms.py. The first one is the main dormitory. Every
+# dormitory has its own admins, subscribers, change and reminder times, and chats choose theirs with /dorm
+dorm_config = dorms.parse(os.environ.get('SLUMOMETER_DORMS', ''))
+# Telegram API calls share SLUMOMETER_API_POOL_SIZE keep-alive connections to SLUMOMETER_API_URL, wait up to
+# SLUMOMETER_API_TIMEOUT seconds for an answer and are repeated up to SLUMOMETER_API_RETRIES times after transient errors
+api_url = os.environ.get('SLUMOMETER_API_URL', transport.API_URL)
+api_pool_size = int(os.environ.get('SLUMOMETER_API_POOL_SIZE', transport.DEFAULT_POOL_SIZE))
+api_timeout = float(os.environ.get('SLUMOMETER_API_TIMEOUT', transport.DEFAULT_READ_TIMEOUT))
+api_retries = int(os.environ.get('SLUMOMETER_API_RETRIES', transport.DEFAULT_RETRIES))
+
+_OUTBOX_POLL_INTERVAL = 1.0  # Seconds between looks for new broadcasts in the multi-process mode
+_LEADER_RETRY_INTERVAL = 5.0  # Seconds between attempts to take the scheduler lease in the multi-process mode
+
+transport = transport.Transport(api_url, pool_size=api_pool_size, read_timeout=api_timeout, retries=api_retries)
+transport.install()
+if async_mode:
+    bot = aiobot.AsyncBot(bot_token, api_url=api_url, handler_workers=update_workers)
+else:
+    # The bot is created without its own pool. ChatWorkerPool takes its place in the process which handles updates, so
+    # the supervisor of the multi-process mode doesn't start threads its workers won't inherit
+    bot = telebot.TeleBot(bot_token, threaded=False)
+if os.environ.get('SLUMOMETER_STORAGE') == 'sqlite' or worker_count > 1:
+    storage_factory = storage.SqliteStorage
+else:
+    storage_factory = functools.partial(storage.Storage, save_delay=float(os.environ.get('SLUMOMETER_SAVE_DELAY', 0)),
+                                        max_pending_changes=int(os.environ.get('SLUMOMETER_SAVE_MAX_CHANGES', 100)))
+storage = storage_factory()  # The storage of the main dormitory. Chat settings which don't depend on the dormitory,
+# such as the language or the room, are kept here for all chats
+outbox = outbox.Outbox(storage.get_outbox_db_path())
+history = history.History(storage.get_history_db_path())
+dorms = dorms.Dorms(storage, history, admin_key, dorm_config, storage_factory)
+sensors = sensors.Sensors()
+if async_mode:
+    broadcaster = broadcast.AsyncBroadcaster(bot.async_send_message,
+                                             workers=int(os.environ.get('SLUMOMETER_BROADCAST_WORKERS',
+                                                                        broadcast.DEFAULT_ASYNC_WORKERS)))
+else:
+    # Workers send at the same time, so they share the quota of Telegram
+    broadcaster = broadcast.Broadcaster(bot.send_message,
+                                        workers=int(os.environ.get('SLUMOMETER_BROADCAST_WORKERS',
+                                                                   broadcast.DEFAULT_WORKERS)),
+                                        rate=broadcast.GLOBAL_RATE_LIMIT / worker_count)
+_outbox_changed = threading.Event()  # Wakes up the sender of the partition in the multi-process mode
+
+
+def _send_slow_down(msg):
+    bot.send_message(msg.chat.id, _get_locale(msg.chat.id).SLOW_DOWN)
+
+
+# Called on the thread which takes in updates, so the reply is sent by the worker of the chat and a slow API call doesn't
+# hold up the updates of other chats. The asyncio bot only schedules the reply anyway
+def _reply_slow_down(msg):
+    if getattr(bot, 'worker_pool', None) is not None and bot.threaded:
+        bot.worker_pool.put(_send_slow_down, msg)
+    else:
+        _send_slow_down(msg)
+
+
+middleware.UpdateFilter(on_throttled=_reply_slow_down).install(bot)
+metrics.Gauge('slumometer_subscribed_chats', 'Number of subscribed chats',
+              function=lambda: sum(len(dorm.storage.subscribed_chats) for dorm in dorms))
+metrics.Gauge('slumometer_api_connections', 'Connections to the Telegram API opened by the transport',
+              function=transport.connections_opened)
 
-bot = telebot.TeleBot(bot_token)
-storage = storage.Storage()
+
+# The same timestamps are printed on every alarm and /status, so the results are cached
+@functools.lru_cache(maxsize=256)
+def _format_timestamp(timestamp, date_format):
+    return datetime.fromtimestamp(timestamp).astimezone(MOSCOW_TIMEZONE).strftime(date_format)
 
 
 def _to_printable_datetime(timestamp, **kwargs):
     if timestamp is None:
-        return loc.NA
+        return kwargs.get('na', localization.get().NA)
     date_format = ''
     if 'no_date' not in kwargs:
         date_format += '%d.%m.%Y '
     if 'no_time' not in kwargs:
         date_format += '%H:%M '
     date_format = date_format[:-1]  # Cut the last space
-    return datetime.fromtimestamp(timestamp).astimezone(MOSCOW_TIMEZONE).strftime(date_format)
+    return _format_timestamp(timestamp, date_format)
+
+
+# Returns the bundle of strings in the language of the chat
+def _get_locale(chat_id):
+    return localization.get(storage.get_chat_locale(chat_id))
+
+
+# Measures the time of the handler and counts its failures
+def _instrumented(handler):
+    @functools.wraps(handler)
+    def wrapper(msg):
+        with metrics.HANDLER_SECONDS.time(handler=handler.__name__):
+            try:
+                return handler(msg)
+            except Exception:
+                metrics.HANDLER_ERRORS.inc(handler=handler.__name__)
+                raise
+    return wrapper
 
 
 @bot.message_handler(commands=['start', 'help'])
+@_instrumented
 def send_welcome(msg):
+    loc = _get_locale(msg.chat.id)
     bot.send_message(msg.chat.id, loc.HELLO_MESSAGE, parse_mode="Markdown")
 
 
 @bot.message_handler(commands=['subscribe'])
+@_instrumented
 def subscribe(msg):
     chat_id = msg.chat.id
-    if chat_id in storage.subscribed_chats:
+    loc = _get_locale(chat_id)
+    dorm = dorms.of_chat(chat_id)
+    if not dorm.storage.add_subscribed_chat(chat_id):
         bot.send_message(chat_id, loc.ALREADY_SUBSCRIBED)
         return
-    storage.subscribed_chats.append(chat_id)
+    dorm.storage.save()
+    storage.clear_chat_failures([chat_id])
     storage.save()
     bot.send_message(chat_id, loc.SUBSCRIBE_MESSAGE)
 
 
 @bot.message_handler(commands=['unsubscribe'])
+@_instrumented
 def unsubscribe(msg):
     chat_id = msg.chat.id
-    if chat_id not in storage.subscribed_chats:
+    loc = _get_locale(chat_id)
+    dorm = dorms.of_chat(chat_id)
+    if not dorm.storage.remove_subscribed_chat(chat_id):
         bot.send_message(chat_id, loc.NOT_SUBSCRIBED)
         return
-    storage.subscribed_chats.remove(chat_id)
-    storage.save()
+    dorm.storage.save()
     bot.send_message(chat_id, loc.UNSUBSCRIBE_MESSAGE)
 
 
 @bot.message_handler(commands=['admin'])
+@_instrumented
 def add_admin(msg):
+    loc = _get_locale(msg.chat.id)
     space_index = msg.text.find(' ')
     key = msg.text[space_index+1:] if space_index != -1 else ''
+    dorm = dorms.of_chat(msg.chat.id)
     if not key:
         bot.send_message(msg.chat.id, loc.ADMIN_COMMAND_ABOUT)
-    elif key == admin_key:
-        if msg.chat.id in storage.admin_chats:
+    elif key == dorm.admin_key:
+        if not dorm.storage.add_admin_chat(msg.chat.id):
             bot.send_message(msg.chat.id, loc.ALREADY_ADMIN_MESSAGE)
         else:
-            storage.admin_chats.append(msg.chat.id)
-            storage.save()
+            dorm.storage.save()
             bot.send_message(msg.chat.id, loc.ADMIN_ADDED_MESSAGE)
     else:
         bot.send_message(msg.chat.id, loc.WRONG_ADMIN_KEY_MESSAGE)
 
 
 @bot.message_handler(commands=['unadmin'])
+@_instrumented
 def remove_admin(msg):
-    if msg.chat.id not in storage.admin_chats:
+    loc = _get_locale(msg.chat.id)
+    dorm = dorms.of_chat(msg.chat.id)
+    if not dorm.storage.remove_admin_chat(msg.chat.id):
         bot.send_message(msg.chat.id, loc.ADMIN_ONLY_USAGE)
     else:
-        storage.admin_chats.remove(msg.chat.id)
-        storage.save()
+        dorm.storage.save()
         bot.send_message(msg.chat.id, loc.ADMIN_REMOVED_MESSAGE)
 
 
 @bot.message_handler(commands=['stc'])
+@_instrumented
 def set_time_change(msg):
-    if msg.chat.id not in storage.admin_chats:
+    loc = _get_locale(msg.chat.id)
+    dorm = dorms.of_chat(msg.chat.id)
+    if msg.chat.id not in dorm.storage.admin_chats:
         bot.send_message(msg.chat.id, loc.ADMIN_ONLY_USAGE)
         return
 
     args = msg.text.split(' ')
 
     if len(args) == 2 and args[1] == "n/a":
-        scheduler.clear_time_next_change()
+        scheduler.clear_time_next_change(dorm.tenant)
         bot.send_message(msg.chat.id, loc.TIME_NEXT_CHANGE_CLEARED)
         return
 
@@ -118,38 +245,257 @@ def set_time_change(msg):
         bot.send_message(msg.chat.id, loc.BAD_DATETIME_MESSAGE)
         return
 
-    first_alarm_timestamp = scheduler.update_time_of_next_change([time_start, time_end]).timestamp()
+    first_alarm_timestamp = scheduler.update_time_of_next_change([time_start, time_end], dorm.tenant).timestamp()
     bot.send_message(msg.chat.id, loc.TIME_NEXT_CHANGE_UPDATED.format(_to_printable_datetime(first_alarm_timestamp)),
                      parse_mode="Markdown")
 
 
 @bot.message_handler(commands=['status'])
+@_instrumented
 def send_status(msg):
-    time_next_change = storage.time_next_change
+    loc = _get_locale(msg.chat.id)
+    dorm = dorms.of_chat(msg.chat.id)
+    time_next_change = dorm.storage.time_next_change
     time_starts = _to_printable_datetime(time_next_change[0]) if time_next_change is not None else loc.NA
     time_ends = _to_printable_datetime(time_next_change[1]) if time_next_change is not None else loc.NA
-    answer = loc.STATUS_MESSAGE.format(time_starts, time_ends, len(storage.subscribed_chats))
+    answer = loc.STATUS_MESSAGE.format(time_starts, time_ends, len(dorm.storage.subscribed_chats))
+    if len(dorms) > 1:
+        answer = loc.STATUS_MESSAGE_DORM.format(dorm.name) + "\n" + answer
 
-    if msg.chat.id in storage.admin_chats:
-        time_admin_notify = _to_printable_datetime(storage.next_admin_notification_time)
+    if msg.chat.id in dorm.storage.admin_chats:
+        time_admin_notify = _to_printable_datetime(dorm.storage.next_admin_notification_time, na=loc.NA)
         answer += "\n" + loc.STATUS_MESSAGE_ADMIN_ADDITION.format(time_admin_notify)
+        remaining_alarms = scheduler.get_remaining_alarms(dorm.tenant)
+        if remaining_alarms:
+            answer += "\n" + loc.STATUS_MESSAGE_REMAINING_ALARMS.format(', '.join(
+                '`{}`'.format(_to_printable_datetime(alarm[1], no_date=True)) for alarm in remaining_alarms))
+        answer += "\n" + _get_metrics_summary(loc)
 
     bot.reply_to(msg, answer, parse_mode="Markdown")
 
 
+def _format_seconds(seconds, loc):
+    return loc.SECONDS.format(seconds) if seconds is not None else loc.NA
+
+
+def _get_metrics_summary(loc):
+    reports = list(broadcaster.last_reports)
+    if reports:
+        report = max(reports, key=lambda r: r.started)
+        last_broadcast = loc.STATUS_MESSAGE_LAST_BROADCAST.format(report.sent, report.total,
+                                                                  '{:.1f}'.format(report.duration or 0))
+    else:
+        last_broadcast = loc.NA
+    return loc.STATUS_MESSAGE_METRICS.format(
+        metrics.SENDS.get(result=broadcast.DELIVERED),
+        metrics.SENDS.get(result=broadcast.FAILED) + metrics.SENDS.get(result=broadcast.UNAVAILABLE),
+        metrics.SEND_RETRIES.get(reason='flood') + metrics.SEND_RETRIES.get(reason='network'),
+        metrics.CHATS_PRUNED.get(), last_broadcast,
+        _format_seconds(metrics.JOB_LATENESS_SECONDS.mean(job=scheduler._JOB_USER_NOTIFIER), loc),
+        _format_seconds(metrics.STORAGE_SAVE_SECONDS.mean(), loc),
+        _format_seconds(metrics.API_REQUEST_SECONDS.mean(method='sendMessage'), loc))
+
+
+def _format_share(part, total, loc):
+    return '{:.0%}'.format(part / total) if total else loc.NA
+
+
+def _format_slot(alarm_type, minute, loc):
+    if minute is not None:
+        return '{:02}:{:02}'.format(minute // 60, minute % 60)
+    return {scheduler.USER_NOTIFY_TYPE_1HOUR_TO_END: loc.STATS_SLOT_1HOUR,
+            scheduler.USER_NOTIFY_TYPE_30MIN_TO_END: loc.STATS_SLOT_30MIN,
+            scheduler.USER_NOTIFY_TYPE_15MIN_TO_END: loc.STATS_SLOT_15MIN,
+            scheduler.USER_NOTIFY_TYPE_LAST: loc.STATS_SLOT_LAST}.get(alarm_type, loc.NA)
+
+
+# Campaign statistics are counted as events arrive, so the answer doesn't depend on the length of the history
+@bot.message_handler(commands=['stats'])
+@_instrumented
+def send_stats(msg):
+    loc = _get_locale(msg.chat.id)
+    dorm = dorms.of_chat(msg.chat.id)
+    if msg.chat.id not in dorm.storage.admin_chats:
+        bot.send_message(msg.chat.id, loc.ADMIN_ONLY_USAGE)
+        return
+
+    campaign = dorm.history.get_last_campaign()
+    if campaign is None:
+        bot.send_message(msg.chat.id, loc.STATS_NO_CAMPAIGNS)
+        return
+    answer = loc.STATS_MESSAGE.format(_to_printable_datetime(campaign['first_alarm_time']), campaign['confirmations'],
+                                      campaign['subscribers'],
+                                      _format_share(campaign['confirmations'], campaign['subscribers'], loc),
+                                      campaign['alarms'], campaign['messages'])
+    slots = dorm.history.get_slots()
+    if slots:
+        answer += "\n" + loc.STATS_SLOTS
+        for alarm_type, minute, alarms, recipients, confirmations in slots:
+            answer += "\n" + loc.STATS_SLOT.format(_format_slot(alarm_type, minute, loc), confirmations, recipients,
+                                                   _format_share(confirmations, recipients, loc))
+    bot.send_message(msg.chat.id, answer, parse_mode="Markdown")
+
+
 @bot.message_handler(commands=['linen_changed'])
+@_instrumented
 def update_chat_with_changed_linen(msg):
-    if msg.chat.id in storage.chats_to_notify:
-        storage.chats_to_notify.remove(msg.chat.id)
-        storage.save()
+    loc = _get_locale(msg.chat.id)
+    dorm = dorms.of_chat(msg.chat.id)
+    if dorm.storage.remove_chat_to_notify(msg.chat.id):
+        dorm.storage.save()
+        dorm.history.record_linen_changed(msg.chat.id)
         bot.send_message(msg.chat.id, loc.LINEN_CHANGED_MESSAGE)
     else:
         bot.send_message(msg.chat.id, loc.LINEN_ALREADY_CHANGED_MESSAGE)
 
 
+@bot.message_handler(commands=['language'])
+@_instrumented
+def set_language(msg):
+    args = msg.text.split(' ')
+    if len(args) != 2 or args[1] not in localization.LOCALES:
+        loc = _get_locale(msg.chat.id)
+        bot.send_message(msg.chat.id, loc.ABOUT_LANGUAGE_COMMAND.format(', '.join(localization.LOCALES)))
+        return
+    storage.set_chat_locale(msg.chat.id, args[1])
+    storage.save()
+    bot.send_message(msg.chat.id, localization.get(args[1]).LANGUAGE_CHANGED)
+
+
+def _parse_times(args):
+    try:
+        return [datetime.strptime(arg, '%H:%M').time() for arg in args]
+    except ValueError:
+        return None
+
+
+def _format_times(times):
+    return ', '.join(t.strftime('%H:%M') for t in times)
+
+
+def _send_reminder_times(chat_id, loc):
+    times = scheduler.get_chat_reminder_times(chat_id, dorms.of_chat(chat_id).tenant)
+    if times:
+        bot.send_message(chat_id, loc.REMINDER_TIMES_CHANGED.format(_format_times(times)))
+    else:
+        bot.send_message(chat_id, loc.NO_REMINDER_TIMES)
+
+
+@bot.message_handler(commands=['times'])
+@_instrumented
+def set_reminder_times(msg):
+    loc = _get_locale(msg.chat.id)
+    dorm = dorms.of_chat(msg.chat.id)
+    args = msg.text.split()[1:]
+    if args == ['default']:
+        times = None
+    else:
+        times = _parse_times(args)
+        if not times:
+            bot.send_message(msg.chat.id, loc.ABOUT_TIMES_COMMAND.format(
+                _format_times(scheduler.get_chat_reminder_times(msg.chat.id, dorm.tenant))))
+            return
+    scheduler.set_chat_reminder_times(msg.chat.id, times, dorm.tenant)
+    _send_reminder_times(msg.chat.id, loc)
+
+
+@bot.message_handler(commands=['quiet'])
+@_instrumented
+def set_quiet_hours(msg):
+    loc = _get_locale(msg.chat.id)
+    args = msg.text.split()[1:]
+    if args == ['off']:
+        quiet_hours = None
+    else:
+        quiet_hours = _parse_times(args)
+        if quiet_hours is None or len(quiet_hours) != 2:
+            bot.send_message(msg.chat.id, loc.ABOUT_QUIET_COMMAND)
+            return
+    scheduler.set_chat_quiet_hours(msg.chat.id, quiet_hours, dorms.of_chat(msg.chat.id).tenant)
+    _send_reminder_times(msg.chat.id, loc)
+
+
+@bot.message_handler(commands=['default_times'])
+@_instrumented
+def set_default_reminder_times(msg):
+    loc = _get_locale(msg.chat.id)
+    dorm = dorms.of_chat(msg.chat.id)
+    if msg.chat.id not in dorm.storage.admin_chats:
+        bot.send_message(msg.chat.id, loc.ADMIN_ONLY_USAGE)
+        return
+
+    args = msg.text.split()[1:]
+    if args == ['default']:
+        times = None
+    else:
+        times = _parse_times(args)
+        if not times:
+            bot.send_message(msg.chat.id, loc.ABOUT_DEFAULT_TIMES_COMMAND.format(
+                _format_times(scheduler.get_default_reminder_times(dorm.tenant))))
+            return
+    scheduler.set_default_reminder_times(times, dorm.tenant)
+    bot.send_message(msg.chat.id, loc.DEFAULT_TIMES_CHANGED.format(
+        _format_times(scheduler.get_default_reminder_times(dorm.tenant))))
+
+
+@bot.message_handler(commands=['dorm'])
+@_instrumented
+def set_dorm(msg):
+    loc = _get_locale(msg.chat.id)
+    args = msg.text.split()[1:]
+    dorm = dorms.get(args[0]) if len(args) == 1 else None
+    if dorm is None:
+        bot.send_message(msg.chat.id, loc.ABOUT_DORM_COMMAND.format(dorms.of_chat(msg.chat.id).name,
+                                                                    ', '.join(dorm.name for dorm in dorms)))
+        return
+    if not dorms.move_chat(msg.chat.id, dorm):
+        bot.send_message(msg.chat.id, loc.ALREADY_IN_DORM.format(dorm.name))
+        return
+    bot.send_message(msg.chat.id, loc.DORM_CHANGED.format(dorm.name))
+
+
+def _format_index(index, loc):
+    return '{:.0f}'.format(index) if index is not None else loc.NA
+
+
+def _get_room_status(room, loc):
+    reading = sensors.get_last_reading(room)
+    if reading is None:
+        return loc.ROOM_NO_READINGS.format(room)
+    current, day = sensors.get_room_indexes(room)
+    return loc.ROOM_STATUS.format(room, _format_index(current, loc), _format_index(day, loc)) + "\n" + \
+        loc.ROOM_LAST_READING.format(_to_printable_datetime(reading[0]), *reading[1:])
+
+
+@bot.message_handler(commands=['room'])
+@_instrumented
+def set_room(msg):
+    loc = _get_locale(msg.chat.id)
+    args = msg.text.split()[1:]
+    if args == ['off']:
+        storage.set_chat_room(msg.chat.id, None)
+        storage.save()
+        bot.send_message(msg.chat.id, loc.ROOM_OFF)
+        return
+    if len(args) != 1 or not sensors.is_valid_room(args[0]):
+        room = storage.get_chat_room(msg.chat.id)
+        answer = loc.ABOUT_ROOM_COMMAND
+        if room is not None:
+            answer += "\n\n" + _get_room_status(room, loc)
+        bot.send_message(msg.chat.id, answer, parse_mode="Markdown")
+        return
+    storage.set_chat_room(msg.chat.id, args[0])
+    storage.save()
+    bot.send_message(msg.chat.id, loc.ROOM_CHANGED.format(args[0], _format_index(slum_threshold, loc)) + "\n" +
+                     _get_room_status(args[0], loc), parse_mode="Markdown")
+
+
 @bot.message_handler(commands=['sant'])
+@_instrumented
 def set_admin_notification_time(msg):
-    if msg.chat.id not in storage.admin_chats:
+    loc = _get_locale(msg.chat.id)
+    dorm = dorms.of_chat(msg.chat.id)
+    if msg.chat.id not in dorm.storage.admin_chats:
         bot.send_message(msg.chat.id, loc.ADMIN_ONLY_USAGE)
         return
 
@@ -170,60 +516,298 @@ def set_admin_notification_time(msg):
         bot.send_message(msg.chat.id, loc.BAD_DATETIME_MESSAGE)
         return
 
-    scheduler.update_admin_notification_time(notify_time)
+    scheduler.update_admin_notification_time(notify_time, dorm.tenant)
     bot.send_message(msg.chat.id, loc.ADMIN_NOTIFICATION_TIME_CHANGED.format(_to_printable_datetime(notify_time)),
                  parse_mode="Markdown")
 
 
+# Callbacks return the broadcast: its report, or a coroutine in the asyncio mode
 class EventHandler(scheduler.Callback):
-    def on_admin_remind(self):
-        for chat_id in storage.admin_chats:
-            bot.send_message(chat_id, loc.ADMIN_NOTIFY_SET_NEXT_TIME.format(
-                _to_printable_datetime(storage.next_admin_notification_time, no_time=True)), parse_mode="Markdown")
-
-    def on_user_notification(self, alarm_type, next_alarm_datetime, is_first_alarm):
-        if is_first_alarm:
-            # Reset storage.chats_to_notify
-            storage.chats_to_notify = storage.subscribed_chats.copy()
-            storage.save()
-
-        #text = loc.NOTIFY_LINEN_CHANGE.format(_to_printable_datetime(storage.time_next_change[1], no_date=True))\
-        #    if not is_last_call else loc.NOTIFY_LAST_LINEN_CHANGE
-        #for chat_id in storage.chats_to_notify:
-        #    bot.send_message(chat_id, text)
-
-        text = None
+    def on_admin_remind(self, tenant=scheduler.DEFAULT_TENANT):
+        dorm = dorms.get_by_tenant(tenant)
+        if dorm is None:
+            return None
+        messages = []
+        for chat_id in dorm.storage.admin_chats:
+            loc = _get_locale(chat_id)
+            text = loc.ADMIN_NOTIFY_SET_NEXT_TIME.format(
+                _to_printable_datetime(dorm.storage.next_admin_notification_time, no_time=True, na=loc.NA))
+            messages.append((chat_id, text, "Markdown"))
+        batch_id = outbox.create_batch(_get_campaign_name('admin_remind', dorm, datetime.now()), messages)
+        return _deliver(batch_id)
+
+    def on_user_notification(self, alarm_type, next_alarm_datetime, is_first_alarm, alarm_datetime, recipients,
+                             tenant=scheduler.DEFAULT_TENANT):
+        dorm = dorms.get_by_tenant(tenant)
+        if dorm is None:
+            return None
+        time_ends = dorm.storage.time_next_change[1] if dorm.storage.time_next_change is not None else None
+        # The text is rendered once per locale and time of the next alarm and then looked up for every chat
+        chat_locales = storage.get_chat_locales()
+        texts = {}
         use_markdown = False
-        if alarm_type == scheduler.USER_NOTIFY_TYPE_USUAL:
-            text = loc.NOTIFY_LINEN_CHANGE_USUAL.format(
-                _to_printable_datetime(storage.time_next_change[1], no_date=True),
-                _to_printable_datetime(next_alarm_datetime.timestamp(), no_date=True)
-            )
-            # use_markdown = True
-        elif alarm_type == scheduler.USER_NOTIFY_TYPE_1HOUR_TO_END:
-            text = loc.NOTIFY_LINEN_CHANGE_IN_1HOUR
-        elif alarm_type == scheduler.USER_NOTIFY_TYPE_30MIN_TO_END:
-            text = loc.NOTIFY_LINEN_CHANGE_IN_30MIN
-        elif alarm_type == scheduler.USER_NOTIFY_TYPE_15MIN_TO_END:
-            text = loc.NOTIFY_LINEN_CHANGE_IN_15MIN
-        elif alarm_type == scheduler.USER_NOTIFY_TYPE_LAST:
-            text = loc.NOTIFY_LINEN_CHANGE_LAST
-
-        for chat_id in storage.chats_to_notify:
-            bot.send_message(chat_id, text, parse_mode="Markdown" if use_markdown else None)
-
-
-if __name__ == '__main__':
+        parse_mode = "Markdown" if use_markdown else None
+        messages = []
+        for chat_id, chat_next_alarm_datetime in recipients:
+            locale = chat_locales.get(chat_id, localization.DEFAULT_LOCALE)
+            next_alarm_timestamp = chat_next_alarm_datetime.timestamp() if chat_next_alarm_datetime is not None \
+                else None
+            text = texts.get((locale, next_alarm_timestamp))
+            if text is None:
+                text = texts[(locale, next_alarm_timestamp)] = _render_user_notification(
+                    localization.get(locale), alarm_type, time_ends, next_alarm_timestamp)
+            messages.append((chat_id, text, parse_mode))
+
+        batch_id = outbox.create_batch(_get_campaign_name('user_notification', dorm, alarm_datetime), messages)
+        _record_alarm(dorm, alarm_type, is_first_alarm, alarm_datetime, len(recipients))
+        return _deliver(batch_id)
+
+    def on_sensor_alerts(self, alerts):
+        messages = []
+        for room, index, raised, chat_ids in alerts:
+            LOG.info("Slum index of room {} is {:.0f}".format(room, index))
+            for chat_id in chat_ids:
+                loc = _get_locale(chat_id)
+                text = loc.SENSOR_ALERT_RAISED if raised else loc.SENSOR_ALERT_CLEARED
+                messages.append((chat_id, text.format(room, _format_index(index, loc)), None))
+        if not messages:
+            return None
+        batch_id = outbox.create_batch('sensor_alert:{}'.format(int(datetime.now().timestamp())), messages)
+        return _deliver(batch_id)
+
+
+# Broadcasts of all dormitories go through the same outbox, so the name of a campaign of a dormitory other than the main
+# one includes the dormitory: changes of two dormitories may have alarms at the same time
+def _get_campaign_name(kind, dorm, campaign_datetime):
+    if dorm is dorms.main:
+        return '{}:{}'.format(kind, int(campaign_datetime.timestamp()))
+    return '{}:{}:{}'.format(kind, dorm.name, int(campaign_datetime.timestamp()))
+
+
+def _record_alarm(dorm, alarm_type, is_first_alarm, alarm_datetime, recipients):
+    if is_first_alarm:
+        dorm.history.start_campaign(alarm_datetime.timestamp(), len(dorm.storage.subscribed_chats))
+    minute = None
+    if alarm_type == scheduler.USER_NOTIFY_TYPE_USUAL:
+        moscow_datetime = alarm_datetime.astimezone(MOSCOW_TIMEZONE)
+        minute = moscow_datetime.hour * 60 + moscow_datetime.minute
+    dorm.history.record_alarm(alarm_type, alarm_datetime.timestamp(), minute, recipients)
+
+
+def _render_user_notification(loc, alarm_type, time_ends, next_alarm_timestamp):
+    text = None
+    if alarm_type == scheduler.USER_NOTIFY_TYPE_USUAL:
+        text = loc.NOTIFY_LINEN_CHANGE_USUAL.format(
+            _to_printable_datetime(time_ends, no_date=True),
+            _to_printable_datetime(next_alarm_timestamp, no_date=True)
+        )
+    elif alarm_type == scheduler.USER_NOTIFY_TYPE_1HOUR_TO_END:
+        text = loc.NOTIFY_LINEN_CHANGE_IN_1HOUR
+    elif alarm_type == scheduler.USER_NOTIFY_TYPE_30MIN_TO_END:
+        text = loc.NOTIFY_LINEN_CHANGE_IN_30MIN
+    elif alarm_type == scheduler.USER_NOTIFY_TYPE_15MIN_TO_END:
+        text = loc.NOTIFY_LINEN_CHANGE_IN_15MIN
+    elif alarm_type == scheduler.USER_NOTIFY_TYPE_LAST:
+        text = loc.NOTIFY_LINEN_CHANGE_LAST
+    return text
+
+
+# Sends a batch of the outbox and unsubscribes the chats which turned out to be unavailable. Returns the report of the
+# broadcast, or a coroutine in the asyncio mode. In the multi-process mode every worker sends its partition of the batch
+# in _deliver_partitions_forever, so nothing is returned
+def _deliver(batch_id):
+    if async_mode:
+        return _deliver_async(batch_id)
+    if worker_count > 1:
+        _outbox_changed.set()
+        return None
+    report = broadcaster.deliver(outbox, batch_id)
+    for chat_id, text in _prune_unavailable_chats(report):
+        broadcaster.send(chat_id, text)
+    return report
+
+
+async def _deliver_async(batch_id):
+    report = await broadcaster.deliver(outbox, batch_id)
+    messages = await asyncio.get_running_loop().run_in_executor(None, _prune_unavailable_chats, report)
+    for chat_id, text in messages:
+        await broadcaster.send(chat_id, text)
+    return report
+
+
+# Counts failures of the unavailable chats of the broadcast and unsubscribes those which have failed max_chat_failures
+# broadcasts in a row, all at once, in every dormitory. A delivered message clears the failures of its chat. Returns
+# the messages [(chat_id, text)] which tell admins about the pruned chats
+def _prune_unavailable_chats(report):
+    storage.clear_chat_failures(report.delivered_chats)
+    failures = storage.add_chat_failures(report.unavailable_chats)
+    dead_chats = [chat_id for chat_id, count in failures.items() if count >= max_chat_failures]
+    if dead_chats:
+        for dorm in dorms.others():
+            dorm.storage.remove_subscribed_chats(dead_chats)
+            dorm.storage.save()
+        storage.remove_subscribed_chats(dead_chats)
+        storage.clear_chat_failures(dead_chats)
+    storage.save()
+    if not dead_chats:
+        return []
+
+    metrics.CHATS_PRUNED.inc(len(dead_chats))
+    LOG.info("{} unavailable chats are unsubscribed".format(len(dead_chats)))
+    admin_chats = dict.fromkeys(chat_id for dorm in dorms for chat_id in dorm.storage.admin_chats)
+    return [(chat_id, _get_locale(chat_id).CHATS_PRUNED_MESSAGE.format(len(dead_chats))) for chat_id in admin_chats]
+
+
+# Sends broadcasts which were interrupted by the previous shutdown
+def _resume_broadcasts():
+    for batch_id in outbox.unfinished_batches():
+        LOG.info("Resuming campaign {}".format(outbox.get_campaign(batch_id)))
+        _deliver(batch_id)
+
+
+async def _resume_broadcasts_async():
+    event_loop = asyncio.get_running_loop()
+    for batch_id in await event_loop.run_in_executor(None, outbox.unfinished_batches):
+        LOG.info("Resuming campaign {}".format(await event_loop.run_in_executor(None, outbox.get_campaign, batch_id)))
+        await _deliver(batch_id)
+
+
+# Multi-process mode: sends the messages of this worker's partition of every unfinished batch, including batches which
+# were interrupted by a shutdown. New batches are noticed within _OUTBOX_POLL_INTERVAL
+def _deliver_partitions_forever():
+    partition = (worker_index, worker_count)
+    while True:
+        _outbox_changed.wait(_OUTBOX_POLL_INTERVAL)
+        _outbox_changed.clear()
+        try:
+            for batch_id in outbox.unfinished_batches():
+                if outbox.has_pending_messages(batch_id, partition):
+                    report = broadcaster.deliver(outbox, batch_id, partition)
+                    for chat_id, text in _prune_unavailable_chats(report):
+                        broadcaster.send(chat_id, text)
+                elif not outbox.has_pending_messages(batch_id):
+                    outbox.finish_batch(batch_id)  # The worker which sent the last partition died before finishing it
+        except Exception:
+            LOG.exception("Failed to deliver broadcasts")
+
+
+def _add_tenants():
+    for dorm in dorms.others():
+        scheduler.add_tenant(dorm.tenant, dorm.storage)
+
+
+def _become_leader():
+    LOG.info('Worker {} holds the lease and runs scheduler jobs'.format(worker_index))
+    scheduler.run_jobs()
+
+
+def _run_worker(index):
+    global worker_index
+    worker_index = index
+    # The API connections of the supervisor are not shared with its forks
+    middleware.ChatWorkerPool(update_workers).install(bot)
+    transport.reset()
     storage.load()
+    outbox.open()
+    history.open()
+    dorms.open()
     scheduler.set_callback(EventHandler())
+    scheduler.init(storage, shared=True)
+    scheduler.unwatch_sensors()  # Sensors are off in the multi-process mode
+    _add_tenants()
+    lease = cluster.LeaderLease(storage.get_leader_lock_path())
+    lease.watch(_become_leader, _LEADER_RETRY_INTERVAL)
+
+    if metrics_port:
+        metrics.MetricsServer('127.0.0.1', int(metrics_port) + index).start()
+    threading.Thread(target=_deliver_partitions_forever, name='outbox-partition', daemon=True).start()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        webhook.WebhookServer(bot, '0.0.0.0', webhook_port, webhook_secret, reuse_port=True).serve_forever()
+    finally:
+        scheduler.shutdown()
+        storage.close()
+        outbox.close()
+        history.close()
+        dorms.close()
+        lease.release()
+
+
+def _run_event_loop(event_loop):
+    asyncio.set_event_loop(event_loop)
+    event_loop.run_until_complete(bot.start())
+    event_loop.create_task(_resume_broadcasts_async())
+    try:
+        if webhook_url:
+            webhook.set_webhook(bot, webhook_url, webhook_secret)
+            webhook.WebhookServer(bot, '0.0.0.0', webhook_port, webhook_secret).start()
+            event_loop.run_forever()
+        else:
+            event_loop.run_until_complete(bot.polling())
+    finally:
+        event_loop.run_until_complete(bot.close())
+
 
-    if os.environ['SLUMOMETER_TEST']:
-        scheduler.init_for_test(storage)
-        scheduler._scheduler.print_jobs()
+if __name__ == '__main__' and worker_count > 1:
+    if not webhook_url or async_mode or sensors_port:
+        print("Error! SLUMOMETER_WORKERS needs SLUMOMETER_WEBHOOK_URL and doesn't work with SLUMOMETER_ASYNC and "
+              "SLUMOMETER_SENSORS_PORT")
+        sys.exit(1)
+    # Databases are created or migrated once before the workers open them
+    storage.load()
+    storage.close()
+    outbox.open()
+    outbox.close()
+    history.open()
+    history.close()
+    dorms.open()
+    dorms.close()
+    webhook.set_webhook(bot, webhook_url, webhook_secret)
+    LOG.info('Starting bot with {} workers'.format(worker_count))
+    telebot.logger.setLevel(logging.INFO)
+    cluster.run_workers(worker_count, _run_worker)
+elif __name__ == '__main__':
+    if not async_mode:
+        middleware.ChatWorkerPool(update_workers).install(bot)
+    storage.load()
+    outbox.open()
+    history.open()
+    dorms.open()
+    scheduler.set_callback(EventHandler())
+
+    event_loop = asyncio.new_event_loop() if async_mode else None
+    scheduler.init(storage, event_loop)
+    _add_tenants()
+    if sensors_port:
+        sensors.listen(sensors_host, int(sensors_port))
+        scheduler.watch_sensors(sensors, slum_threshold)
     else:
-        scheduler.init(storage)
+        scheduler.unwatch_sensors()
+
+    if metrics_port:
+        metrics.MetricsServer('127.0.0.1', int(metrics_port)).start()
+    if not async_mode:
+        threading.Thread(target=_resume_broadcasts, name='resume-broadcasts', daemon=True).start()
 
     LOG.info('Starting bot')
     telebot.logger.setLevel(logging.INFO)
 
-    bot.polling(True)
+    # Docker stops the container with SIGTERM. Turn it into SystemExit so that pending changes are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if async_mode:
+            _run_event_loop(event_loop)
+        elif webhook_url:
+            webhook.set_webhook(bot, webhook_url, webhook_secret)
+            webhook.WebhookServer(bot, '0.0.0.0', webhook_port, webhook_secret).serve_forever()
+        else:
+            bot.remove_webhook()
+            bot.polling(True)
+    finally:
+        scheduler.shutdown()
+        sensors.close()
+        storage.close()
+        outbox.close()
+        history.close()
+        dorms.close()
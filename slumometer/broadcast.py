@@ -0,0 +1,312 @@
+import array
+import asyncio
+import collections
+import logging
+import threading
+import time
+from requests.exceptions import RequestException
+from telebot.apihelper import ApiException
+from slumometer import metrics
+
+LOG = logging.getLogger("slumometer.broadcast")
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.INFO)
+
+# Telegram allows about 30 messages per second in total and about one message per second to the same chat
+GLOBAL_RATE_LIMIT = 30
+CHAT_SEND_INTERVAL = 1.0
+DEFAULT_WORKERS = 8
+DEFAULT_ASYNC_WORKERS = 100
+KEPT_REPORTS = 10  # Reports of this many last campaigns are kept for /status
+ASYNC_MARK_BATCH = 30  # Results of sends are written to the outbox by this many at once in the asyncio mode
+
+# Results of a send
+DELIVERED = 'delivered'
+FAILED = 'failed'
+UNAVAILABLE = 'unavailable'  # The chat blocked the bot or was deleted, or the bot was kicked from it
+
+_MAX_ATTEMPTS = 3
+_TRANSIENT_ERROR_DELAY = 1.0  # Seconds to wait before resending after a network error
+_PACER_MIN_PRUNE_SIZE = 1024
+# Descriptions of HTTP 400 errors which mean that the chat doesn't exist anymore. Other 400 errors, e.g. a bad markup,
+# are problems of the message
+_GONE_CHAT_ERRORS = ('chat not found', 'user not found', 'peer_id_invalid', 'group chat was deactivated')
+
+
+# Returns the error answer of Telegram as a dict
+def _error_answer(exception):
+    result = exception.result
+    if isinstance(result, dict):
+        return result
+    try:
+        return result.json()
+    except (AttributeError, ValueError):
+        return {}
+
+
+# Returns the number of seconds Telegram asked to wait (HTTP 429), or None if the error is of another kind
+def _retry_after(exception):
+    answer = _error_answer(exception)
+    if answer.get('error_code') != 429:
+        return None
+    return (answer.get('parameters') or {}).get('retry_after', _TRANSIENT_ERROR_DELAY)
+
+
+# Telegram answers HTTP 403 if the bot can't write to the chat anymore and HTTP 400 if the chat is gone
+def _is_chat_unavailable(exception):
+    answer = _error_answer(exception)
+    if answer.get('error_code') == 403:
+        return True
+    description = (answer.get('description') or '').lower()
+    return answer.get('error_code') == 400 and any(error in description for error in _GONE_CHAT_ERRORS)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    # Takes a token in advance. Returns the number of seconds the caller must wait before using it
+    def reserve(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    # Blocks until a token is available
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    # Nobody gets a token during the next `seconds` seconds
+    def pause(self, seconds):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+# Keeps messages to the same chat at least `interval` seconds apart
+class _ChatPacer:
+    def __init__(self, interval):
+        self._interval = interval
+        self._next_send_time = {}
+        self._prune_size = _PACER_MIN_PRUNE_SIZE
+        self._lock = threading.Lock()
+
+    # Returns the number of seconds to wait before sending to the chat
+    def reserve(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            send_time = max(now, self._next_send_time.get(chat_id, now))
+            self._next_send_time[chat_id] = send_time + self._interval
+            if len(self._next_send_time) > self._prune_size:
+                self._next_send_time = {chat: t for chat, t in self._next_send_time.items() if t > now}
+                self._prune_size = max(_PACER_MIN_PRUNE_SIZE, 2 * len(self._next_send_time))
+        return send_time - now
+
+    def wait(self, chat_id):
+        delay = self.reserve(chat_id)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class CampaignReport:
+    def __init__(self, campaign, total):
+        self.campaign = campaign
+        self.total = total
+        self.sent = 0
+        self.failed = 0  # Including unavailable chats
+        self.delivered_chats = array.array('q')  # 8 bytes per chat, so big campaigns stay cheap to keep
+        self.unavailable_chats = []
+        self.started = time.time()
+        self.duration = None  # Seconds between the start of the campaign and the last send
+        self._lock = threading.Lock()
+
+    def add(self, chat_id, result):
+        with self._lock:
+            if result == DELIVERED:
+                self.sent += 1
+                self.delivered_chats.append(chat_id)
+            else:
+                self.failed += 1
+                if result == UNAVAILABLE:
+                    self.unavailable_chats.append(chat_id)
+
+    def finish(self):
+        self.duration = time.time() - self.started
+
+    def __str__(self):
+        return "Campaign {}: {} of {} messages sent, {} failed ({} chats unavailable), took {:.1f} s".format(
+            self.campaign, self.sent, self.total, self.failed, len(self.unavailable_chats), self.duration or 0)
+
+
+class Broadcaster:
+    def __init__(self, send_function, workers=DEFAULT_WORKERS, rate=GLOBAL_RATE_LIMIT,
+                 chat_interval=CHAT_SEND_INTERVAL):
+        self._send_function = send_function  # Usually bot.send_message
+        self._workers = workers
+        self._bucket = TokenBucket(rate)
+        self._pacer = _ChatPacer(chat_interval)
+        # CampaignReports of the last campaigns, oldest first. Campaign names are unique, so only the last ones are kept
+        self.last_reports = collections.deque(maxlen=KEPT_REPORTS)
+
+    # Sends one message respecting rate limits. Returns DELIVERED, FAILED or UNAVAILABLE
+    def send(self, chat_id, text, **kwargs):
+        for attempt in range(_MAX_ATTEMPTS):
+            self._pacer.wait(chat_id)
+            self._bucket.acquire()
+            try:
+                with metrics.SEND_SECONDS.time():
+                    self._send_function(chat_id, text, **kwargs)
+                metrics.SENDS.inc(result=DELIVERED)
+                return DELIVERED
+            except ApiException as e:
+                retry_after = _retry_after(e)
+                if retry_after is None:
+                    result = UNAVAILABLE if _is_chat_unavailable(e) else FAILED
+                    LOG.warning("Failed to send a message to chat {}: {}".format(chat_id, e))
+                    metrics.SENDS.inc(result=result)
+                    return result
+                LOG.warning("Flood limit is exceeded, pausing sends for {} s".format(retry_after))
+                metrics.SEND_RETRIES.inc(reason='flood')
+                self._bucket.pause(retry_after)
+            except RequestException as e:
+                LOG.warning("Network error while sending a message to chat {}: {}".format(chat_id, e))
+                metrics.SEND_RETRIES.inc(reason='network')
+                time.sleep(_TRANSIENT_ERROR_DELAY)
+        metrics.SENDS.inc(result=FAILED)
+        return FAILED
+
+    # Sends `text` to every chat in `chat_ids` using a pool of workers. Blocks until all messages are processed
+    def broadcast(self, campaign, chat_ids, text, **kwargs):
+        return self._send_all(campaign, ((chat_id, text, kwargs) for chat_id in chat_ids), len(chat_ids))
+
+    # Sends pending messages of an outbox batch and records the result of every send in the outbox. If partition is
+    # (index, count), only that partition of the batch is sent and the batch is finished by the worker which is the last
+    # to send its partition
+    def deliver(self, outbox, batch_id, partition=None):
+        messages = outbox.pending_messages(batch_id, partition)
+        report = self._send_all(outbox.get_campaign(batch_id), messages, len(messages),
+                                lambda chat_id, result: outbox.mark(batch_id, chat_id, result == DELIVERED))
+        if partition is None or not outbox.has_pending_messages(batch_id):
+            outbox.finish_batch(batch_id)
+        return report
+
+    # `messages` yields (chat_id, text, send kwargs). on_result(chat_id, result) is called after every send
+    def _send_all(self, campaign, messages, count, on_result=None):
+        report = CampaignReport(campaign, count)
+        messages = iter(messages)
+        messages_lock = threading.Lock()
+
+        def worker():
+            while True:
+                with messages_lock:
+                    message = next(messages, None)
+                if message is None:
+                    return
+                chat_id, text, kwargs = message
+                result = self.send(chat_id, text, **kwargs)
+                report.add(chat_id, result)
+                if on_result is not None:
+                    on_result(chat_id, result)
+
+        threads = [threading.Thread(target=worker, name='broadcast-{}'.format(i), daemon=True)
+                   for i in range(min(self._workers, count))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        report.finish()
+        metrics.BROADCAST_SECONDS.observe(report.duration)
+        self.last_reports.append(report)
+        LOG.info(str(report))
+        return report
+
+
+# The same broadcaster for the asyncio mode. `send_function` is a coroutine function, workers are tasks
+class AsyncBroadcaster:
+    def __init__(self, send_function, workers=DEFAULT_ASYNC_WORKERS, rate=GLOBAL_RATE_LIMIT,
+                 chat_interval=CHAT_SEND_INTERVAL):
+        self._send_function = send_function  # Usually bot.async_send_message
+        self._workers = workers
+        self._bucket = TokenBucket(rate)
+        self._pacer = _ChatPacer(chat_interval)
+        self.last_reports = collections.deque(maxlen=KEPT_REPORTS)
+
+    async def send(self, chat_id, text, **kwargs):
+        for attempt in range(_MAX_ATTEMPTS):
+            await asyncio.sleep(self._pacer.reserve(chat_id))
+            await asyncio.sleep(self._bucket.reserve())
+            try:
+                with metrics.SEND_SECONDS.time():
+                    await self._send_function(chat_id, text, **kwargs)
+                metrics.SENDS.inc(result=DELIVERED)
+                return DELIVERED
+            except ApiException as e:
+                retry_after = _retry_after(e)
+                if retry_after is None:
+                    result = UNAVAILABLE if _is_chat_unavailable(e) else FAILED
+                    LOG.warning("Failed to send a message to chat {}: {}".format(chat_id, e))
+                    metrics.SENDS.inc(result=result)
+                    return result
+                LOG.warning("Flood limit is exceeded, pausing sends for {} s".format(retry_after))
+                metrics.SEND_RETRIES.inc(reason='flood')
+                self._bucket.pause(retry_after)
+            except RequestException as e:
+                LOG.warning("Network error while sending a message to chat {}: {}".format(chat_id, e))
+                metrics.SEND_RETRIES.inc(reason='network')
+                await asyncio.sleep(_TRANSIENT_ERROR_DELAY)
+        metrics.SENDS.inc(result=FAILED)
+        return FAILED
+
+    async def broadcast(self, campaign, chat_ids, text, **kwargs):
+        return await self._send_all(campaign, ((chat_id, text, kwargs) for chat_id in chat_ids), len(chat_ids))
+
+    # The outbox is written in a thread, so the loop doesn't wait for the disk. Results of sends are written by
+    # ASYNC_MARK_BATCH at once, about a second of sends: after a crash at most that many messages are sent again
+    async def deliver(self, outbox, batch_id):
+        loop = asyncio.get_running_loop()
+        messages = await loop.run_in_executor(None, outbox.pending_messages, batch_id)
+        campaign = await loop.run_in_executor(None, outbox.get_campaign, batch_id)
+        results = []
+        writes = []
+
+        def on_result(chat_id, result):
+            results.append((chat_id, result == DELIVERED))
+            if len(results) >= ASYNC_MARK_BATCH:
+                writes.append(loop.run_in_executor(None, outbox.mark_many, batch_id, results.copy()))
+                results.clear()
+
+        report = await self._send_all(campaign, messages, len(messages), on_result)
+        writes.append(loop.run_in_executor(None, outbox.mark_many, batch_id, results))
+        await asyncio.gather(*writes)
+        await loop.run_in_executor(None, outbox.finish_batch, batch_id)
+        return report
+
+    async def _send_all(self, campaign, messages, count, on_result=None):
+        report = CampaignReport(campaign, count)
+        messages = iter(messages)
+
+        async def worker():
+            for chat_id, text, kwargs in messages:
+                result = await self.send(chat_id, text, **kwargs)
+                report.add(chat_id, result)
+                if on_result is not None:
+                    on_result(chat_id, result)
+
+        await asyncio.gather(*(worker() for i in range(min(self._workers, count))))
+
+        report.finish()
+        metrics.BROADCAST_SECONDS.observe(report.duration)
+        self.last_reports.append(report)
+        LOG.info(str(report))
+        return report
@@ -0,0 +1,117 @@
+import array
+import bisect
+import math
+
+# Compact sets of chat ids for Storage. A chat takes 8 bytes in a flat array instead of a boxed int and a list slot, and
+# a set can be a view of a memory-mapped file, so loading it parses nothing
+
+_MIN_CHANGED_TO_COMPACT = 64
+
+
+# Returns ids[start:end] as bytes without copying them
+def _bytes(ids, start, end=None):
+    return memoryview(ids)[start:end].cast('B')
+
+
+# Immutable sorted set of chat ids in an array('q') or a memoryview of 'q'. Membership is a binary search. Changes return
+# a new set and copy the ids once, so readers may go on iterating the old set
+class ChatSet:
+    __slots__ = ('_ids',)
+
+    def __init__(self, chat_ids=()):
+        self._ids = array.array('q', sorted(set(chat_ids)))
+
+    # `ids` must be sorted and without repeats
+    @classmethod
+    def from_buffer(cls, ids):
+        chat_set = cls.__new__(cls)
+        chat_set._ids = ids
+        return chat_set
+
+    def _find(self, chat_id):
+        index = bisect.bisect_left(self._ids, chat_id)
+        return index, index < len(self._ids) and self._ids[index] == chat_id
+
+    def __contains__(self, chat_id):
+        return self._find(chat_id)[1]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    # Returns the chats as a list
+    def copy(self):
+        return list(self._ids)
+
+    def tobytes(self):
+        return self._ids.tobytes()
+
+    def add(self, chat_id):
+        index, found = self._find(chat_id)
+        if found:
+            return self
+        ids = array.array('q')
+        ids.frombytes(_bytes(self._ids, 0, index))
+        ids.append(chat_id)
+        ids.frombytes(_bytes(self._ids, index))
+        return ChatSet.from_buffer(ids)
+
+    def remove(self, chat_id):
+        return self.difference((chat_id,))
+
+    # Returns the set without `chat_ids`. The cost is a binary search per chat of `chat_ids` and one copy of the rest
+    def difference(self, chat_ids):
+        indexes = sorted(index for index, found in map(self._find, set(chat_ids)) if found)
+        if not indexes:
+            return self
+        ids = array.array('q')
+        start = 0
+        for index in indexes:
+            ids.frombytes(_bytes(self._ids, start, index))
+            start = index + 1
+        ids.frombytes(_bytes(self._ids, start))
+        return ChatSet.from_buffer(ids)
+
+
+# Chats of a notification campaign which haven't changed linen yet: the chats the campaign started with minus the chats
+# which have changed since. A campaign starts with the set of subscribed chats itself instead of a copy, and a chat which
+# changes linen joins the small set of changed chats. The changed chats are taken out of the big set once they are
+# about sqrt(n), so a change costs O(sqrt(n)) on average instead of a copy of all chats
+class PendingChats:
+    __slots__ = ('chats', 'changed')
+
+    def __init__(self, chats=ChatSet(), changed=ChatSet()):
+        self.chats = chats if isinstance(chats, ChatSet) else ChatSet(chats)
+        self.changed = changed  # Always a subset of chats
+
+    def __contains__(self, chat_id):
+        return chat_id not in self.changed and chat_id in self.chats
+
+    def __len__(self):
+        return len(self.chats) - len(self.changed)
+
+    def __iter__(self):
+        return iter(self.chats.difference(self.changed))
+
+    def copy(self):
+        return list(self)
+
+    def add(self, chat_id):
+        if chat_id in self:
+            return self
+        changed = self.changed.remove(chat_id) if chat_id in self.changed else self.changed
+        return PendingChats(self.chats.add(chat_id), changed)
+
+    def remove(self, chat_id):
+        if chat_id not in self:
+            return self
+        changed = self.changed.add(chat_id)
+        if len(changed) >= max(_MIN_CHANGED_TO_COMPACT, math.isqrt(len(self.chats))):
+            return PendingChats(self.chats.difference(changed))
+        return PendingChats(self.chats, changed)
+
+    def difference(self, chat_ids):
+        chat_ids = set(chat_ids)
+        return PendingChats(self.chats.difference(chat_ids), self.changed.difference(chat_ids))
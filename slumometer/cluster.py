@@ -0,0 +1,125 @@
+import fcntl
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+# Multi-process mode: a supervisor forks worker processes which share the state in SQLite. One of them holds a lease on
+# a lock file and runs the scheduler jobs
+
+LOG = logging.getLogger("slumometer.cluster")
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.INFO)
+
+_RESTART_DELAY = 1.0  # Seconds to wait before restarting a worker which died
+
+
+# Returns the index of the worker which sends broadcast messages to the chat. Group chats have negative ids
+def get_partition(chat_id, count):
+    return abs(chat_id) % count
+
+
+# Exclusive lease on a lock file. The kernel releases the lock when the holder exits or dies, so another process takes
+# the lease over without any clean-up
+class LeaderLease:
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    @property
+    def is_held(self):
+        return self._file is not None
+
+    # Takes the lease if nobody holds it. Returns True if this process holds the lease
+    def try_acquire(self):
+        if self._file is not None:
+            return True
+        file = open(self._path, 'a+')
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+        # The pid of the holder is written for admins only, the lock itself is what matters
+        file.seek(0)
+        file.truncate()
+        file.write('{}\n'.format(os.getpid()))
+        file.flush()
+        self._file = file
+        return True
+
+    # Calls on_acquired() in a background thread as soon as this process takes the lease
+    def watch(self, on_acquired, interval):
+        def run():
+            while not self.try_acquire():
+                time.sleep(interval)
+            on_acquired()
+
+        threading.Thread(target=run, name='leader-lease', daemon=True).start()
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()  # Closing the file releases the lock
+            self._file = None
+
+
+def _run_child(index, run_worker):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    code = 0
+    try:
+        run_worker(index)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 0
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        LOG.exception("Worker {} failed".format(index))
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+# Forks `count` workers which call run_worker(index) and restarts a worker which dies. SIGTERM and SIGINT are passed on
+# to the workers. Returns when all workers have exited. Nothing should start threads before this call
+def run_workers(count, run_worker):
+    workers = {}  # Pid -> index of the worker
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            _run_child(index, run_worker)
+        workers[pid] = index
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(count):
+        spawn(index)
+    LOG.info('Started {} workers'.format(count))
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = workers.pop(pid, None)
+        if index is None or stopping:
+            continue
+        LOG.warning("Worker {} exited with code {}, restarting it".format(index, os.waitstatus_to_exitcode(status)))
+        time.sleep(_RESTART_DELAY)
+        if not stopping:
+            spawn(index)
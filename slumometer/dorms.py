@@ -0,0 +1,101 @@
+import re
+from slumometer import scheduler
+from slumometer.history import History
+from slumometer.storage import Storage
+
+# Dormitories served by one bot. Every dormitory has its own subscribers, admins, change, reminder times and history in
+# its own folder, and the scheduler serves it as a tenant. The main dormitory is the first one: its data stays where the
+# bot with a single dormitory kept it. A chat belongs to the main dormitory until it chooses another one with /dorm
+
+DEFAULT_MAIN_NAME = 'main'
+_NAME_PATTERN = re.compile(r'^[a-z0-9_-]{1,32}$')
+
+
+# Parses 'name[:admin key],...'. Returns [(name, admin key or None)]
+def parse(value):
+    dorms = []
+    for item in value.split(','):
+        name, _, admin_key = item.strip().partition(':')
+        if not name:
+            continue
+        if not _NAME_PATTERN.match(name) or name in (other for other, key in dorms):
+            raise ValueError("Bad dormitory name: {}".format(name))
+        dorms.append((name, admin_key or None))
+    return dorms
+
+
+class Dorm:
+    __slots__ = ('name', 'tenant', 'storage', 'history', 'admin_key')
+
+    # `tenant` is the name of the dormitory in the scheduler: scheduler.DEFAULT_TENANT for the main one
+    def __init__(self, name, tenant, storage, history, admin_key):
+        self.name = name
+        self.tenant = tenant
+        self.storage = storage
+        self.history = history
+        self.admin_key = admin_key
+
+
+class Dorms:
+    # The storage and the history of the main dormitory are opened and closed by the caller. Storages of the other
+    # dormitories are made by storage_factory(folder=...). Dormitories without their own key use admin_key
+    def __init__(self, main_storage, main_history, admin_key, config, storage_factory):
+        (main_name, main_key), *others = config or [(DEFAULT_MAIN_NAME, None)]
+        self.main = Dorm(main_name, scheduler.DEFAULT_TENANT, main_storage, main_history, main_key or admin_key)
+        self._dorms = {main_name: self.main}
+        for name, key in others:
+            folder = Storage.get_dorm_folder(name)
+            self._dorms[name] = Dorm(name, name, storage_factory(folder=folder),
+                                     History(Storage.get_history_db_path(folder)), key or admin_key)
+
+    def __iter__(self):
+        return iter(self._dorms.values())
+
+    def __len__(self):
+        return len(self._dorms)
+
+    # Returns the dormitories except the main one
+    def others(self):
+        return [dorm for dorm in self if dorm is not self.main]
+
+    def open(self):
+        for dorm in self.others():
+            dorm.storage.load()
+            dorm.history.open()
+
+    def close(self):
+        for dorm in self.others():
+            dorm.storage.close()
+            dorm.history.close()
+
+    # Returns None if there is no such dormitory
+    def get(self, name):
+        return self._dorms.get(name)
+
+    def get_by_tenant(self, tenant):
+        return self.main if tenant == scheduler.DEFAULT_TENANT else self._dorms.get(tenant)
+
+    # A chat whose dormitory is no longer served belongs to the main one
+    def of_chat(self, chat_id):
+        return self._dorms.get(self.main.storage.get_chat_dorm(chat_id), self.main)
+
+    # Moves the chat with its subscription, reminder times and quiet hours to `dorm`. A chat which hasn't changed linen
+    # yet keeps getting reminders of the current change of `dorm`. Admin rights stay in the dormitory which gave them.
+    # Returns False if the chat is already there
+    def move_chat(self, chat_id, dorm):
+        current = self.of_chat(chat_id)
+        if dorm is current:
+            return False
+        subscribed = chat_id in current.storage.subscribed_chats
+        to_notify = chat_id in current.storage.chats_to_notify
+        current.storage.remove_subscribed_chats([chat_id])
+        current.storage.save()
+        if subscribed:
+            dorm.storage.add_subscribed_chat(chat_id)
+            if to_notify:
+                dorm.storage.add_chat_to_notify(chat_id)
+            dorm.storage.save()
+        scheduler.move_chat_schedule(chat_id, current.tenant, dorm.tenant)
+        self.main.storage.set_chat_dorm(chat_id, dorm.name if dorm is not self.main else None)
+        self.main.storage.save()
+        return True
@@ -0,0 +1,122 @@
+import logging
+import sqlite3
+import threading
+import time
+
+LOG = logging.getLogger("slumometer.history")
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.INFO)
+
+# Kinds of events
+CAMPAIGN_STARTED = 1
+ALARM_FIRED = 2
+LINEN_CHANGED = 3
+
+_NO_MINUTE = -1  # The minute of an alarm whose time depends on the end of the change, e.g. an hour before it
+
+
+# Append-only history of notification campaigns: when alarms fired, to how many chats, and when chats reported that they
+# had changed linen. Counters of campaigns and of alarm slots are updated in the same transaction as every event, so
+# statistics are read without scanning the history. A slot is (alarm type, minute of the day in Moscow time) of usual
+# alarms and (alarm type, None) of the alarms before the end of the change
+class History:
+    _SCHEMA = (
+        # recipients is the number of subscribed chats for CAMPAIGN_STARTED and the number of chats which got the alarm
+        # for ALARM_FIRED. chat_id is set for LINEN_CHANGED
+        'CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY, kind INTEGER NOT NULL, time REAL NOT NULL, '
+        'campaign INTEGER NOT NULL, chat_id INTEGER, alarm_type INTEGER, alarm_time REAL, recipients INTEGER)',
+        # An alarm which fires twice, e.g. after a crash, is recorded once. 2 is ALARM_FIRED
+        'CREATE UNIQUE INDEX IF NOT EXISTS events_alarms ON events (campaign, alarm_time) WHERE kind = 2',
+        'CREATE TABLE IF NOT EXISTS campaigns (id INTEGER PRIMARY KEY, first_alarm_time REAL NOT NULL UNIQUE, '
+        'subscribers INTEGER NOT NULL, alarms INTEGER NOT NULL DEFAULT 0, messages INTEGER NOT NULL DEFAULT 0, '
+        'confirmations INTEGER NOT NULL DEFAULT 0, last_alarm_type INTEGER, last_alarm_minute INTEGER)',
+        # Confirmations are counted in the slot of the last alarm of the campaign before them
+        'CREATE TABLE IF NOT EXISTS slots (alarm_type INTEGER NOT NULL, minute INTEGER NOT NULL, '
+        'alarms INTEGER NOT NULL DEFAULT 0, recipients INTEGER NOT NULL DEFAULT 0, '
+        'confirmations INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (alarm_type, minute)) WITHOUT ROWID',
+    )
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.RLock()
+        self._connection = None
+
+    def open(self):
+        self._connection = sqlite3.connect(self._path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._connection:
+            for statement in History._SCHEMA:
+                self._connection.execute(statement)
+
+    def _get_current_campaign(self):
+        return self._connection.execute('SELECT MAX(id) FROM campaigns').fetchone()[0]
+
+    def _append(self, kind, campaign, **columns):
+        names = ['kind', 'time', 'campaign'] + list(columns)
+        return self._connection.execute('INSERT OR IGNORE INTO events ({}) VALUES ({})'.format(
+            ', '.join(names), ', '.join('?' * len(names))), [kind, time.time(), campaign] + list(columns.values()))\
+            .rowcount
+
+    # Starts a campaign which is identified by the time of its first alarm. Starting it again does nothing
+    def start_campaign(self, first_alarm_time, subscribers):
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                'INSERT OR IGNORE INTO campaigns (first_alarm_time, subscribers) VALUES (?, ?)',
+                (first_alarm_time, subscribers))
+            if cursor.rowcount:
+                self._append(CAMPAIGN_STARTED, cursor.lastrowid, recipients=subscribers)
+                LOG.info("Campaign {} is started for {} chats".format(cursor.lastrowid, subscribers))
+
+    # alarm_time is the planned time of the alarm, `minute` is its minute of the day or None
+    def record_alarm(self, alarm_type, alarm_time, minute, recipients):
+        minute = minute if minute is not None else _NO_MINUTE
+        with self._lock, self._connection:
+            campaign = self._get_current_campaign()
+            if campaign is None:
+                return
+            if not self._append(ALARM_FIRED, campaign, alarm_type=alarm_type, alarm_time=alarm_time,
+                                recipients=recipients):
+                return
+            self._connection.execute('UPDATE campaigns SET alarms = alarms + 1, messages = messages + ?, '
+                                     'last_alarm_type = ?, last_alarm_minute = ? WHERE id = ?',
+                                     (recipients, alarm_type, minute, campaign))
+            self._connection.execute('INSERT OR IGNORE INTO slots (alarm_type, minute) VALUES (?, ?)',
+                                     (alarm_type, minute))
+            self._connection.execute('UPDATE slots SET alarms = alarms + 1, recipients = recipients + ? '
+                                     'WHERE alarm_type = ? AND minute = ?', (recipients, alarm_type, minute))
+
+    def record_linen_changed(self, chat_id):
+        with self._lock, self._connection:
+            campaign = self._get_current_campaign()
+            if campaign is None:
+                return
+            self._append(LINEN_CHANGED, campaign, chat_id=chat_id)
+            self._connection.execute('UPDATE campaigns SET confirmations = confirmations + 1 WHERE id = ?',
+                                     (campaign,))
+            alarm_type, minute = self._connection.execute(
+                'SELECT last_alarm_type, last_alarm_minute FROM campaigns WHERE id = ?', (campaign,)).fetchone()
+            self._connection.execute('UPDATE slots SET confirmations = confirmations + 1 '
+                                     'WHERE alarm_type = ? AND minute = ?', (alarm_type, minute))
+
+    # Returns the counters of the last campaign as a dict or None if there were no campaigns
+    def get_last_campaign(self):
+        columns = ('id', 'first_alarm_time', 'subscribers', 'alarms', 'messages', 'confirmations')
+        with self._lock:
+            row = self._connection.execute('SELECT {} FROM campaigns ORDER BY id DESC LIMIT 1'.format(
+                ', '.join(columns))).fetchone()
+        return dict(zip(columns, row)) if row is not None else None
+
+    # Returns [(alarm_type, minute, alarms, recipients, confirmations)] of all campaigns, ordered by slot
+    def get_slots(self):
+        with self._lock:
+            rows = self._connection.execute('SELECT alarm_type, minute, alarms, recipients, confirmations FROM slots '
+                                            'ORDER BY alarm_type, minute').fetchall()
+        return [(alarm_type, minute if minute != _NO_MINUTE else None, alarms, recipients, confirmations)
+                for alarm_type, minute, alarms, recipients, confirmations in rows]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,192 @@
+import json
+import logging
+import pickle
+import sqlite3
+import threading
+from datetime import datetime, timedelta, tzinfo
+from apscheduler.job import Job
+from apscheduler.jobstores.base import BaseJobStore, ConflictingIdError, JobLookupError
+from apscheduler.util import datetime_to_utc_timestamp, obj_to_ref, ref_to_obj, utc_timestamp_to_datetime
+from pytz import timezone
+
+LOG = logging.getLogger("slumometer.jobstore")
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.INFO)
+
+_LEGACY_TABLE = 'apscheduler_jobs'  # The table of SQLAlchemyJobStore
+
+
+def _timezone_name(tz):
+    return getattr(tz, 'zone', None) or str(tz)
+
+
+# Jobs are kept as JSON. datetime, timedelta and timezone values, which triggers keep in their state, are written as
+# tagged objects
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'$datetime': value.timestamp(), 'tz': _timezone_name(value.tzinfo) if value.tzinfo else None}
+    if isinstance(value, timedelta):
+        return {'$timedelta': value.total_seconds()}
+    if isinstance(value, tzinfo):
+        return {'$timezone': _timezone_name(value)}
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if '$datetime' in value:
+            tz = timezone(value['tz']) if value['tz'] else None
+            return datetime.fromtimestamp(value['$datetime'], tz)
+        if '$timedelta' in value:
+            return timedelta(seconds=value['$timedelta'])
+        if '$timezone' in value:
+            return timezone(value['$timezone'])
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+def _encode_job_state(state):
+    state = dict(state)
+    trigger = state.pop('trigger')
+    state['next_run_time'] = datetime_to_utc_timestamp(state['next_run_time'])
+    state = _encode(state)
+    state['trigger'] = {'class': obj_to_ref(type(trigger)), 'state': _encode(trigger.__getstate__())}
+    return json.dumps(state)
+
+
+def _decode_job_state(data):
+    state = json.loads(data)
+    trigger_data = state.pop('trigger')
+    state = _decode(state)
+    state['next_run_time'] = utc_timestamp_to_datetime(state['next_run_time'])
+    state['args'] = tuple(state['args'])
+    trigger_class = ref_to_obj(trigger_data['class'])
+    trigger = trigger_class.__new__(trigger_class)
+    trigger.__setstate__(_decode(trigger_data['state']))
+    state['trigger'] = trigger
+    return state
+
+
+# Persistent job store for APScheduler on the standard sqlite3 module. A job is a row with its next run time and its
+# state as JSON: the trigger, the function reference and the arguments. The bot has two jobs, so every operation is a
+# single query on a tiny table
+class SqliteJobStore(BaseJobStore):
+    def __init__(self, path):
+        super().__init__()
+        self._path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        self._connection = sqlite3.connect(self._path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, next_run_time REAL, '
+                                     'job_state TEXT NOT NULL)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS jobs_next_run_time ON jobs (next_run_time)')
+            self._migrate_legacy_jobs()
+
+    # Converts jobs written by SQLAlchemyJobStore before it was replaced. Their state is pickled
+    def _migrate_legacy_jobs(self):
+        if not self._connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                        (_LEGACY_TABLE,)).fetchall():
+            return
+        for job_id, next_run_time, job_state in self._connection.execute(
+                'SELECT id, next_run_time, job_state FROM {}'.format(_LEGACY_TABLE)).fetchall():
+            try:
+                state = _encode_job_state(pickle.loads(job_state))
+            except Exception:
+                LOG.exception('Unable to convert job "{}" -- dropping it'.format(job_id))
+                continue
+            self._connection.execute('INSERT OR REPLACE INTO jobs (id, next_run_time, job_state) VALUES (?, ?, ?)',
+                                     (job_id, next_run_time, state))
+        self._connection.execute('DROP TABLE IF EXISTS {}'.format(_LEGACY_TABLE))  # Workers start at the same time
+        LOG.info('Jobs are migrated from the SQLAlchemy job store')
+
+    def shutdown(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _reconstitute_job(self, job_state):
+        state = _decode_job_state(job_state)
+        state['jobstore'] = self
+        job = Job.__new__(Job)
+        job.__setstate__(state)
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+    def _get_jobs(self, where='', params=()):
+        with self._lock:
+            if self._connection is None:
+                return []  # The scheduler thread may look for due jobs once more while the scheduler shuts down
+            rows = self._connection.execute('SELECT id, job_state FROM jobs {} ORDER BY next_run_time'.format(where),
+                                            params).fetchall()
+        jobs = []
+        failed_job_ids = []
+        for job_id, job_state in rows:
+            try:
+                jobs.append(self._reconstitute_job(job_state))
+            except Exception:
+                self._logger.exception('Unable to restore job "%s" -- removing it', job_id)
+                failed_job_ids.append(job_id)
+        if failed_job_ids:
+            with self._lock, self._connection:
+                self._connection.executemany('DELETE FROM jobs WHERE id = ?', ((job_id,) for job_id in failed_job_ids))
+        return jobs
+
+    def lookup_job(self, job_id):
+        jobs = self._get_jobs('WHERE id = ?', (job_id,))
+        return jobs[0] if jobs else None
+
+    def get_due_jobs(self, now):
+        return self._get_jobs('WHERE next_run_time <= ?', (datetime_to_utc_timestamp(now),))
+
+    def get_next_run_time(self):
+        with self._lock:
+            if self._connection is None:
+                return None
+            row = self._connection.execute('SELECT MIN(next_run_time) FROM jobs').fetchone()
+        return utc_timestamp_to_datetime(row[0])
+
+    def get_all_jobs(self):
+        jobs = self._get_jobs()
+        self._fix_paused_jobs_sorting(jobs)
+        return jobs
+
+    def add_job(self, job):
+        try:
+            with self._lock, self._connection:
+                self._connection.execute('INSERT INTO jobs (id, next_run_time, job_state) VALUES (?, ?, ?)',
+                                         (job.id, datetime_to_utc_timestamp(job.next_run_time),
+                                          _encode_job_state(job.__getstate__())))
+        except sqlite3.IntegrityError:
+            raise ConflictingIdError(job.id)
+
+    def update_job(self, job):
+        with self._lock, self._connection:
+            changed = self._connection.execute('UPDATE jobs SET next_run_time = ?, job_state = ? WHERE id = ?', (
+                datetime_to_utc_timestamp(job.next_run_time), _encode_job_state(job.__getstate__()), job.id)).rowcount
+        if changed == 0:
+            raise JobLookupError(job.id)
+
+    def remove_job(self, job_id):
+        with self._lock, self._connection:
+            changed = self._connection.execute('DELETE FROM jobs WHERE id = ?', (job_id,)).rowcount
+        if changed == 0:
+            raise JobLookupError(job_id)
+
+    def remove_all_jobs(self):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM jobs')
+
+    def __repr__(self):
+        return '<{} (path={})>'.format(self.__class__.__name__, self._path)
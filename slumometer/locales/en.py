@@ -0,0 +1,121 @@
+# Markup rules:
+# 1. Every sentence ends with a period.
+# 2. Date and time are formatted as `code` and preceded by "at".
+# 3. A date alone or a time alone is not formatted as code.
+
+HELLO_MESSAGE = "Hi! This bot will help you not to forget to change the linen in your room. Send /subscribe and you " \
+                "will get a reminder on the day of the change."
+SUBSCRIBE_MESSAGE = "You will now get reminders about the change. To unsubscribe, send /unsubscribe."
+UNSUBSCRIBE_MESSAGE = "You have unsubscribed from reminders."
+ALREADY_SUBSCRIBED = "You are already subscribed."
+NOT_SUBSCRIBED = "You are not subscribed."
+
+ADMIN_ADDED_MESSAGE = "You are added as an admin."
+WRONG_ADMIN_KEY_MESSAGE = "Wrong key."
+ADMIN_COMMAND_ABOUT = "/admin <key>\nAn admin sets the time of the next linen change. If you are just a user, you " \
+                      "don't need this command."
+ADMIN_ONLY_USAGE = "This command is available to admins of the bot only."
+ADMIN_REMOVED_MESSAGE = "Your admin rights are revoked."
+ALREADY_ADMIN_MESSAGE = "You are already an admin."
+
+ABOUT_SET_TIME_CHANGE_COMMAND = "/stc <date> <start time> <end time> (1)\n" \
+                                "/stc n/a (2)\n" \
+                                "The command sets the time of the next linen change (1) or clears it (2). For " \
+                                "example, the command:\n" \
+                                "/stc 2019-09-30 9:00 16:30\n" \
+                                "sets the next change to September 30, 2019 from 9:00 to 16:30 Moscow time."
+TIME_NEXT_CHANGE_UPDATED = "The date and time of the next linen change are updated. The first reminder should come " \
+                           "at `{}`."
+TIME_NEXT_CHANGE_CLEARED = "The date and time of the next linen change are cleared."
+BAD_DATETIME_MESSAGE = "Wrong date and/or time. Make sure that the date is in YYYY-MM-DD format, the time is in HH:MM " \
+                       "format, and the time hasn't come yet."
+
+NA = "n/a"
+STATUS_MESSAGE = "The next linen change is from `{}` to `{}`.\n" \
+                 "{} chats are subscribed."
+STATUS_MESSAGE_DORM = "Dormitory {}."
+STATUS_MESSAGE_ADMIN_ADDITION = "Admins will be reminded to set the next change date at `{}`."
+STATUS_MESSAGE_REMAINING_ALARMS = "Remaining reminders: {}."
+STATUS_MESSAGE_METRICS = "Since the start {} broadcast messages were delivered, {} failed, {} were resent after " \
+                         "errors. {} unavailable chats were unsubscribed.\n" \
+                         "Last broadcast: {}.\n" \
+                         "Average scheduler delay: {}, average storage save: {}, " \
+                         "average sendMessage call: {}."
+SECONDS = "{:.3f} s"
+STATUS_MESSAGE_LAST_BROADCAST = "{} of {} messages in {} s"
+STATS_MESSAGE = "The last campaign started at `{}`: {} of {} chats have changed their linen ({}). Reminders: {}, " \
+                "messages: {}."
+STATS_NO_CAMPAIGNS = "There were no campaigns yet."
+STATS_SLOTS = "Chats which changed linen after a reminder, over all campaigns:"
+STATS_SLOT = "{}: {} of {} ({})"
+STATS_SLOT_1HOUR = "an hour before closing"
+STATS_SLOT_30MIN = "30 minutes before closing"
+STATS_SLOT_15MIN = "15 minutes before closing"
+STATS_SLOT_LAST = "after closing"
+
+NOTIFY_LINEN_CHANGE_USUAL = "Hand in your linen today before {}! If you have changed it, send /linen_changed. The next " \
+                            "reminder will come at {}."
+_NOTIFY_LINEN_CHANGE_IN_TIME = "The linen room closes in {}! Hurry to hand in your linen. If you have done it, send " \
+                               "/linen_changed."
+NOTIFY_LINEN_CHANGE_IN_1HOUR = _NOTIFY_LINEN_CHANGE_IN_TIME.format('an hour')
+NOTIFY_LINEN_CHANGE_IN_30MIN = _NOTIFY_LINEN_CHANGE_IN_TIME.format('30 minutes')
+NOTIFY_LINEN_CHANGE_IN_15MIN = _NOTIFY_LINEN_CHANGE_IN_TIME.format('15 minutes')
+NOTIFY_LINEN_CHANGE_LAST = "Alas, the linen room has closed. The next change will be in about 2 weeks. Sweet dreams " \
+                           "in a dirty bed :)"
+
+
+ADMIN_NOTIFY_SET_NEXT_TIME = "The date and time of the next linen change are not set yet. Please set them with the " \
+                             "/stc command. You will get the next reminder on {}."
+CHATS_PRUNED_MESSAGE = "{} chats are unsubscribed because they blocked the bot or were deleted."
+LINEN_CHANGED_MESSAGE = "Got it."
+LINEN_ALREADY_CHANGED_MESSAGE = "You have already changed your linen."
+
+ABOUT_SET_ADMIN_NOTIFICATION_TIME = "/sant <date> [time=12:00]\n" \
+                                    "The command moves the admin reminder to the given date. The reminder helps not " \
+                                    "to forget to set the next linen change date in the dormitory. The date is in " \
+                                    "YYYY-MM-DD format."
+ADMIN_NOTIFICATION_TIME_CHANGED = "Admins will get the next reminder at `{}`."
+
+SLOW_DOWN = "Too many commands. Please wait a bit and try again."
+ABOUT_LANGUAGE_COMMAND = "/language <language>\nChanges the language of the bot in this chat. Available languages: {}."
+LANGUAGE_CHANGED = "The bot will now talk to you in English."
+
+ABOUT_TIMES_COMMAND = "/times <HH:MM> [HH:MM ...] (1)\n" \
+                      "/times default (2)\n" \
+                      "The command sets the times of usual reminders on the day of the change in Moscow time (1) or " \
+                      "restores the default times (2). Times are rounded down to 5 minutes. Reminders before the " \
+                      "linen room closes always come. Now reminders come at {}."
+ABOUT_QUIET_COMMAND = "/quiet <from HH:MM> <to HH:MM> (1)\n" \
+                      "/quiet off (2)\n" \
+                      "The command sets quiet hours in Moscow time when usual reminders don't come (1) or turns them " \
+                      "off (2). Reminders before the linen room closes always come. For example:\n" \
+                      "/quiet 12:00 14:00"
+REMINDER_TIMES_CHANGED = "On the day of the change reminders will come at {} and before the linen room closes."
+NO_REMINDER_TIMES = "On the day of the change only the reminders before the linen room closes will come."
+ABOUT_DEFAULT_TIMES_COMMAND = "/default_times <HH:MM> [HH:MM ...] (1)\n" \
+                              "/default_times default (2)\n" \
+                              "The command sets the times of usual reminders in Moscow time for the chats of the " \
+                              "dormitory which haven't chosen their own times with /times (1) or restores the times " \
+                              "of the bot (2). Now they are {}."
+DEFAULT_TIMES_CHANGED = "Chats of the dormitory without their own times will get usual reminders at {}."
+
+ABOUT_DORM_COMMAND = "/dorm <dormitory>\n" \
+                     "Every dormitory has its own linen changes, admins and reminders. The command moves the chat to " \
+                     "another dormitory together with its subscription and reminder times. The chat is in dormitory " \
+                     "{} now. Available dormitories: {}."
+DORM_CHANGED = "The chat is in dormitory {} now."
+ALREADY_IN_DORM = "The chat is already in dormitory {}."
+
+ABOUT_ROOM_COMMAND = "/room <room> (1)\n" \
+                     "/room off (2)\n" \
+                     "Sensors in rooms measure temperature, humidity and CO2, and the bot computes the slum index of " \
+                     "the room from 0 (comfortable) to 100. The command subscribes the chat to alerts about the index " \
+                     "of the room (1) or stops them (2). For example:\n" \
+                     "/room 512"
+ROOM_CHANGED = "You will get an alert when the slum index of room {} reaches {}."
+ROOM_OFF = "You won't get alerts about the room anymore."
+ROOM_STATUS = "Room {}: the slum index is {} now and {} on average over the last day."
+ROOM_LAST_READING = "The last reading at `{}`: {:.1f} °C, {:.0f}% humidity, {:.0f} ppm of CO2."
+ROOM_NO_READINGS = "Room {} hasn't sent any readings yet."
+SENSOR_ALERT_RAISED = "The slum index of room {} has reached {}. Air the room!"
+SENSOR_ALERT_CLEARED = "The slum index of room {} is back to {}."
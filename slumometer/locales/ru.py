@@ -0,0 +1,123 @@
+# Правила разметки:
+# 1. В конце каждого предложения ставится точка.
+# 2. Дата и время оформляется как `код`, перед ними ставится предлог "в".
+# 3. Только дата или только время не оформляется как код, предлог "в" перед ними ставится согласно правилам русского
+#    языка.
+
+HELLO_MESSAGE = "Привет! Этот бот поможет вам не забыть поменять белье в комнате. Введите команду /subscribe и вы " \
+                "получите напоминание в день смены белья."
+SUBSCRIBE_MESSAGE = "Теперь вы будете получать напоминания о смене. Чтобы отписаться от уведомлений, введите " \
+                    "/unsubscribe."
+UNSUBSCRIBE_MESSAGE = "Вы отписались от уведомлений."
+ALREADY_SUBSCRIBED = "Вы уже подписаны."
+NOT_SUBSCRIBED = "Вы не подписаны на рассылку."
+
+ADMIN_ADDED_MESSAGE = "Вы добавлены как админ."
+WRONG_ADMIN_KEY_MESSAGE = "Неправильный ключ."
+ADMIN_COMMAND_ABOUT = "/admin <ключ>\nАдминистратор выставляет время следующей сдачи белья. Если вы просто " \
+                      "пользователь, эта команда не должна вас интересовать."
+ADMIN_ONLY_USAGE = "Эта команда доступна только для администраторов бота."
+ADMIN_REMOVED_MESSAGE = "Полномочия администатора отозваны."
+ALREADY_ADMIN_MESSAGE = "Вы и так админ."
+
+ABOUT_SET_TIME_CHANGE_COMMAND = "/stc <дата> <время начала сдачи> <время конца сдачи> (1)\n" \
+                                "/stc n/a (2)\n" \
+                                "Команда установит следующее время сдачи белья (1) или сбросит его (2). Например " \
+                                "команда:\n" \
+                                "/stc 2019-09-30 9:00 16:30\n" \
+                                "установит следующую сдачу на 30 сентября 2019 с 9:00 до 16:30 по МСК."
+TIME_NEXT_CHANGE_UPDATED = "Дата и время следующей смены белья изменены. Первое уведомление о смене должно прийти `{}`."
+TIME_NEXT_CHANGE_CLEARED = "Дата и время следующей смены белья сброшены."
+BAD_DATETIME_MESSAGE = "Некорректные дата и/или время. Убедитесь, что вы ввели дату в формате ГГГГ-ММ-ДД, время — " \
+                       "ЧЧ:ММ, и указанное время еще не наступило."
+
+NA = "н/у"
+STATUS_MESSAGE = "Следующая смена белья будет с `{}` по `{}`.\n" \
+                 "На рассылку зарегистрировано {} чатов."
+STATUS_MESSAGE_DORM = "Общежитие {}."
+STATUS_MESSAGE_ADMIN_ADDITION = "Админы получат следующее напоминание выставить новую дату смены в `{}`."
+STATUS_MESSAGE_REMAINING_ALARMS = "Оставшиеся напоминания о смене: {}."
+STATUS_MESSAGE_METRICS = "С запуска бота доставлено {} сообщений рассылки, не доставлено {}, повторено после " \
+                         "ошибок {}. Отписано недоступных чатов: {}.\n" \
+                         "Последняя рассылка: {}.\n" \
+                         "Среднее опоздание планировщика: {}, среднее сохранение хранилища: {}, " \
+                         "средний вызов sendMessage: {}."
+SECONDS = "{:.3f} с"
+STATUS_MESSAGE_LAST_BROADCAST = "{} из {} сообщений за {} с"
+STATS_MESSAGE = "Последняя кампания началась в `{}`: белье поменяли {} из {} чатов ({}). Напоминаний: {}, " \
+                "сообщений: {}."
+STATS_NO_CAMPAIGNS = "Кампаний еще не было."
+STATS_SLOTS = "Сколько чатов поменяли белье после напоминания, за все кампании:"
+STATS_SLOT = "{}: {} из {} ({})"
+STATS_SLOT_1HOUR = "за час до закрытия"
+STATS_SLOT_30MIN = "за 30 минут до закрытия"
+STATS_SLOT_15MIN = "за 15 минут до закрытия"
+STATS_SLOT_LAST = "после закрытия"
+
+#NOTIFY_LINEN_CHANGE = "Сдайте белье сегодня до {}! Если вы его поменяли, напишите /linen_changed."
+#NOTIFY_LAST_LINEN_CHANGE = "Сдайте белье! Это последнее напоминение: кастелянная закрывается."
+NOTIFY_LINEN_CHANGE_USUAL = "Сдайте белье сегодня до {}! Если вы его поменяли, напишите /linen_changed. Следующее " \
+                            "напоминание вы получите в {}."
+_NOTIFY_LINEN_CHANGE_IN_TIME = "Кастелянная закрывается через {}! Успейте сдать белье. Если вы его сдали, напишите " \
+                              "/linen_changed."
+NOTIFY_LINEN_CHANGE_IN_1HOUR = _NOTIFY_LINEN_CHANGE_IN_TIME.format('час')
+NOTIFY_LINEN_CHANGE_IN_30MIN = _NOTIFY_LINEN_CHANGE_IN_TIME.format('30 минут')
+NOTIFY_LINEN_CHANGE_IN_15MIN = _NOTIFY_LINEN_CHANGE_IN_TIME.format('15 минут')
+NOTIFY_LINEN_CHANGE_LAST = "Увы, кастелянная закрылась. Следующая сдача будет примерно через 2 недели. Приятных снов на " \
+                           "грязной постели :)"
+
+
+ADMIN_NOTIFY_SET_NEXT_TIME = "Дата и время следующей сдачи белья еще не указаны. Пожалуйста, укажите их с помощью " \
+                             "команды /stc. Следующее напоминание вы получите {}."
+CHATS_PRUNED_MESSAGE = "{} чатов отписаны от рассылки, так как они заблокировали бота или были удалены."
+LINEN_CHANGED_MESSAGE = "Понял, принял."
+LINEN_ALREADY_CHANGED_MESSAGE = "Вы уже поменяли белье."
+
+ABOUT_SET_ADMIN_NOTIFICATION_TIME = "/sant <дата> [время=12:00]\n" \
+                                    "Команда переносит напоминание админам на указанную дату. Напоминание нужно, чтобы "\
+                                    "не забыть указать следующую дату смены белья в общежитии. Дата указывается в " \
+                                    "формате ГГГГ-ММ-ДД."
+ADMIN_NOTIFICATION_TIME_CHANGED = "Следующее напоминание админы получат в `{}`."
+
+SLOW_DOWN = "Слишком много команд. Подождите немного и попробуйте снова."
+ABOUT_LANGUAGE_COMMAND = "/language <язык>\nМеняет язык сообщений бота в этом чате. Доступные языки: {}."
+LANGUAGE_CHANGED = "Теперь бот будет писать вам по-русски."
+
+ABOUT_TIMES_COMMAND = "/times <ЧЧ:ММ> [ЧЧ:ММ ...] (1)\n" \
+                      "/times default (2)\n" \
+                      "Команда задает время обычных напоминаний в день смены белья по МСК (1) или возвращает время " \
+                      "по умолчанию (2). Время округляется вниз до 5 минут. Напоминания перед закрытием кастелянной " \
+                      "приходят всегда. Сейчас напоминания приходят в {}."
+ABOUT_QUIET_COMMAND = "/quiet <с ЧЧ:ММ> <до ЧЧ:ММ> (1)\n" \
+                      "/quiet off (2)\n" \
+                      "Команда задает тихие часы по МСК, в которые не приходят обычные напоминания (1), или отключает " \
+                      "их (2). Напоминания перед закрытием кастелянной приходят всегда. Например, команда:\n" \
+                      "/quiet 12:00 14:00"
+REMINDER_TIMES_CHANGED = "В день смены белья напоминания придут в {}, а также перед закрытием кастелянной."
+NO_REMINDER_TIMES = "В день смены белья придут только напоминания перед закрытием кастелянной."
+ABOUT_DEFAULT_TIMES_COMMAND = "/default_times <ЧЧ:ММ> [ЧЧ:ММ ...] (1)\n" \
+                              "/default_times default (2)\n" \
+                              "Команда задает время обычных напоминаний по МСК для чатов общежития, которые не " \
+                              "выбрали свое время командой /times (1), или возвращает время бота (2). Сейчас это {}."
+DEFAULT_TIMES_CHANGED = "Чаты общежития без своего времени будут получать обычные напоминания в {}."
+
+ABOUT_DORM_COMMAND = "/dorm <общежитие>\n" \
+                     "У каждого общежития свои смены белья, админы и напоминания. Команда переводит чат в другое " \
+                     "общежитие вместе с подпиской и временем напоминаний. Сейчас чат в общежитии {}. Доступные " \
+                     "общежития: {}."
+DORM_CHANGED = "Теперь чат в общежитии {}."
+ALREADY_IN_DORM = "Чат уже в общежитии {}."
+
+ABOUT_ROOM_COMMAND = "/room <комната> (1)\n" \
+                     "/room off (2)\n" \
+                     "Датчики в комнатах измеряют температуру, влажность и CO2, а бот считает по ним индекс " \
+                     "трущобности комнаты от 0 (комфортно) до 100. Команда подписывает чат на оповещения об индексе " \
+                     "комнаты (1) или отключает их (2). Например, команда:\n" \
+                     "/room 512"
+ROOM_CHANGED = "Вы получите оповещение, когда индекс трущобности комнаты {} достигнет {}."
+ROOM_OFF = "Оповещения о комнате больше не будут приходить."
+ROOM_STATUS = "Комната {}: индекс трущобности сейчас {}, в среднем за последние сутки {}."
+ROOM_LAST_READING = "Последние показания в `{}`: {:.1f} °C, влажность {:.0f}%, CO2 {:.0f} ppm."
+ROOM_NO_READINGS = "Комната {} еще не присылала показаний."
+SENSOR_ALERT_RAISED = "Индекс трущобности комнаты {} достиг {}. Проветрите комнату!"
+SENSOR_ALERT_CLEARED = "Индекс трущобности комнаты {} снизился до {}."
@@ -0,0 +1,237 @@
+import logging
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Counters, gauges and histograms of the bot. They are served in the Prometheus text format on /metrics
+
+LOG = logging.getLogger("slumometer.metrics")
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.INFO)
+
+_DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_BROADCAST_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_metrics = []  # All metrics in the order of creation
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"')
+                                           .replace('\n', r'\n'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}  # Tuple of label values -> value
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('{} expects labels {}, got {}'.format(self.name, self.labels, tuple(labels)))
+        return tuple(labels[name] for name in self.labels)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.type)]
+        for name, key, extra, value in self._samples():
+            lines.append('{}{} {}'.format(name, _format_labels(self.labels, key, extra), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    # If `function` is given, the gauge has no labels and its value is function() at the time of reading
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self._function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        if self._function is not None:
+            return self._function()
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        if self._function is not None:
+            return [(self.name, (), (), self._function())]
+        return super()._samples()
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(time.perf_counter() - self._started, **self._labels)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=_DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                # [count of every bucket, sum]. Buckets aren't cumulative here, they are summed up on rendering
+                data = self._values[key] = [[0] * len(self.buckets), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[0][i] += 1
+                    break
+            data[1] += value
+
+    # Measures the time of a `with` block
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        with self._lock:
+            data = self._values.get(self._key(labels))
+            return sum(data[0]) if data is not None else 0
+
+    # Returns the mean of observed values or None if nothing is observed
+    def mean(self, **labels):
+        with self._lock:
+            data = self._values.get(self._key(labels))
+            if data is None or not sum(data[0]):
+                return None
+            return data[1] / sum(data[0])
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (bucket_counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    samples.append((self.name + '_bucket', key, (('le', _format_value(bound)),), cumulative))
+                samples.append((self.name + '_sum', key, (), total))
+                samples.append((self.name + '_count', key, (), cumulative))
+        return samples
+
+
+# Returns all metrics in the Prometheus text format
+def render():
+    return '\n'.join(metric.render() for metric in _metrics) + '\n'
+
+
+START_TIME = Gauge('slumometer_start_time_seconds', 'Unix time when the bot was started')
+START_TIME.set(time.time())
+HANDLER_SECONDS = Histogram('slumometer_handler_seconds', 'Time spent in command handlers', ('handler',))
+HANDLER_ERRORS = Counter('slumometer_handler_errors_total', 'Command handlers which raised an exception',
+                         ('handler',))
+UPDATES_DROPPED = Counter('slumometer_updates_dropped_total', 'Updates dropped before the handlers',
+                          ('reason',))  # duplicate, throttled or collapsed
+SENDS = Counter('slumometer_sends_total', 'Broadcast messages by result',
+                ('result',))  # delivered, failed or unavailable
+CHATS_PRUNED = Counter('slumometer_chats_pruned_total', 'Chats unsubscribed because they are unavailable')
+SEND_RETRIES = Counter('slumometer_send_retries_total', 'Broadcast sends repeated after an error',
+                       ('reason',))  # flood or network
+SEND_SECONDS = Histogram('slumometer_send_seconds', 'Duration of a single sendMessage call of a broadcast')
+API_REQUEST_SECONDS = Histogram('slumometer_api_request_seconds', 'Duration of an HTTP request to the Telegram API',
+                                ('method',))
+API_RETRIES = Counter('slumometer_api_retries_total', 'Telegram API requests repeated by the transport',
+                      ('reason',))  # connect, network or server
+BROADCAST_SECONDS = Histogram('slumometer_broadcast_seconds', 'Duration of a whole broadcast',
+                              buckets=_BROADCAST_BUCKETS)
+STORAGE_SAVE_SECONDS = Histogram('slumometer_storage_save_seconds', 'Time Storage.save() blocks the caller')
+STORAGE_FLUSH_SECONDS = Histogram('slumometer_storage_flush_seconds', 'Time of writing the storage to disk')
+JOB_LATENESS_SECONDS = Histogram('slumometer_job_lateness_seconds',
+                                 'Delay between the planned and the actual start of a scheduler job', ('job',))
+JOB_SECONDS = Histogram('slumometer_job_seconds', 'Duration of scheduler jobs', ('job',),
+                        buckets=_DEFAULT_BUCKETS + _BROADCAST_BUCKETS[1:])
+JOB_MISSED = Counter('slumometer_jobs_missed_total', 'Scheduler jobs which were not run in time', ('job',))
+JOB_ERRORS = Counter('slumometer_job_errors_total', 'Scheduler jobs which raised an exception', ('job',))
+SENSOR_READINGS = Counter('slumometer_sensor_readings_total', 'Sensor readings received',
+                          ('result',))  # accepted or rejected
+SENSOR_ALERTS = Counter('slumometer_sensor_alerts_total', 'Rooms whose slum index has reached the threshold')
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', _CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug(format % args)
+
+
+# Serves /metrics in a background thread
+class MetricsServer:
+    def __init__(self, host, port):
+        self._server = ThreadingHTTPServer((host, port), _RequestHandler)
+        self._server.daemon_threads = True
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+        LOG.info('Serving metrics on port {}'.format(self.port))
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
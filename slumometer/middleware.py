@@ -0,0 +1,152 @@
+import collections
+import logging
+import queue
+import threading
+import time
+from telebot import util
+from slumometer import cluster, metrics
+
+LOG = logging.getLogger("slumometer.middleware")
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.INFO)
+
+# Every chat may send a burst of CHAT_BURST commands and then one command per CHAT_COMMAND_INTERVAL seconds
+CHAT_BURST = 5
+CHAT_COMMAND_INTERVAL = 3.0
+COLLAPSE_WINDOW = 10.0  # Repeats of an idempotent command within this many seconds are dropped
+# Commands which leave the same state and give the same answer when repeated
+IDEMPOTENT_COMMANDS = frozenset(('start', 'help', 'subscribe', 'unsubscribe', 'linen_changed', 'status', 'language',
+                                 'times', 'quiet', 'stats', 'room', 'dorm', 'default_times'))
+
+DEFAULT_UPDATE_WORKERS = 4
+
+_SLOW_DOWN_INTERVAL = 30.0  # A throttled chat is told to slow down at most once per this many seconds
+_REMEMBERED_UPDATES = 10000
+_MIN_PRUNE_SIZE = 1024
+
+
+# Filters updates before they reach the message handlers: drops updates which were already processed, throttles chats
+# which send too many commands and collapses repeated idempotent commands into one. on_throttled(message) is called
+# when a chat is throttled, at most once per _SLOW_DOWN_INTERVAL, and should send a cheap reply
+class UpdateFilter:
+    def __init__(self, on_throttled=None, burst=CHAT_BURST, command_interval=CHAT_COMMAND_INTERVAL,
+                 collapse_window=COLLAPSE_WINDOW, idempotent_commands=IDEMPOTENT_COMMANDS):
+        self._on_throttled = on_throttled
+        self._burst = burst
+        self._command_interval = command_interval
+        self._collapse_window = collapse_window
+        self._idempotent_commands = idempotent_commands
+        self._update_ids = set()
+        self._update_ids_order = collections.deque()
+        self._buckets = {}  # Chat id -> [tokens, time of update, time of the last "slow down" reply]
+        self._last_commands = {}  # Chat id -> (text of its last command, time)
+        self._prune_size = _MIN_PRUNE_SIZE
+        self._lock = threading.Lock()
+
+    # Wraps bot.process_new_updates. The bot still sees the ids of dropped updates, so polling doesn't get them again
+    def install(self, bot):
+        process_new_updates = bot.process_new_updates
+
+        def filtered_process_new_updates(updates):
+            for update in updates:
+                if update.update_id > bot.last_update_id:
+                    bot.last_update_id = update.update_id
+            updates = self.filter(updates)
+            if updates:
+                process_new_updates(updates)
+
+        bot.process_new_updates = filtered_process_new_updates
+
+    def filter(self, updates):
+        now = time.monotonic()
+        accepted = []
+        throttled = []
+        with self._lock:
+            for update in updates:
+                reason = self._check(update, now)
+                if reason is None:
+                    accepted.append(update)
+                    continue
+                metrics.UPDATES_DROPPED.inc(reason=reason)
+                if reason == 'throttled' and self._should_reply(update.message.chat.id, now):
+                    throttled.append(update.message)
+            self._prune(now)
+
+        for message in throttled:
+            LOG.info("Chat {} is throttled".format(message.chat.id))
+            if self._on_throttled is not None:
+                self._on_throttled(message)
+        return accepted
+
+    # Returns the reason to drop the update or None
+    def _check(self, update, now):
+        if update.update_id in self._update_ids:
+            return 'duplicate'
+        self._update_ids.add(update.update_id)
+        self._update_ids_order.append(update.update_id)
+        if len(self._update_ids_order) > _REMEMBERED_UPDATES:
+            self._update_ids.discard(self._update_ids_order.popleft())
+
+        message = update.message
+        if message is None or message.content_type != 'text' or not util.is_command(message.text):
+            return None
+        chat_id = message.chat.id
+
+        # Only a repeat of the previous command of the chat is collapsed: /subscribe, /unsubscribe, /subscribe must
+        # leave the chat subscribed
+        text = message.text.strip()
+        last_command = self._last_commands.get(chat_id)
+        self._last_commands[chat_id] = (text, now)
+        if last_command is not None and last_command[0] == text and now - last_command[1] < self._collapse_window and \
+                util.extract_command(text) in self._idempotent_commands:
+            return 'collapsed'
+
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = [self._burst, now, None]
+        bucket[0] = min(self._burst, bucket[0] + (now - bucket[1]) / self._command_interval)
+        bucket[1] = now
+        if bucket[0] < 1:
+            return 'throttled'
+        bucket[0] -= 1
+        return None
+
+    def _should_reply(self, chat_id, now):
+        bucket = self._buckets[chat_id]
+        if bucket[2] is not None and now - bucket[2] < _SLOW_DOWN_INTERVAL:
+            return False
+        bucket[2] = now
+        return True
+
+    # Forgets chats whose buckets are full again and commands older than the window
+    def _prune(self, now):
+        if len(self._buckets) + len(self._last_commands) <= self._prune_size:
+            return
+        refill_time = self._burst * self._command_interval
+        self._buckets = {chat_id: bucket for chat_id, bucket in self._buckets.items()
+                         if now - bucket[1] < refill_time or
+                         (bucket[2] is not None and now - bucket[2] < _SLOW_DOWN_INTERVAL)}
+        self._last_commands = {chat_id: command for chat_id, command in self._last_commands.items()
+                               if now - command[1] < self._collapse_window}
+        self._prune_size = max(_MIN_PRUNE_SIZE, 2 * (len(self._buckets) + len(self._last_commands)))
+
+
+# Runs the handlers of the bot in place of its util.ThreadPool. Every worker has its own queue and a chat always goes to
+# the same worker, so commands of one chat are handled in the order they came while different chats run in parallel
+class ChatWorkerPool(util.ThreadPool):
+    def __init__(self, num_threads=DEFAULT_UPDATE_WORKERS):
+        self.num_threads = num_threads
+        self.workers = [util.WorkerThread(self.on_exception, queue.Queue(), name='update-worker-{}'.format(i))
+                        for i in range(num_threads)]
+        self.exception_event = threading.Event()
+        self.exc_info = None
+
+    def install(self, bot):
+        bot.threaded = True
+        bot.worker_pool = self
+
+    # Handlers get the message first. Tasks without a chat go to the first worker
+    def put(self, func, *args, **kwargs):
+        chat = getattr(args[0], 'chat', None) if args else None
+        index = cluster.get_partition(chat.id, self.num_threads) if chat is not None else 0
+        self.workers[index].put(func, *args, **kwargs)
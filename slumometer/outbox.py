@@ -0,0 +1,121 @@
+import logging
+import sqlite3
+import threading
+import time
+from slumometer import cluster
+
+LOG = logging.getLogger("slumometer.outbox")
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.INFO)
+
+# States of a message
+PENDING = 0
+SENT = 1
+FAILED = 2
+
+_KEEP_FINISHED_BATCHES = 14 * 24 * 60 * 60  # Messages of finished batches are deleted after two weeks
+
+
+def _partition_condition(partition):
+    if partition is None:
+        return '', ()
+    index, count = partition
+    return ' AND get_partition(messages.chat_id, ?) = ?', (count, index)
+
+
+# Durable queue of broadcasts. Every broadcast is written as a batch of messages before the first send and every send
+# is recorded, so a broadcast interrupted by a crash resumes on restart without sending anything twice
+class Outbox:
+    _SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS batches (id INTEGER PRIMARY KEY, campaign TEXT NOT NULL UNIQUE, '
+        'created_at REAL NOT NULL, finished_at REAL)',
+        'CREATE TABLE IF NOT EXISTS texts (id INTEGER PRIMARY KEY, text TEXT NOT NULL, parse_mode TEXT)',
+        'CREATE TABLE IF NOT EXISTS messages (batch_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, '
+        'text_id INTEGER NOT NULL, state INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (batch_id, chat_id)) WITHOUT ROWID',
+    )
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.RLock()
+        self._connection = None
+
+    def open(self):
+        self._connection = sqlite3.connect(self._path, check_same_thread=False)
+        # Partitions are chosen by the same function in SQL and in Python, so they can't disagree
+        self._connection.create_function('get_partition', 2, cluster.get_partition, deterministic=True)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        with self._connection:
+            for statement in Outbox._SCHEMA:
+                self._connection.execute(statement)
+
+    # Writes a batch of messages. `messages` is a list of (chat_id, text, parse_mode). A campaign is written only
+    # once: if a batch for it already exists, its id is returned and `messages` are ignored
+    def create_batch(self, campaign, messages):
+        with self._lock, self._connection:
+            row = self._connection.execute('SELECT id FROM batches WHERE campaign = ?', (campaign,)).fetchone()
+            if row is not None:
+                LOG.info("Campaign {} is already in the outbox".format(campaign))
+                return row[0]
+
+            batch_id = self._connection.execute('INSERT INTO batches (campaign, created_at) VALUES (?, ?)',
+                                                (campaign, time.time())).lastrowid
+            text_ids = {}
+            for chat_id, text, parse_mode in messages:
+                if (text, parse_mode) not in text_ids:
+                    text_ids[(text, parse_mode)] = self._connection.execute(
+                        'INSERT INTO texts (text, parse_mode) VALUES (?, ?)', (text, parse_mode)).lastrowid
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO messages (batch_id, chat_id, text_id) VALUES (?, ?, ?)',
+                ((batch_id, chat_id, text_ids[(text, parse_mode)]) for chat_id, text, parse_mode in messages))
+            return batch_id
+
+    def get_campaign(self, batch_id):
+        with self._lock:
+            return self._connection.execute('SELECT campaign FROM batches WHERE id = ?', (batch_id,)).fetchone()[0]
+
+    # Returns [(chat_id, text, send kwargs)] of messages which weren't sent yet. If partition is (index, count), only
+    # messages to the chats of that partition are returned, see cluster.get_partition
+    def pending_messages(self, batch_id, partition=None):
+        condition, params = _partition_condition(partition)
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT messages.chat_id, texts.text, texts.parse_mode FROM messages '
+                'JOIN texts ON texts.id = messages.text_id WHERE messages.batch_id = ? AND messages.state = ?' +
+                condition, (batch_id, PENDING) + params).fetchall()
+        return [(chat_id, text, {'parse_mode': parse_mode}) for chat_id, text, parse_mode in rows]
+
+    def has_pending_messages(self, batch_id, partition=None):
+        condition, params = _partition_condition(partition)
+        with self._lock:
+            return self._connection.execute(
+                'SELECT 1 FROM messages WHERE messages.batch_id = ? AND messages.state = ?' + condition + ' LIMIT 1',
+                (batch_id, PENDING) + params).fetchone() is not None
+
+    def mark(self, batch_id, chat_id, delivered):
+        self.mark_many(batch_id, [(chat_id, delivered)])
+
+    # Records the results [(chat_id, delivered)] of several sends in one transaction
+    def mark_many(self, batch_id, results):
+        with self._lock, self._connection:
+            self._connection.executemany('UPDATE messages SET state = ? WHERE batch_id = ? AND chat_id = ?',
+                                         ((SENT if delivered else FAILED, batch_id, chat_id)
+                                          for chat_id, delivered in results))
+
+    def finish_batch(self, batch_id):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute('UPDATE batches SET finished_at = ? WHERE id = ?', (now, batch_id))
+            self._connection.execute('DELETE FROM messages WHERE batch_id IN (SELECT id FROM batches WHERE '
+                                     'finished_at < ?)', (now - _KEEP_FINISHED_BATCHES,))
+            self._connection.execute('DELETE FROM texts WHERE id NOT IN (SELECT DISTINCT text_id FROM messages)')
+
+    # Returns ids of batches which were interrupted, oldest first
+    def unfinished_batches(self):
+        with self._lock:
+            return [row[0] for row in self._connection.execute(
+                'SELECT id FROM batches WHERE finished_at IS NULL ORDER BY id').fetchall()]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
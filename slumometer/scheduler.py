@@ -1,9 +1,19 @@
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.base import BaseTrigger
 from datetime import datetime
 from datetime import timedelta
 from datetime import time
 from common import MOSCOW_TIMEZONE
+from pytz import utc
+from slumometer import metrics
+from slumometer.jobstore import SqliteJobStore
+import asyncio
+import inspect
 import logging
+import threading
 
 LOG = logging.getLogger("slumometer.scheduler")
 LOG.addHandler(logging.StreamHandler())
@@ -11,8 +21,10 @@ LOG.setLevel(logging.INFO)
 
 _JOB_ADMIN_NOTIFIER = 'admin_notifier'  # A job that reminds admin to set new datetime for linen change
 _JOB_USER_NOTIFIER = 'user_notifier'  # The main job which sends notifications to users
+_JOB_SENSOR_CHECK = 'sensor_check'  # A job that compares slum indexes of rooms with the threshold
 _FIRST_ADMIN_NOTIFICATION_DELAY = timedelta(days=14)
 _PERIODICAL_ADMIN_NOTIFICATION_DELAY = timedelta(days=7)
+_SENSOR_CHECK_INTERVAL = timedelta(minutes=1)
 # Времена, в которые можно присылать уведомления. (за исключением 1-часовой зоны перед концом смены)
 # Указаны в московской временной зоне
 _USER_NOTIFICATION_TIMES_TO_SEND = (
@@ -39,13 +51,48 @@ _USER_1HOUR_TO_END_DELAY = timedelta(hours=1)
 _USER_30MIN_TO_END_DELAY = timedelta(minutes=30)
 _USER_15MIN_TO_END_DELAY = timedelta(minutes=15)
 
+# Reminder times chosen by users are rounded down to slots of a timing wheel which covers a day
+_SLOT_MINUTES = 5
+_WHEEL_SIZE = 24 * 60 // _SLOT_MINUTES
+_SHARED_POLL_INTERVAL = 5  # Seconds between looks into the shared job store for jobs changed by other processes
+
+DEFAULT_TENANT = None  # The tenant of the main dormitory. Its jobs are named as before there were other tenants
+
 _scheduler = None
-_storage = None
+_storage = None  # The storage of DEFAULT_TENANT
 _callback = None
+_trigger_function = None  # The function jobs call: _on_event_trigger or, in the asyncio mode, _on_event_trigger_async
+_shared = False  # Other processes change jobs and chat schedules in the same storage
+_sensors = None
+_sensor_threshold = None
+_now = datetime.now  # Returns the current local time. The simulation replaces it with a virtual clock
+_stopped = threading.Event()
+
+
+# A dormitory served by the scheduler: its storage with its own change, admins and subscribers, and the timing wheel of
+# its chats. Jobs of a tenant are named '<job>:<tenant>', and a tenant without chats with an own schedule keeps only
+# empty dicts, so another dormitory costs little more than its storage
+class _Tenant:
+    __slots__ = ('name', 'storage', 'wheel', 'chat_slots', 'lock')
+
+    def __init__(self, name, storage):
+        self.name = name
+        self.storage = storage
+        # Slot -> set of the chats with an own schedule which get usual reminders in the slot. Only slots with chats are
+        # kept. Chats without an own schedule get reminders in the default slots of the tenant
+        self.wheel = {}
+        self.chat_slots = {}  # Chat id -> frozenset of the slots of the chat in wheel
+        self.lock = threading.Lock()
+
+    def get_job_id(self, job_name):
+        return job_name if self.name is DEFAULT_TENANT else '{}:{}'.format(job_name, self.name)
+
+
+_tenants = {}  # Name -> _Tenant
 
 
 # Returns: (NOTIFY_TYPE, datetime for next alarm)
-def _find_next_time_to_notify_user(cur_datetime, to_datetime):
+def _find_next_time_to_notify_user(cur_datetime, to_datetime, times_to_send=None):
     time_remaining = to_datetime - cur_datetime
     if time_remaining <= _USER_ENDING_ZONE:
         if time_remaining < _USER_15MIN_TO_END_DELAY:
@@ -57,82 +104,268 @@ def _find_next_time_to_notify_user(cur_datetime, to_datetime):
         return USER_NOTIFY_TYPE_1HOUR_TO_END, (to_datetime - _USER_1HOUR_TO_END_DELAY)
 
     moscow_ending_date = to_datetime.astimezone(MOSCOW_TIMEZONE).date()
-    for moscow_send_time in _USER_NOTIFICATION_TIMES_TO_SEND:
+    for moscow_send_time in times_to_send or _USER_NOTIFICATION_TIMES_TO_SEND:
         moscow_send_datetime = MOSCOW_TIMEZONE.localize(datetime.combine(moscow_ending_date, moscow_send_time))
         send_datetime = moscow_send_datetime.astimezone(None)
 
+        if send_datetime.replace(tzinfo=None) >= to_datetime:
+            break
         if send_datetime.replace(tzinfo=None) > cur_datetime:
             return USER_NOTIFY_TYPE_USUAL, send_datetime
 
-    # We shouldn't be here
-    LOG.warning("_find_next_time_to_notify_user didn't find a proper next datetime alarm")
-    LOG.warning("Cur datetime: {}, to datetime: {}".format(cur_datetime, to_datetime))
-    return USER_NOTIFY_TYPE_LAST, to_datetime
+    # No usual time is left before the end, e.g. the times chosen for a dormitory are sparse. Only the alarms before
+    # the end remain
+    return USER_NOTIFY_TYPE_1HOUR_TO_END, (to_datetime - _USER_1HOUR_TO_END_DELAY)
 
 
-def init(storage):
-    global _scheduler, _storage
+# If event_loop is given, jobs are run on that asyncio loop instead of a thread pool. If shared is True, the storage and
+# the job store are shared with other processes: jobs aren't run until run_jobs() is called, and the timing wheel is
+# read from the storage again before use
+def init(storage, event_loop=None, shared=False):
+    global _scheduler, _storage, _trigger_function, _shared, _tenants
     _storage = storage
-    _scheduler = BackgroundScheduler()
-    _scheduler.add_jobstore('sqlalchemy', url=storage.get_scheduler_db_url())
-    _scheduler.start()
-
-
-def init_for_test(storage):
-    global _FIRST_ADMIN_NOTIFICATION_DELAY, _PERIODICAL_ADMIN_NOTIFICATION_DELAY
-    _FIRST_ADMIN_NOTIFICATION_DELAY = timedelta(minutes=2)
-    _PERIODICAL_ADMIN_NOTIFICATION_DELAY = timedelta(minutes=1)
-
-    global _USER_1HOUR_TO_END_DELAY, _USER_15MIN_TO_END_DELAY, _USER_30MIN_TO_END_DELAY, _USER_ENDING_ZONE
-    _USER_1HOUR_TO_END_DELAY = timedelta(seconds=60*3)
-    _USER_30MIN_TO_END_DELAY = timedelta(seconds=60*2)
-    _USER_15MIN_TO_END_DELAY = timedelta(seconds=60)
-    _USER_ENDING_ZONE = timedelta(seconds=60*5)
-
-    global _USER_NOTIFICATION_TIMES_TO_SEND
-    _USER_NOTIFICATION_TIMES_TO_SEND = (
-        time(3, 45),
-        time(3, 47),
-        time(3, 49),
-        time(3, 51),
-        time(3, 53),
-        time(3, 55),
-        time(3, 57),
-        time(3, 59),
-        time(4, 1),
-    )
-
-    init(storage)
+    tenant = _Tenant(DEFAULT_TENANT, storage)
+    _tenants = {DEFAULT_TENANT: tenant}
+    _shared = shared
+    if event_loop is not None:
+        _scheduler = AsyncIOScheduler(event_loop=event_loop)
+        _trigger_function = _on_event_trigger_async
+    else:
+        _scheduler = BackgroundScheduler()
+        _trigger_function = _on_event_trigger
+    _scheduler.add_jobstore(SqliteJobStore(storage.get_scheduler_db_path()))
+    _scheduler.add_listener(_on_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED | EVENT_JOB_ERROR)
+    _scheduler.start(paused=shared)
+
+    _build_wheel(tenant)
+    # Jobs stored by the bot running in the other mode
+    for job in _scheduler.get_jobs():
+        if job.func is not _trigger_function:
+            job.modify(func=_trigger_function)
+    # The change was set by a version of the bot which scheduled alarms one by one
+    if storage.time_next_change is not None and storage.notification_timeline is None:
+        _schedule_notification_timeline(tenant)
+
+
+# The simulation runs jobs with its own job_scheduler at the times of the virtual clock `now`, see simulation.py
+def init_simulation(storage, job_scheduler, now):
+    global _scheduler, _storage, _trigger_function, _shared, _now, _tenants
+    _storage = storage
+    _scheduler = job_scheduler
+    _trigger_function = _on_event_trigger
+    _shared = False
+    _now = now
+    _tenants = {DEFAULT_TENANT: _Tenant(DEFAULT_TENANT, storage)}
+    _build_wheel(_tenants[DEFAULT_TENANT])
+
+
+# Schedules another dormitory named `name` with its own storage. Call it after init() for every dormitory in every
+# process, since jobs of the dormitory may fire in any of them
+def add_tenant(name, storage):
+    tenant = _tenants[name] = _Tenant(name, storage)
+    _build_wheel(tenant)
+
+
+# Starts running jobs of the shared job store in this process. Jobs changed by other processes are noticed within
+# _SHARED_POLL_INTERVAL seconds
+def run_jobs():
+    _scheduler.resume()
+
+    def wake_up_forever():
+        while not _stopped.wait(_SHARED_POLL_INTERVAL):
+            _scheduler.wakeup()
+
+    threading.Thread(target=wake_up_forever, name='scheduler-wakeup', daemon=True).start()
 
 
 def shutdown():
+    _stopped.set()
     if _scheduler is not None:
         _scheduler.shutdown()
 
 
-def _on_event_trigger(job_name, **kwargs):
+def _on_job_event(event):
+    if event.code == EVENT_JOB_SUBMITTED:
+        now = datetime.now(utc)
+        for run_time in event.scheduled_run_times:
+            metrics.JOB_LATENESS_SECONDS.observe((now - run_time).total_seconds(), job=event.job_id)
+    elif event.code == EVENT_JOB_MISSED:
+        metrics.JOB_MISSED.inc(job=event.job_id)
+    else:
+        metrics.JOB_ERRORS.inc(job=event.job_id)
+
+
+def _on_event_trigger(job_name, tenant_name=DEFAULT_TENANT, **kwargs):
+    with metrics.JOB_SECONDS.time(job=job_name):
+        return _run_job(job_name, tenant_name)
+
+
+def _run_job(job_name, tenant_name=DEFAULT_TENANT):
+    if job_name == _JOB_SENSOR_CHECK:
+        return _check_sensors()
+    tenant = _tenants.get(tenant_name)
+    if tenant is None:
+        LOG.warning("Job {} of unknown dormitory {} is skipped".format(job_name, tenant_name))
+        return None
+    storage = tenant.storage
     if job_name == _JOB_ADMIN_NOTIFIER:
-        _callback.on_admin_remind()
+        return _callback.on_admin_remind(tenant=tenant.name)
     elif job_name == _JOB_USER_NOTIFIER:
-        #is_last_call = _scheduler.get_job(job_name) is None  # Job is deleted from scheduler if it's the last call
-        #_callback.on_user_notification(kwargs['is_first'], is_last_call)
-        #if kwargs['is_first']:
-        #    kwargs['is_first'] = False
-        #    _scheduler.modify_job(job_name, kwargs=kwargs)
-        #if is_last_call:
-        #    # Reset time_next_change in storage
-        #    clear_time_next_change()
-
-        alarm_type = kwargs['type']
-        next_alarm_datetime = None
-
-        if type == USER_NOTIFY_TYPE_LAST:
-            clear_time_next_change()
+        timeline = storage.notification_timeline
+        if timeline is None:
+            return None
+
+        # Normally the alarm at notification_index fires, but alarms missed while the bot was down are skipped
+        is_first_alarm = storage.notification_index == 0
+        index = storage.notification_index
+        now = _now().timestamp()
+        while index + 1 < len(timeline) and timeline[index + 1][1] <= now:
+            index += 1
+        index = min(index, len(timeline) - 1)
+        alarm_type = timeline[index][0]
+        next_alarm_datetime = datetime.fromtimestamp(timeline[index + 1][1]) if index + 1 < len(timeline) else None
+
+        _refresh_wheel(tenant)
+        if is_first_alarm:
+            # A new campaign: everybody has to change linen
+            storage.reset_chats_to_notify()
+            storage.save()
+        recipients = _get_recipients(tenant, timeline, index)
+
+        if alarm_type == USER_NOTIFY_TYPE_LAST:
+            clear_time_next_change(tenant.name)
         else:
-            params = _set_next_user_notification_job(False)
-            next_alarm_datetime = params[1]
+            storage.notification_index = index + 1
+            storage.save()
+
+        alarm_datetime = datetime.fromtimestamp(timeline[index][1])
+        return _callback.on_user_notification(alarm_type, next_alarm_datetime, is_first_alarm, alarm_datetime,
+                                              recipients, tenant=tenant.name)
+
+
+def _time_to_slot(minute_of_day):
+    return minute_of_day // _SLOT_MINUTES % _WHEEL_SIZE
+
+
+def _slot_to_time(slot):
+    minutes = slot * _SLOT_MINUTES
+    return time(minutes // 60, minutes % 60)
+
+
+def _timestamp_to_slot(timestamp):
+    moscow_datetime = datetime.fromtimestamp(timestamp, MOSCOW_TIMEZONE)
+    return _time_to_slot(moscow_datetime.hour * 60 + moscow_datetime.minute)
+
+
+# Returns the minutes of day of usual reminders of the chats of the tenant which haven't chosen their own times
+def _get_default_minutes(tenant):
+    default_times = tenant.storage.default_times
+    if default_times is not None:
+        return default_times
+    return [t.hour * 60 + t.minute for t in _USER_NOTIFICATION_TIMES_TO_SEND]
+
 
-        _callback.on_user_notification(alarm_type, next_alarm_datetime, kwargs['is_first'])
+def _get_default_slots(tenant):
+    return frozenset(_time_to_slot(minute) for minute in _get_default_minutes(tenant))
+
+
+def _is_quiet(minute_of_day, quiet_hours):
+    quiet_from, quiet_to = quiet_hours
+    if quiet_from <= quiet_to:
+        return quiet_from <= minute_of_day < quiet_to
+    return minute_of_day >= quiet_from or minute_of_day < quiet_to  # Quiet hours span midnight
+
+
+# Returns the slots in which a chat with the schedule gets usual reminders
+def _get_schedule_slots(schedule, default_minutes):
+    minutes = schedule['times'] if schedule.get('times') is not None else default_minutes
+    quiet_hours = schedule.get('quiet')
+    return frozenset(_time_to_slot(minute) for minute in minutes
+                     if quiet_hours is None or not _is_quiet(minute, quiet_hours))
+
+
+def _put_chat_on_wheel(tenant, chat_id, schedule, default_minutes):
+    with tenant.lock:
+        for slot in tenant.chat_slots.pop(chat_id, ()):
+            chats = tenant.wheel[slot]
+            chats.discard(chat_id)
+            if not chats:
+                del tenant.wheel[slot]
+        if schedule is not None:
+            slots = tenant.chat_slots[chat_id] = _get_schedule_slots(schedule, default_minutes)
+            for slot in slots:
+                tenant.wheel.setdefault(slot, set()).add(chat_id)
+
+
+def _build_wheel(tenant):
+    with tenant.lock:
+        tenant.wheel = {}
+        tenant.chat_slots = {}
+    default_minutes = _get_default_minutes(tenant)
+    for chat_id, schedule in tenant.storage.get_chat_schedules().items():
+        _put_chat_on_wheel(tenant, chat_id, schedule, default_minutes)
+
+
+# Other processes may have changed chat schedules
+def _refresh_wheel(tenant):
+    if _shared:
+        _build_wheel(tenant)
+
+
+# Returns the slots in which somebody gets usual reminders
+def _get_occupied_slots(tenant):
+    default_slots = _get_default_slots(tenant)
+    with tenant.lock:
+        return default_slots.union(tenant.wheel)
+
+
+# Returns the times of all slots in which somebody gets usual reminders
+def _get_times_to_send(tenant):
+    _refresh_wheel(tenant)
+    return [_slot_to_time(slot) for slot in sorted(_get_occupied_slots(tenant))]
+
+
+# Returns [(chat_id, datetime of the next alarm of the chat or None)] of the chats which get the alarm at `index`. A usual
+# alarm goes only to the chats of its slot, so its cost depends on the size of the slot
+def _get_recipients(tenant, timeline, index):
+    storage = tenant.storage
+    default_slots = _get_default_slots(tenant)
+    alarm_type, timestamp = timeline[index]
+    if alarm_type != USER_NOTIFY_TYPE_USUAL:
+        chat_ids = storage.chats_to_notify.copy()
+    else:
+        slot = _timestamp_to_slot(timestamp)
+        with tenant.lock:
+            bucket = list(tenant.wheel.get(slot, ()))
+        chat_ids = storage.filter_chats_to_notify(bucket)
+        if slot in default_slots:
+            chat_ids.extend(chat_id for chat_id in storage.chats_to_notify if chat_id not in tenant.chat_slots)
+
+    # Chats with the same slots have the same next alarm
+    next_alarms = {}
+    recipients = []
+    for chat_id in chat_ids:
+        slots = tenant.chat_slots.get(chat_id, default_slots)
+        if slots not in next_alarms:
+            next_alarms[slots] = _get_next_alarm(timeline, index, slots)
+        recipients.append((chat_id, next_alarms[slots]))
+    return recipients
+
+
+def _get_next_alarm(timeline, index, slots):
+    for alarm_type, timestamp in timeline[index + 1:]:
+        if alarm_type != USER_NOTIFY_TYPE_USUAL or _timestamp_to_slot(timestamp) in slots:
+            return datetime.fromtimestamp(timestamp)
+    return None
+
+
+# Callbacks may return an awaitable in the asyncio mode, e.g. a broadcast which is still in progress. Jobs write the
+# storage, so they run in a thread and only the awaitable is run on the loop
+async def _on_event_trigger_async(job_name, tenant_name=DEFAULT_TENANT, **kwargs):
+    with metrics.JOB_SECONDS.time(job=job_name):
+        result = await asyncio.get_running_loop().run_in_executor(None, _run_job, job_name, tenant_name)
+        if inspect.isawaitable(result):
+            await result
 
 
 def set_callback(callback):
@@ -140,67 +373,242 @@ def set_callback(callback):
     _callback = callback
 
 
-def _set_job(job_name, *args, **kwargs):
-    if _scheduler.get_job(job_name) is not None:
-        _scheduler.remove_job(job_name)
-
+# Jobs of a tenant get its name as an argument
+def _set_job(job_name, *args, tenant=None, **kwargs):
     job_args = [job_name]
+    if tenant is not None and tenant.name is not DEFAULT_TENANT:
+        job_args.append(tenant.name)
     job_args.extend(kwargs['args'] if 'args' in kwargs else [])
     kwargs['args'] = job_args
-    kwargs['id'] = job_name
-    _scheduler.add_job(_on_event_trigger, *args, **kwargs)
+    kwargs['id'] = tenant.get_job_id(job_name) if tenant is not None else job_name
+    _scheduler.add_job(_trigger_function, *args, replace_existing=True, **kwargs)
+
+
+# Returns the ordered list of all alarms of the change: [[NOTIFY_TYPE, timestamp], ...]
+def _build_notification_timeline(tenant, time_next_change):
+    to_datetime = datetime.fromtimestamp(time_next_change[1])
+    # Вычитаем секунду, так как _find_next_time_to_notify_user сравнивает строгим порядком
+    cur_datetime = max(_now(), datetime.fromtimestamp(time_next_change[0]) - timedelta(seconds=1))
+    times_to_send = _get_times_to_send(tenant)
+    timeline = []
+    while True:
+        alarm_type, alarm_datetime = _find_next_time_to_notify_user(cur_datetime, to_datetime, times_to_send)
+        timeline.append([alarm_type, alarm_datetime.timestamp()])
+        if alarm_type == USER_NOTIFY_TYPE_LAST:
+            return timeline
+        # Continue as if the alarm has just fired
+        cur_datetime = datetime.fromtimestamp(alarm_datetime.timestamp()) + timedelta(seconds=1)
+
+
+# Fires at every time of the notification timeline. One job serves the whole change day, so nothing is recomputed and
+# no job is re-added between alarms
+class _TimelineTrigger(BaseTrigger):
+    def __init__(self, timestamps):
+        self.timestamps = timestamps
+        self._set_fire_times()
+
+    # Fire times are compared as datetimes: previous_fire_time is rounded to microseconds, so a float timestamp may be
+    # a bit greater than the datetime made of it, and the same time would be returned again
+    def _set_fire_times(self):
+        self._fire_times = [datetime.fromtimestamp(timestamp, utc) for timestamp in self.timestamps]
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        for fire_time in self._fire_times:
+            if previous_fire_time is None or fire_time > previous_fire_time:
+                return fire_time
+        return None
+
+    def __getstate__(self):
+        return {'version': 1, 'timestamps': self.timestamps}
+
+    def __setstate__(self, state):
+        self.timestamps = state['timestamps']
+        self._set_fire_times()
+
+    def __str__(self):
+        return 'timeline[{} alarms]'.format(len(self.timestamps))
+
+
+def _schedule_notification_timeline(tenant):
+    storage = tenant.storage
+    storage.notification_timeline = _build_notification_timeline(tenant, storage.time_next_change)
+    storage.notification_index = 0
+    storage.save()
+    _set_job(_JOB_USER_NOTIFIER, _TimelineTrigger([alarm[1] for alarm in storage.notification_timeline]),
+             tenant=tenant)
+
+
+# Rebuilds the alarms which haven't fired yet, e.g. after a chat has chosen new reminder times. Fired alarms are kept,
+# so the campaign goes on
+def _reschedule_remaining_alarms(tenant):
+    storage = tenant.storage
+    fired_alarms = storage.notification_timeline[:storage.notification_index]
+    last_fired_timestamp = fired_alarms[-1][1] if fired_alarms else 0
+    remaining_alarms = [alarm for alarm in _build_notification_timeline(tenant, storage.time_next_change)
+                        if alarm[1] > last_fired_timestamp]
+    storage.notification_timeline = fired_alarms + remaining_alarms
+    storage.save()
+    _set_job(_JOB_USER_NOTIFIER, _TimelineTrigger([alarm[1] for alarm in remaining_alarms]), tenant=tenant)
+
+
+def _reschedule_if_needed(tenant):
+    if tenant.storage.time_next_change is not None and tenant.storage.notification_timeline is not None:
+        _reschedule_remaining_alarms(tenant)
+
+
+# The timeline has an alarm in every occupied slot, so it is rebuilt only when the chat comes to an empty slot or leaves
+# the last one. Quiet hours and times in slots of other chats only change the recipients of the alarms
+def _update_chat_schedule(tenant, chat_id, **changes):
+    storage = tenant.storage
+    schedule = dict(storage.get_chat_schedule(chat_id) or {}, **changes)
+    if all(value is None for value in schedule.values()):
+        schedule = None
+    _refresh_wheel(tenant)
+    occupied_slots = _get_occupied_slots(tenant)
+    storage.set_chat_schedule(chat_id, schedule)
+    storage.save()
+    _put_chat_on_wheel(tenant, chat_id, schedule, _get_default_minutes(tenant))
+    if _get_occupied_slots(tenant) != occupied_slots:
+        _reschedule_if_needed(tenant)
+
+
+def _to_minutes(times):
+    return sorted({t.hour * 60 + t.minute for t in times})
+
+
+# `times` is a list of datetime.time in Moscow time, None restores the default times
+def set_chat_reminder_times(chat_id, times, tenant=DEFAULT_TENANT):
+    _update_chat_schedule(_tenants[tenant], chat_id, times=_to_minutes(times) if times is not None else None)
+
+
+# `quiet_hours` is a pair of datetime.time (from, to) in Moscow time, None turns quiet hours off
+def set_chat_quiet_hours(chat_id, quiet_hours, tenant=DEFAULT_TENANT):
+    _update_chat_schedule(_tenants[tenant], chat_id, quiet=[t.hour * 60 + t.minute for t in quiet_hours]
+                          if quiet_hours is not None else None)
+
+
+# Returns the sorted list of times (datetime.time, Moscow time) when the chat gets usual reminders
+def get_chat_reminder_times(chat_id, tenant=DEFAULT_TENANT):
+    tenant = _tenants[tenant]
+    schedule = tenant.storage.get_chat_schedule(chat_id)
+    slots = _get_schedule_slots(schedule, _get_default_minutes(tenant)) if schedule is not None \
+        else _get_default_slots(tenant)
+    return [_slot_to_time(slot) for slot in sorted(slots)]
+
+
+# Moves the reminder times and quiet hours of the chat to another tenant when the chat moves to another dormitory
+def move_chat_schedule(chat_id, from_tenant, to_tenant):
+    schedule = _tenants[from_tenant].storage.get_chat_schedule(chat_id)
+    if schedule is not None:
+        _update_chat_schedule(_tenants[from_tenant], chat_id, **{name: None for name in schedule})
+        _update_chat_schedule(_tenants[to_tenant], chat_id, **schedule)
+
+
+# `times` is a list of datetime.time in Moscow time when chats of the tenant without their own times get usual
+# reminders, None restores _USER_NOTIFICATION_TIMES_TO_SEND
+def set_default_reminder_times(times, tenant=DEFAULT_TENANT):
+    tenant = _tenants[tenant]
+    tenant.storage.default_times = _to_minutes(times) if times is not None else None
+    tenant.storage.save()
+    _build_wheel(tenant)  # Chats with quiet hours but without their own times get the default times
+    _reschedule_if_needed(tenant)
+
+
+def get_default_reminder_times(tenant=DEFAULT_TENANT):
+    return [_slot_to_time(slot) for slot in sorted(_get_default_slots(_tenants[tenant]))]
+
+
+# Checks the slum indexes of the rooms of `sensors` every minute and calls on_sensor_alerts when some of them cross the
+# threshold
+def watch_sensors(sensors, threshold):
+    global _sensors, _sensor_threshold
+    _sensors = sensors
+    _sensor_threshold = threshold
+    _set_job(_JOB_SENSOR_CHECK, 'interval', seconds=_SENSOR_CHECK_INTERVAL.total_seconds())
 
 
-def _set_next_user_notification_job(is_first_alarm):
-    start_alarms_datetime = datetime.fromtimestamp(_storage.time_next_change[0])
-    hacked_current_time = max(datetime.now(), start_alarms_datetime - timedelta(seconds=1))  # Вычитаем секунду, так как
-    # _find_next_time_to_notify_user сравнивает строгим порядком
+# Removes the job of watch_sensors, which stays in the job store when the bot is started again without sensors
+def unwatch_sensors():
+    try:
+        _scheduler.remove_job(_JOB_SENSOR_CHECK)
+    except JobLookupError:
+        pass
+
 
-    next_notify_params = _find_next_time_to_notify_user(hacked_current_time,
-                                                        datetime.fromtimestamp(_storage.time_next_change[1]))
-    _set_job(_JOB_USER_NOTIFIER, 'date', run_date=next_notify_params[1], kwargs={'type': next_notify_params[0],
-                                                                                 'is_first': is_first_alarm})
-    return next_notify_params
+def _check_sensors():
+    if _sensors is None:
+        return None
+    changes = _sensors.check(_sensor_threshold, _now().timestamp())
+    if not changes:
+        return None
+    room_chats = _storage.get_room_chats(room for room, index, raised in changes)
+    return _callback.on_sensor_alerts([(room, index, raised, room_chats.get(room, []))
+                                       for room, index, raised in changes])
 
 
-def clear_time_next_change():
-    if _scheduler.get_job(_JOB_USER_NOTIFIER) is not None:
-        _scheduler.remove_job(_JOB_USER_NOTIFIER)
-    _storage.time_next_change = None
-    _storage.save()
+# Returns [[NOTIFY_TYPE, timestamp], ...] of the alarms which haven't fired yet
+def get_remaining_alarms(tenant=DEFAULT_TENANT):
+    storage = _tenants[tenant].storage
+    timeline = storage.notification_timeline
+    return timeline[storage.notification_index:] if timeline is not None else []
 
 
-def update_admin_notification_time(notify_time):
+def clear_time_next_change(tenant=DEFAULT_TENANT):
+    tenant = _tenants[tenant]
+    # Called from the LAST alarm too, whose job APScheduler may remove while it runs
+    try:
+        _scheduler.remove_job(tenant.get_job_id(_JOB_USER_NOTIFIER))
+    except JobLookupError:
+        pass
+    tenant.storage.time_next_change = None
+    tenant.storage.notification_timeline = None
+    tenant.storage.notification_index = 0
+    tenant.storage.save()
+
+
+def update_admin_notification_time(notify_time, tenant=DEFAULT_TENANT):
+    tenant = _tenants[tenant]
     if type(notify_time) is float:
         # It's timestamp
         notify_time = datetime.fromtimestamp(notify_time)
 
     _set_job(_JOB_ADMIN_NOTIFIER, 'interval', seconds=_PERIODICAL_ADMIN_NOTIFICATION_DELAY.total_seconds(),
-             start_date=notify_time)
-    _storage.next_admin_notification_time = notify_time.timestamp()
-    _storage.save()
+             start_date=notify_time, tenant=tenant)
+    tenant.storage.next_admin_notification_time = notify_time.timestamp()
+    tenant.storage.save()
 
 
 # Returns datetime of first alarm
-def update_time_of_next_change(time_next_change):
+def update_time_of_next_change(time_next_change, tenant=DEFAULT_TENANT):
     # First set new admin notification date
     user_alarm_datetime = datetime.fromtimestamp(time_next_change[0])
     admin_alarm_datetime = user_alarm_datetime + _FIRST_ADMIN_NOTIFICATION_DELAY
-    update_admin_notification_time(admin_alarm_datetime)
+    update_admin_notification_time(admin_alarm_datetime, tenant)
 
     # Now save the storage
-    _storage.time_next_change = time_next_change
-    _storage.save()
+    tenant = _tenants[tenant]
+    tenant.storage.time_next_change = time_next_change
+    tenant.storage.save()
 
     # Set user job
-    notif_params = _set_next_user_notification_job(True)
+    _schedule_notification_timeline(tenant)
 
-    return notif_params[1]
+    return datetime.fromtimestamp(tenant.storage.notification_timeline[0][1])
 
 
+# `tenant` is the name of the dormitory of the event, DEFAULT_TENANT for the main one
 class Callback:
-    def on_admin_remind(self):
+    def on_admin_remind(self, tenant=DEFAULT_TENANT):
+        pass
+
+    # alarm_datetime is the planned time of the alarm. It identifies the alarm even if it fires late or twice.
+    # recipients is [(chat_id, datetime of the next alarm of the chat or None)]: a usual alarm goes only to the chats
+    # which want a reminder at its time
+    def on_user_notification(self, alarm_type, next_alarm_datetime, is_first_alarm, alarm_datetime, recipients,
+                             tenant=DEFAULT_TENANT):
         pass
 
-    def on_user_notification(self, alarm_type, next_alarm_datetime, is_first_alarm):
+    # alerts is [(room, slum index, True if the index has reached the threshold or False if it is back to normal,
+    # [chat_id] of the chats which have chosen the room)]
+    def on_sensor_alerts(self, alerts):
         pass
@@ -0,0 +1,306 @@
+import logging
+import math
+import socket
+import threading
+import time
+import numpy as np
+from slumometer import metrics
+
+LOG = logging.getLogger("slumometer.sensors")
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.INFO)
+
+# Rooms send readings of temperature (°C), relative humidity (%) and CO2 concentration (ppm) and get a slum index from
+# 0 (comfortable) to 100 (a slum). Readings come as UDP datagrams of one or more lines:
+#
+#     <room> <temperature> <humidity> <co2> [unix time]
+#
+# The time of arrival is used if the time is not given.
+
+READING_SIZE = 3  # temperature, humidity, co2
+MAX_ROOMS = 1024
+MAX_ROOM_NAME = 32
+RAW_CAPACITY = 256  # Last raw readings kept for every room
+MINUTE_CAPACITY = 24 * 60  # 1-minute rollups of a day
+HOUR_CAPACITY = 7 * 24  # 1-hour rollups of a week
+DEFAULT_WINDOW = 15  # Minutes whose rollups make the current index of a room
+DEFAULT_THRESHOLD = 60.0
+_HYSTERESIS = 10.0  # An alert of a room is cleared when its index falls this much below the threshold
+_DAY_HOURS = 24
+_MAX_DATAGRAM_SIZE = 65535
+_RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024  # Datagrams wait there while readings are added. The kernel may cap the size
+
+# Comfortable ranges of the readings and the distances out of them at which a part of the index reaches its maximum.
+# The parts are weighted, CO2 matters most
+_COMFORT_LOW = np.array([20.0, 40.0, 0.0])
+_COMFORT_HIGH = np.array([24.0, 60.0, 800.0])
+_WORST_DISTANCE = np.array([8.0, 30.0, 1200.0])
+_WEIGHTS = np.array([0.3, 0.2, 0.5])
+
+
+# Returns the slum index of every reading of `readings`, an array of shape (..., READING_SIZE). The result has the shape
+# (...) and NaN where a reading is NaN
+def slum_index(readings):
+    readings = np.asarray(readings, dtype=float)
+    distance = np.maximum(_COMFORT_LOW - readings, 0) + np.maximum(readings - _COMFORT_HIGH, 0)
+    return 100 * np.minimum(distance / _WORST_DISTANCE, 1) @ _WEIGHTS
+
+
+# Sums of the readings of the period (a minute or an hour) which is not over yet
+class _OpenRollup:
+    __slots__ = ('period', 'sums', 'count')
+
+    def __init__(self):
+        self.period = None
+        self.sums = [0.0] * READING_SIZE
+        self.count = 0
+
+    def add(self, values):
+        sums = self.sums
+        for i in range(READING_SIZE):
+            sums[i] += values[i]
+        self.count += 1
+
+    def reset(self, period):
+        self.period = period
+        self.sums = [0.0] * READING_SIZE
+        self.count = 0
+
+
+# Readings of all rooms in fixed-size arrays. Raw readings of a room are a ring buffer of RAW_CAPACITY entries. A reading
+# is also summed into the open minute of its room; when the minute is over, its mean is written to the ring of 1-minute
+# rollups at the column minute % MINUTE_CAPACITY, and it is summed into the open hour, which goes to the ring of 1-hour
+# rollups in the same way. Columns are aligned by time for all rooms, so the indexes of a window are computed for every
+# room at once. A reading which comes late, after a newer minute of its room was opened, counts in the open minute
+class Sensors:
+    def __init__(self, max_rooms=MAX_ROOMS):
+        self.max_rooms = max_rooms
+        self._lock = threading.Lock()
+        self._rooms = {}  # Room -> index in the arrays
+        self._names = []
+        self._open_minutes = []
+        self._open_hours = []
+        self._raw_next = []  # Position of the next raw reading of every room
+        self._capacity = 0
+        self._raw_times = np.empty((0, RAW_CAPACITY))
+        self._raw_values = np.empty((0, RAW_CAPACITY, READING_SIZE), dtype=np.float32)
+        self._minutes = np.empty((0, MINUTE_CAPACITY, READING_SIZE), dtype=np.float32)
+        self._minute_stamps = np.empty((0, MINUTE_CAPACITY), dtype=np.int64)  # The minute of every column, -1 if none
+        self._hours = np.empty((0, HOUR_CAPACITY, READING_SIZE), dtype=np.float32)
+        self._hour_stamps = np.empty((0, HOUR_CAPACITY), dtype=np.int64)
+        self._alerted = np.empty(0, dtype=bool)
+        self._socket = None
+
+    # Room names are short and can be printed in Markdown as is, e.g. 512 or 3-14
+    @staticmethod
+    def is_valid_room(room):
+        return 0 < len(room) <= MAX_ROOM_NAME and all(char.isalnum() or char in '-.' for char in room)
+
+    # Arrays grow twice when they are full, so memory is taken only for rooms which send readings
+    def _grow(self):
+        capacity = min(self.max_rooms, max(16, 2 * self._capacity))
+
+        def grown(array, fill):
+            result = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            result[:self._capacity] = array
+            return result
+
+        self._raw_times = grown(self._raw_times, np.nan)
+        self._raw_values = grown(self._raw_values, np.nan)
+        self._minutes = grown(self._minutes, np.nan)
+        self._minute_stamps = grown(self._minute_stamps, -1)
+        self._hours = grown(self._hours, np.nan)
+        self._hour_stamps = grown(self._hour_stamps, -1)
+        self._alerted = grown(self._alerted, False)
+        self._capacity = capacity
+
+    # Returns the index of the room or None if there are too many rooms
+    def _get_room(self, room):
+        index = self._rooms.get(room)
+        if index is not None:
+            return index
+        if len(self._names) == self.max_rooms:
+            return None
+        if len(self._names) == self._capacity:
+            self._grow()
+        index = self._rooms[room] = len(self._names)
+        self._names.append(room)
+        self._open_minutes.append(_OpenRollup())
+        self._open_hours.append(_OpenRollup())
+        self._raw_next.append(0)
+        return index
+
+    def _close_minute(self, index, rollup):
+        minute = rollup.period
+        means = [value / rollup.count for value in rollup.sums]
+        column = minute % MINUTE_CAPACITY
+        self._minutes[index, column] = means
+        self._minute_stamps[index, column] = minute
+
+        hour = minute // 60
+        hour_rollup = self._open_hours[index]
+        if hour_rollup.period != hour:
+            if hour_rollup.count:
+                self._close_hour(index, hour_rollup)
+            hour_rollup.reset(hour)
+        hour_rollup.add(means)
+
+    def _close_hour(self, index, rollup):
+        column = rollup.period % HOUR_CAPACITY
+        self._hours[index, column] = [value / rollup.count for value in rollup.sums]
+        self._hour_stamps[index, column] = rollup.period
+
+    # Closes the minutes and hours which are over by `timestamp` although their rooms have sent nothing since
+    def _close_stale(self, timestamp):
+        minute = int(timestamp // 60)
+        for index, rollup in enumerate(self._open_minutes):
+            if rollup.count and rollup.period < minute:
+                self._close_minute(index, rollup)
+                rollup.reset(None)
+            hour_rollup = self._open_hours[index]
+            if hour_rollup.count and hour_rollup.period < minute // 60:
+                self._close_hour(index, hour_rollup)
+                hour_rollup.reset(None)
+
+    def _add(self, room, values, timestamp):
+        index = self._get_room(room)
+        if index is None:
+            return False
+        position = self._raw_next[index]
+        self._raw_times[index, position] = timestamp
+        self._raw_values[index, position] = values
+        self._raw_next[index] = (position + 1) % RAW_CAPACITY
+
+        minute = int(timestamp // 60)
+        rollup = self._open_minutes[index]
+        if rollup.period is None or minute > rollup.period:
+            if rollup.count:
+                self._close_minute(index, rollup)
+            rollup.reset(minute)
+        rollup.add(values)
+        return True
+
+    # Returns False if the reading is rejected
+    def add_reading(self, room, temperature, humidity, co2, timestamp=None):
+        with self._lock:
+            return self._add(room, (temperature, humidity, co2), timestamp if timestamp is not None else time.time())
+
+    # Adds the readings of a datagram. Returns (accepted, rejected) numbers of lines
+    def add_datagram(self, data):
+        now = time.time()
+        accepted = rejected = 0
+        with self._lock:
+            for line in data.decode('utf-8', 'replace').splitlines():
+                reading = _parse_line(line, now)
+                if reading is None:
+                    if line.strip():
+                        rejected += 1
+                elif self._add(*reading):
+                    accepted += 1
+                else:
+                    rejected += 1
+        metrics.SENSOR_READINGS.inc(accepted, result='accepted')
+        if rejected:
+            metrics.SENSOR_READINGS.inc(rejected, result='rejected')
+        return accepted, rejected
+
+    # Returns the indexes of all rooms over the `window` minutes before `timestamp`, NaN for rooms without rollups there
+    def _window_indexes(self, timestamp, window):
+        count = len(self._names)
+        minute = int(timestamp // 60)
+        expected_minutes = np.arange(minute - window, minute)
+        columns = expected_minutes % MINUTE_CAPACITY
+        valid = self._minute_stamps[:count][:, columns] == expected_minutes
+        scores = np.where(valid, slum_index(self._minutes[:count][:, columns]), 0)
+        counts = valid.sum(axis=1)
+        return np.divide(scores.sum(axis=1), counts, out=np.full(count, np.nan), where=counts > 0)
+
+    # Returns (index over the last `window` minutes, index over the last day) of the room. Either is None if the room has
+    # no readings then
+    def get_room_indexes(self, room, timestamp=None, window=DEFAULT_WINDOW):
+        timestamp = timestamp if timestamp is not None else time.time()
+        with self._lock:
+            index = self._rooms.get(room)
+            if index is None:
+                return None, None
+            self._close_stale(timestamp)
+            current = self._window_indexes(timestamp, window)[index]
+            hour = int(timestamp // 3600)
+            expected_hours = np.arange(hour - _DAY_HOURS, hour)
+            columns = expected_hours % HOUR_CAPACITY
+            valid = self._hour_stamps[index, columns] == expected_hours
+            day = slum_index(self._hours[index, columns[valid]]).mean() if valid.any() else None
+        return (float(current) if not math.isnan(current) else None), (float(day) if day is not None else None)
+
+    # Returns (timestamp, temperature, humidity, co2) of the last reading of the room or None
+    def get_last_reading(self, room):
+        with self._lock:
+            index = self._rooms.get(room)
+            if index is None:
+                return None
+            position = (self._raw_next[index] - 1) % RAW_CAPACITY
+            return (float(self._raw_times[index, position]),) + tuple(float(value) for value in
+                                                                       self._raw_values[index, position])
+
+    # Compares the current index of every room with the threshold. An alert of a room is raised when its index reaches
+    # the threshold and cleared when the index falls below threshold - _HYSTERESIS, so an index near the threshold
+    # doesn't raise an alert every minute. Returns [(room, index, True if raised, False if cleared)]
+    def check(self, threshold=DEFAULT_THRESHOLD, timestamp=None, window=DEFAULT_WINDOW):
+        timestamp = timestamp if timestamp is not None else time.time()
+        with self._lock:
+            self._close_stale(timestamp)
+            count = len(self._names)
+            indexes = self._window_indexes(timestamp, window)
+            alerted = self._alerted[:count]
+            raised = ~alerted & (indexes >= threshold)
+            cleared = alerted & (indexes < threshold - _HYSTERESIS)
+            alerted[raised] = True
+            alerted[cleared] = False
+            changes = [(self._names[index], float(indexes[index]), bool(raised[index]))
+                       for index in np.flatnonzero(raised | cleared)]
+        if changes:
+            metrics.SENSOR_ALERTS.inc(sum(1 for change in changes if change[2]))
+        return changes
+
+    # Receives readings on the UDP port in a thread
+    def listen(self, host, port):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _RECEIVE_BUFFER_SIZE)
+        self._socket.bind((host, port))
+        threading.Thread(target=self._receive_forever, args=(self._socket,), name='sensor-server', daemon=True).start()
+        LOG.info('Listening for sensor readings on UDP port {}'.format(self._socket.getsockname()[1]))
+
+    @property
+    def port(self):
+        return self._socket.getsockname()[1] if self._socket is not None else None
+
+    def _receive_forever(self, sock):
+        while True:
+            try:
+                data = sock.recv(_MAX_DATAGRAM_SIZE)
+            except OSError:
+                return  # The socket is closed
+            try:
+                self.add_datagram(data)
+            except Exception:
+                LOG.exception("Failed to add sensor readings")
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+# Returns (room, values, timestamp) or None if the line is not a valid reading
+def _parse_line(line, now):
+    fields = line.split()
+    if len(fields) not in (4, 5) or not Sensors.is_valid_room(fields[0]):
+        return None
+    try:
+        values = tuple(float(field) for field in fields[1:4])
+        timestamp = float(fields[4]) if len(fields) == 5 else now
+    except ValueError:
+        return None
+    if not all(math.isfinite(value) for value in values) or not math.isfinite(timestamp):
+        return None
+    return fields[0], values, timestamp
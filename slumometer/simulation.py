@@ -0,0 +1,186 @@
+import heapq
+import random
+import time
+from datetime import datetime, timedelta
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.triggers.interval import IntervalTrigger
+from pytz import utc
+from common import MOSCOW_TIMEZONE
+from slumometer import scheduler
+from slumometer.storage import Storage
+
+# Deterministic simulation of a linen change. The real scheduler runs on a virtual clock: jobs fire at the planned
+# virtual times, simulated chats get reminders and answer /linen_changed, and a whole change day takes seconds
+
+
+class VirtualClock:
+    def __init__(self, start):
+        self._now = start  # Naive local time like datetime.now()
+
+    def now(self):
+        return self._now
+
+    def set(self, now):
+        if now > self._now:
+            self._now = now
+
+
+# A stored job of VirtualScheduler. next_run_time is an aware datetime in UTC or None if the job won't fire again
+class _VirtualJob:
+    def __init__(self, job_id, func, args, trigger, next_run_time):
+        self.id = job_id
+        self.func = func
+        self.args = args
+        self.trigger = trigger
+        self.next_run_time = next_run_time
+
+    def modify(self, **changes):
+        for name, value in changes.items():
+            setattr(self, name, value)
+
+
+# Keeps the jobs of the scheduler module instead of APScheduler and runs them on the virtual clock. The triggers are the
+# same, so jobs fire at the same times as in the bot
+class VirtualScheduler:
+    def __init__(self, clock):
+        self._clock = clock
+        self._jobs = {}
+
+    def _utc_now(self):
+        return self._clock.now().astimezone(utc)
+
+    def add_job(self, func, trigger, args=(), id=None, replace_existing=False, **trigger_args):
+        if trigger == 'interval':
+            if isinstance(trigger_args.get('start_date'), datetime):
+                trigger_args['start_date'] = trigger_args['start_date'].astimezone(utc)
+            trigger = IntervalTrigger(timezone=utc, **trigger_args)
+        if id in self._jobs and not replace_existing:
+            raise ValueError('Job {} already exists'.format(id))
+        self._jobs[id] = _VirtualJob(id, func, tuple(args), trigger, trigger.get_next_fire_time(None, self._utc_now()))
+        return self._jobs[id]
+
+    def get_job(self, job_id):
+        return self._jobs.get(job_id)
+
+    def get_jobs(self):
+        return list(self._jobs.values())
+
+    def remove_job(self, job_id):
+        if self._jobs.pop(job_id, None) is None:
+            raise JobLookupError(job_id)
+
+    def shutdown(self):
+        self._jobs.clear()
+
+    # Returns the job which fires next or None
+    def next_job(self):
+        jobs = [job for job in self._jobs.values() if job.next_run_time is not None]
+        return min(jobs, key=lambda job: job.next_run_time) if jobs else None
+
+    # Moves the clock to the time of the job and runs it. As in APScheduler, the next run time is computed before the
+    # job runs, so the job may replace or remove itself
+    def run_job(self, job):
+        run_time = job.next_run_time
+        self._clock.set(datetime.fromtimestamp(run_time.timestamp()))
+        job.next_run_time = job.trigger.get_next_fire_time(run_time, self._utc_now())
+        return job.func(*job.args)
+
+
+# Keeps everything in memory: a simulation doesn't touch the data of the bot
+class _MemoryStorage(Storage):
+    def save(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Callback(scheduler.Callback):
+    def __init__(self, simulation):
+        self._simulation = simulation
+
+    def on_admin_remind(self, tenant=scheduler.DEFAULT_TENANT):
+        self._simulation.admin_reminders += 1
+
+    def on_user_notification(self, alarm_type, next_alarm_datetime, is_first_alarm, alarm_datetime, recipients,
+                             tenant=scheduler.DEFAULT_TENANT):
+        self._simulation.on_alarm(alarm_type, alarm_datetime, recipients)
+
+
+# Simulates `chats` subscribed chats. After every reminder a chat which hasn't changed linen yet answers /linen_changed
+# with the probability reply_rate, within reply_delay. custom_times_rate of chats choose their own reminder times among
+# custom_times. The same seed gives the same result
+class Simulation:
+    def __init__(self, chats, reply_rate=0.3, reply_delay=timedelta(minutes=30), custom_times_rate=0.0,
+                 custom_times=(), seed=0, start=None):
+        self.clock = VirtualClock(start or datetime.now().replace(second=0, microsecond=0))
+        self.storage = _MemoryStorage()
+        self.storage.subscribed_chats = list(range(1, chats + 1))
+        self.storage.chats_to_notify = []
+        self.storage.admin_chats = [0]
+        self.storage.chat_locales = {}
+        self.storage.chat_schedules = {}
+        self.storage.chat_failures = {}
+        self.reply_rate = reply_rate
+        self.reply_delay = reply_delay
+        self.alarms = []  # {'time' in Moscow time, 'type', 'recipients', 'replies'} of every fired alarm
+        self.admin_reminders = 0
+        self._random = random.Random(seed)
+        self._replies = []  # Heap of (virtual timestamp, chat_id, index of the alarm in self.alarms)
+        self._job_scheduler = VirtualScheduler(self.clock)
+
+        scheduler.set_callback(_Callback(self))
+        scheduler.init_simulation(self.storage, self._job_scheduler, self.clock.now)
+        if custom_times_rate and custom_times:
+            for chat_id in self.storage.subscribed_chats:
+                if self._random.random() < custom_times_rate:
+                    scheduler.set_chat_reminder_times(
+                        chat_id, self._random.sample(custom_times, self._random.randint(1, len(custom_times))))
+
+    def on_alarm(self, alarm_type, alarm_datetime, recipients):
+        index = len(self.alarms)
+        self.alarms.append({'time': alarm_datetime.astimezone(MOSCOW_TIMEZONE).isoformat(), 'type': alarm_type,
+                            'recipients': len(recipients), 'replies': 0})
+        for chat_id, next_alarm_datetime in recipients:
+            if self._random.random() < self.reply_rate:
+                delay = self._random.uniform(0, self.reply_delay.total_seconds())
+                heapq.heappush(self._replies, (alarm_datetime.timestamp() + delay, chat_id, index))
+
+    # The same as the /linen_changed handler of the bot
+    def _reply(self, chat_id, index):
+        if self.storage.remove_chat_to_notify(chat_id):
+            self.alarms[index]['replies'] += 1
+
+    # Sets the change as /stc does and runs all jobs and replies until the virtual time `until`
+    def run(self, change_start, change_end, until=None):
+        until = until or change_end + timedelta(hours=1)
+        scheduler.update_time_of_next_change([change_start.timestamp(), change_end.timestamp()])
+        started = time.perf_counter()
+        while True:
+            job = self._job_scheduler.next_job()
+            job_timestamp = job.next_run_time.timestamp() if job is not None else float('inf')
+            reply_timestamp = self._replies[0][0] if self._replies else float('inf')
+            if min(job_timestamp, reply_timestamp) > until.timestamp():
+                break
+            if reply_timestamp < job_timestamp:
+                timestamp, chat_id, index = heapq.heappop(self._replies)
+                self.clock.set(datetime.fromtimestamp(timestamp))
+                self._reply(chat_id, index)
+            else:
+                self._job_scheduler.run_job(job)
+        self.clock.set(until)
+
+        return {
+            'chats': len(self.storage.subscribed_chats),
+            'changed': len(self.storage.subscribed_chats) - len(self.storage.chats_to_notify),
+            'messages': sum(alarm['recipients'] for alarm in self.alarms),
+            'admin_reminders': self.admin_reminders,
+            'alarms': self.alarms,
+            'seconds': time.perf_counter() - started,
+        }
+
+    def shutdown(self):
+        scheduler.shutdown()
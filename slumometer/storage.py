@@ -1,56 +1,707 @@
 import json
+import mmap
 import os
 import logging
+import sqlite3
+import struct
+import threading
+import time
+from slumometer import metrics
+from slumometer.chatset import ChatSet, PendingChats
 
 # This storage keeps bot-related parameters such as admin chats or subscribed users
 
+LOG = logging.getLogger("slumometer.storage")
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.INFO)
+
+
+# Writes the file so that a crash leaves either the old or the new content, never a truncated one
+def _write_file_atomically(path, content, mode='w'):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode) as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+# chats.bin holds the sets of chats of Storage: a header with the magic, the version and the size of every set of
+# _CHAT_SETS, then the sorted ids of the sets one after another as native 64-bit integers. The size of the campaign set
+# is _SAME_AS_SUBSCRIBED if the campaign has the same chats as the subscribed set
+_CHATS_MAGIC = b'SLUMCHAT'
+_CHATS_VERSION = 1
+_CHATS_HEADER = struct.Struct('=8sq4q')  # Its size is a multiple of 8, so the ids are aligned
+_CHAT_SETS = ('subscribed', 'admins', 'campaign', 'changed')
+_SAME_AS_SUBSCRIBED = -1
+
+
+def _chat_set_property(name):
+    return property(lambda self: getattr(self, name),
+                    lambda self, chats: setattr(self, name, chats if isinstance(chats, ChatSet) else ChatSet(chats)))
+
+
+def _pack_chats(subscribed_chats, admin_chats, chats_to_notify):
+    campaign_chats = chats_to_notify.chats
+    sets = [subscribed_chats, admin_chats, campaign_chats, chats_to_notify.changed]
+    sizes = [len(chat_set) for chat_set in sets]
+    if campaign_chats is subscribed_chats:
+        sizes[2] = _SAME_AS_SUBSCRIBED
+        sets[2] = ChatSet()
+    return b''.join([_CHATS_HEADER.pack(_CHATS_MAGIC, _CHATS_VERSION, *sizes)] +
+                    [chat_set.tobytes() for chat_set in sets])
+
 
 class Storage:
     _STORAGE_FOLDER = 'data'
     _STORAGE_JSON = 'storage.json'
+    _STORAGE_CHATS = 'chats.bin'
     _STORAGE_SCHEDULER_DB = 'jobs.sqlite'
+    _STORAGE_OUTBOX_DB = 'outbox.sqlite'
+    _STORAGE_HISTORY_DB = 'history.sqlite'
+    _STORAGE_LEADER_LOCK = 'leader.lock'
+    _STORAGE_DORMS = 'dorms'
+
+    @staticmethod
+    def _create_storage_folder_if_needed(folder=None):
+        os.makedirs(folder or Storage._STORAGE_FOLDER, exist_ok=True)
 
     @staticmethod
-    def _create_storage_folder_if_needed():
-        os.makedirs(Storage._STORAGE_FOLDER, exist_ok=True)
+    def get_scheduler_db_path():
+        Storage._create_storage_folder_if_needed()
+        return os.path.join(Storage._STORAGE_FOLDER, Storage._STORAGE_SCHEDULER_DB)
 
     @staticmethod
-    def get_scheduler_db_url():
+    def get_outbox_db_path():
         Storage._create_storage_folder_if_needed()
-        return 'sqlite:///' + os.path.join(Storage._STORAGE_FOLDER, Storage._STORAGE_SCHEDULER_DB)
+        return os.path.join(Storage._STORAGE_FOLDER, Storage._STORAGE_OUTBOX_DB)
 
+    # Every dormitory keeps its own history in its folder
     @staticmethod
-    def _get_storage_json_path():
-        return os.path.join(Storage._STORAGE_FOLDER, Storage._STORAGE_JSON)
+    def get_history_db_path(folder=None):
+        folder = folder or Storage._STORAGE_FOLDER
+        Storage._create_storage_folder_if_needed(folder)
+        return os.path.join(folder, Storage._STORAGE_HISTORY_DB)
+
+    # The lock file of the worker which runs the scheduler in the multi-process mode
+    @staticmethod
+    def get_leader_lock_path():
+        Storage._create_storage_folder_if_needed()
+        return os.path.join(Storage._STORAGE_FOLDER, Storage._STORAGE_LEADER_LOCK)
 
-    subscribed_chats = []
-    chats_to_notify = []  # Subscribed chats except those who already changed linen.
-    # It should be reset before the day of change
-    admin_chats = []
+    # The folder of the storage of a dormitory other than the main one, see dorms.py
+    @staticmethod
+    def get_dorm_folder(name):
+        return os.path.join(Storage._STORAGE_FOLDER, Storage._STORAGE_DORMS, name)
+
+    def _get_storage_json_path(self):
+        return os.path.join(self.folder, Storage._STORAGE_JSON)
+
+    def _get_chats_path(self):
+        return os.path.join(self.folder, Storage._STORAGE_CHATS)
+
+    # Sets of chats are kept in chats.bin, see ChatSet. Lists assigned to them are converted
+    _subscribed_chats = ChatSet()
+    _admin_chats = ChatSet()
+    _chats_to_notify = PendingChats()
+    subscribed_chats = _chat_set_property('_subscribed_chats')
+    admin_chats = _chat_set_property('_admin_chats')
+    # Subscribed chats except those who already changed linen. It is reset by reset_chats_to_notify() on the first alarm
+    # of a change
+    chats_to_notify = property(lambda self: self._chats_to_notify,
+                               lambda self, chats: setattr(self, '_chats_to_notify', chats if isinstance(
+                                   chats, PendingChats) else PendingChats(ChatSet(chats))))
     time_next_change = None  # Date and time of next linen change. An array of timestamps. [time_starts, time_ends].
     # The bot will send notifications every hour beginning from time_starts until time_ends.
     next_admin_notification_time = None  # Timestamp when admins should receive next notification
+    notification_timeline = None  # All alarms of the next change: [[NOTIFY_TYPE, timestamp], ...]
+    notification_index = 0  # Index of the next alarm to fire in notification_timeline
+    chat_locales = {}  # Chat id -> locale chosen with /language. Other chats use the default locale
+    chat_schedules = {}  # Chat id -> {'times': [minute of day, ...] or None, 'quiet': [from minute, to minute] or None}.
+    # Reminder times and quiet hours chosen with /times and /quiet, in Moscow time. Other chats get the default times
+    chat_failures = {}  # Chat id -> number of broadcasts in a row in which the chat was unavailable
+    chat_rooms = {}  # Chat id -> room chosen with /room. The chat gets alerts about the slum index of the room
+    chat_dorms = {}  # Chat id -> dormitory chosen with /dorm. Other chats belong to the main dormitory
+    default_times = None  # [minute of day, ...] of usual reminders chosen with /default_times, in Moscow time. None
+    # means the default times of the scheduler
 
-    _FIELDS = ('subscribed_chats', 'chats_to_notify', 'admin_chats', 'time_next_change', 'next_admin_notification_time')
-    # All fields of Storage
+    _FIELDS = ('time_next_change', 'next_admin_notification_time', 'notification_timeline', 'notification_index',
+               'chat_locales', 'chat_schedules', 'chat_failures', 'chat_rooms', 'chat_dorms', 'default_times')
+    # Fields of Storage kept in storage.json
+    _CHAT_FIELDS = ('subscribed_chats', 'chats_to_notify', 'admin_chats')
+    # Fields which older versions kept in storage.json too
+
+    # `folder` is Storage._STORAGE_FOLDER by default: the storage of the main dormitory
+    def __init__(self, save_delay=0, max_pending_changes=100, folder=None):
+        self.folder = folder or Storage._STORAGE_FOLDER
+        # Write-behind mode: if save_delay is positive, save() only marks the storage dirty and changes are written to
+        # disk at most save_delay seconds later or as soon as max_pending_changes changes are accumulated
+        self.save_delay = save_delay
+        self.max_pending_changes = max_pending_changes
+        self.flush_count = 0  # How many times the storage was written to disk
+        self.flushed_changes = 0  # How many save() calls these writes covered
+        self._pending_changes = 0
+        self._flush_timer = None
+        self._lock = threading.Lock()  # Guards pending changes and the timer
+        self._flush_lock = threading.Lock()  # Keeps writes in order
+        self._data_lock = threading.Lock()  # Serializes changes of the collections
 
     def load(self):
-        Storage._create_storage_folder_if_needed()
+        Storage._create_storage_folder_if_needed(self.folder)
         try:
-            with open(Storage._get_storage_json_path(), 'r') as file:
+            with open(self._get_storage_json_path(), 'r') as file:
                 data = json.load(file)
-                for field in Storage._FIELDS:
+                for field in Storage._FIELDS + Storage._CHAT_FIELDS:
                     if field in data:
                         setattr(self, field, data[field])
+                # JSON keys are strings
+                self.chat_locales = {int(chat_id): locale for chat_id, locale in self.chat_locales.items()}
+                self.chat_schedules = {int(chat_id): schedule for chat_id, schedule in self.chat_schedules.items()}
+                self.chat_failures = {int(chat_id): failures for chat_id, failures in self.chat_failures.items()}
+                self.chat_rooms = {int(chat_id): room for chat_id, room in self.chat_rooms.items()}
+                self.chat_dorms = {int(chat_id): dorm for chat_id, dorm in self.chat_dorms.items()}
+        except FileNotFoundError:
+            LOG.warning("File {0} not found. You should set the time of next linen "
+                        "change.".format(Storage._STORAGE_JSON))
+        self._map_chats()
+
+    # The sets of chats are views of the mapped chats.bin until they are changed, so nothing is parsed or copied
+    def _map_chats(self):
+        try:
+            with open(self._get_chats_path(), 'rb') as file:
+                chats_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
         except FileNotFoundError:
-            logging.getLogger("slumometer.storage").warning("File {0} not found. You should set the time of next linen "
-                                                         "change.".format(Storage._STORAGE_JSON))
+            return
+        magic, version, *sizes = _CHATS_HEADER.unpack_from(chats_map)
+        if magic != _CHATS_MAGIC or version != _CHATS_VERSION:
+            raise ValueError("{} is not a file of chats of version {}".format(Storage._STORAGE_CHATS, _CHATS_VERSION))
+        ids = memoryview(chats_map).cast('q')
+        start = _CHATS_HEADER.size // ids.itemsize
+        sets = {}
+        for name, size in zip(_CHAT_SETS, sizes):
+            size = max(size, 0)
+            sets[name] = ChatSet.from_buffer(ids[start:start + size])
+            start += size
+        if sizes[_CHAT_SETS.index('campaign')] == _SAME_AS_SUBSCRIBED:
+            sets['campaign'] = sets['subscribed']
+        self.subscribed_chats = sets['subscribed']
+        self.admin_chats = sets['admins']
+        self.chats_to_notify = PendingChats(sets['campaign'], sets['changed'])
+
+    # Collections of the storage are copy-on-write: a change builds a new set or dict under _data_lock and replaces the
+    # old one, which is never modified. Readers such as a broadcast or flush() iterate a stable snapshot without locking
+
+    # Returns False if the chat is already subscribed
+    def add_subscribed_chat(self, chat_id):
+        return self._add_chat('subscribed_chats', chat_id)
+
+    # Returns False if the chat isn't subscribed
+    def remove_subscribed_chat(self, chat_id):
+        return self._remove_chat('subscribed_chats', chat_id)
+
+    def add_admin_chat(self, chat_id):
+        return self._add_chat('admin_chats', chat_id)
+
+    def remove_admin_chat(self, chat_id):
+        return self._remove_chat('admin_chats', chat_id)
+
+    # Starts a new notification campaign: every subscribed chat has to change linen
+    def reset_chats_to_notify(self):
+        with self._data_lock:
+            self.chats_to_notify = PendingChats(self.subscribed_chats)
+
+    # Marks that the chat has changed linen. Returns False if it already had
+    def remove_chat_to_notify(self, chat_id):
+        return self._remove_chat('chats_to_notify', chat_id)
+
+    # Adds the chat to the current campaign, e.g. when it comes from another dormitory. Returns False if it is there
+    def add_chat_to_notify(self, chat_id):
+        return self._add_chat('chats_to_notify', chat_id)
+
+    def _add_chat(self, field, chat_id):
+        with self._data_lock:
+            chats = getattr(self, field)
+            if chat_id in chats:
+                return False
+            setattr(self, field, chats.add(chat_id))
+            return True
+
+    def _remove_chat(self, field, chat_id):
+        with self._data_lock:
+            chats = getattr(self, field)
+            if chat_id not in chats:
+                return False
+            setattr(self, field, chats.remove(chat_id))
+            return True
+
+    def get_chat_locale(self, chat_id):
+        return self.chat_locales.get(chat_id)
+
+    def set_chat_locale(self, chat_id, locale):
+        with self._data_lock:
+            chat_locales = dict(self.chat_locales)
+            chat_locales[chat_id] = locale
+            self.chat_locales = chat_locales
+
+    # Returns {chat_id: locale} of chats which have chosen a locale
+    def get_chat_locales(self):
+        return dict(self.chat_locales)
+
+    def get_chat_schedule(self, chat_id):
+        return self.chat_schedules.get(chat_id)
+
+    # None removes the schedule of the chat
+    def set_chat_schedule(self, chat_id, schedule):
+        with self._data_lock:
+            chat_schedules = dict(self.chat_schedules)
+            if schedule is None:
+                chat_schedules.pop(chat_id, None)
+            else:
+                chat_schedules[chat_id] = schedule
+            self.chat_schedules = chat_schedules
+
+    # Returns {chat_id: schedule} of chats which have chosen their reminder times or quiet hours
+    def get_chat_schedules(self):
+        return dict(self.chat_schedules)
+
+    def get_chat_room(self, chat_id):
+        return self.chat_rooms.get(chat_id)
+
+    # None stops alerts about the room of the chat
+    def set_chat_room(self, chat_id, room):
+        with self._data_lock:
+            chat_rooms = dict(self.chat_rooms)
+            if room is None:
+                chat_rooms.pop(chat_id, None)
+            else:
+                chat_rooms[chat_id] = room
+            self.chat_rooms = chat_rooms
+
+    # Returns {room: [chat_id]} of the chats which have chosen one of `rooms`
+    def get_room_chats(self, rooms):
+        rooms = set(rooms)
+        room_chats = {}
+        for chat_id, room in self.chat_rooms.items():
+            if room in rooms:
+                room_chats.setdefault(room, []).append(chat_id)
+        return room_chats
+
+    def get_chat_dorm(self, chat_id):
+        return self.chat_dorms.get(chat_id)
+
+    # None moves the chat back to the main dormitory
+    def set_chat_dorm(self, chat_id, dorm):
+        with self._data_lock:
+            chat_dorms = dict(self.chat_dorms)
+            if dorm is None:
+                chat_dorms.pop(chat_id, None)
+            else:
+                chat_dorms[chat_id] = dorm
+            self.chat_dorms = chat_dorms
+
+    # Returns the chats of `chat_ids` which are in chats_to_notify
+    def filter_chats_to_notify(self, chat_ids):
+        chats_to_notify = self.chats_to_notify
+        return [chat_id for chat_id in chat_ids if chat_id in chats_to_notify]
+
+    # Counts one more failure of every chat. Returns {chat_id: number of failures}
+    def add_chat_failures(self, chat_ids):
+        with self._data_lock:
+            chat_failures = dict(self.chat_failures)
+            for chat_id in chat_ids:
+                chat_failures[chat_id] = chat_failures.get(chat_id, 0) + 1
+            self.chat_failures = chat_failures
+        return {chat_id: chat_failures[chat_id] for chat_id in chat_ids}
+
+    def clear_chat_failures(self, chat_ids):
+        if not self.chat_failures:
+            return
+        chat_ids = set(chat_ids)
+        with self._data_lock:
+            if any(chat_id in self.chat_failures for chat_id in chat_ids):
+                self.chat_failures = {chat_id: failures for chat_id, failures in self.chat_failures.items()
+                                      if chat_id not in chat_ids}
+
+    # Unsubscribes all the chats at once
+    def remove_subscribed_chats(self, chat_ids):
+        chat_ids = set(chat_ids)
+        with self._data_lock:
+            self.subscribed_chats = self.subscribed_chats.difference(chat_ids)
+            self.chats_to_notify = self.chats_to_notify.difference(chat_ids)
 
     # Remember to save the storage after any change
     def save(self):
-        Storage._create_storage_folder_if_needed()
-        with open(Storage._get_storage_json_path(), 'w') as file:
-            data_object = {}
-            for field in Storage._FIELDS:
-                data_object[field] = getattr(self, field)
-            json.dump(data_object, file)
+        with metrics.STORAGE_SAVE_SECONDS.time():
+            with self._lock:
+                self._pending_changes += 1
+                flush_now = not self.save_delay or self._pending_changes >= self.max_pending_changes
+                if not flush_now and self._flush_timer is None:
+                    self._flush_timer = threading.Timer(self.save_delay, self.flush)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+            if flush_now:
+                self.flush()
+
+    # Writes pending changes to disk right now
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                changes = self._pending_changes
+                self._pending_changes = 0
+            if changes == 0:
+                return
+
+            with metrics.STORAGE_FLUSH_SECONDS.time():
+                with self._data_lock:
+                    data_object = {field: getattr(self, field) for field in Storage._FIELDS}
+                    chat_sets = (self.subscribed_chats, self.admin_chats, self.chats_to_notify)
+                Storage._create_storage_folder_if_needed(self.folder)
+                _write_file_atomically(self._get_chats_path(), _pack_chats(*chat_sets), mode='wb')
+                _write_file_atomically(self._get_storage_json_path(), json.dumps(data_object))
+            self.flush_count += 1
+            self.flushed_changes += changes
+
+    # Call on shutdown so that no change is lost in write-behind mode
+    def close(self):
+        self.flush()
+        LOG.info("Storage was written {} times covering {} changes".format(self.flush_count, self.flushed_changes))
+
+
+# A list-like view of chat ids kept in a table of SqliteStorage. Every operation is a single indexed query
+class _ChatTable:
+    def __init__(self, storage, table):
+        self._storage = storage
+        self._table = table
+
+    def __contains__(self, chat_id):
+        return self._storage._query('SELECT 1 FROM {} WHERE chat_id = ?'.format(self._table), (chat_id,)) != []
+
+    def __len__(self):
+        return self._storage._query('SELECT COUNT(*) FROM {}'.format(self._table))[0][0]
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def copy(self):
+        return [row[0] for row in self._storage._query('SELECT chat_id FROM {}'.format(self._table))]
+
+    def append(self, chat_id):
+        self._storage._execute('INSERT OR IGNORE INTO {} (chat_id) VALUES (?)'.format(self._table), (chat_id,))
+
+    def remove(self, chat_id):
+        if self._storage._execute('DELETE FROM {} WHERE chat_id = ?'.format(self._table), (chat_id,)) == 0:
+            raise ValueError('chat {} is not in {}'.format(chat_id, self._table))
+
+
+# Chats of the current notification campaign which haven't changed linen yet
+class _ChatsToNotify(_ChatTable):
+    def __init__(self, storage):
+        super().__init__(storage, 'notify_state')
+
+    def _where(self):
+        return 'campaign = {} AND changed_at IS NULL'.format(int(self._storage._get_setting('notify_campaign') or 0))
+
+    def __contains__(self, chat_id):
+        return self._storage._query('SELECT 1 FROM notify_state WHERE {} AND chat_id = ?'.format(self._where()),
+                                    (chat_id,)) != []
+
+    def __len__(self):
+        return self._storage._query('SELECT COUNT(*) FROM notify_state WHERE {}'.format(self._where()))[0][0]
+
+    def copy(self):
+        return [row[0] for row in self._storage._query('SELECT chat_id FROM notify_state WHERE {}'.format(
+            self._where()))]
+
+    def append(self, chat_id):
+        campaign = int(self._storage._get_setting('notify_campaign') or 0)
+        self._storage._execute('INSERT OR REPLACE INTO notify_state (campaign, chat_id, changed_at) VALUES (?, ?, NULL)',
+                               (campaign, chat_id))
+
+    def remove(self, chat_id):
+        if self._storage._execute('UPDATE notify_state SET changed_at = ? WHERE {} AND chat_id = ?'.format(
+                self._where()), (time.time(), chat_id)) == 0:
+            raise ValueError('chat {} is not in chats_to_notify'.format(chat_id))
+
+
+_MAX_QUERY_PARAMETERS = 500  # SQLite before 3.32 allows at most 999 parameters in a query
+
+
+def _setting_property(name):
+    return property(lambda self: self._get_setting(name), lambda self, value: self._set_setting(name, value))
+
+
+# The same storage kept in an SQLite database. Chats live in indexed tables and every command changes a single row, so
+# save() has nothing left to do. On the first load the database is filled from storage.json
+class SqliteStorage(Storage):
+    _STORAGE_DB = 'storage.sqlite'
+    _SCHEMA_VERSION = 6
+    _SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS subscribed_chats (chat_id INTEGER PRIMARY KEY)',
+        'CREATE TABLE IF NOT EXISTS admin_chats (chat_id INTEGER PRIMARY KEY)',
+        # One row per chat and notification campaign. changed_at is set when the chat reports that linen is changed
+        'CREATE TABLE IF NOT EXISTS notify_state (campaign INTEGER NOT NULL, chat_id INTEGER NOT NULL, '
+        'changed_at REAL, PRIMARY KEY (campaign, chat_id)) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS chat_locales (chat_id INTEGER PRIMARY KEY, locale TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS chat_schedules (chat_id INTEGER PRIMARY KEY, schedule TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS chat_failures (chat_id INTEGER PRIMARY KEY, failures INTEGER NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS chat_rooms (chat_id INTEGER PRIMARY KEY, room TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS chat_rooms_room ON chat_rooms (room)',
+        'CREATE TABLE IF NOT EXISTS chat_dorms (chat_id INTEGER PRIMARY KEY, dorm TEXT NOT NULL)',
+    )
+
+    time_next_change = _setting_property('time_next_change')
+    next_admin_notification_time = _setting_property('next_admin_notification_time')
+    notification_timeline = _setting_property('notification_timeline')
+    notification_index = property(lambda self: self._get_setting('notification_index') or 0,
+                                  lambda self, value: self._set_setting('notification_index', value))
+    default_times = _setting_property('default_times')
+
+    def __init__(self, folder=None):
+        self.folder = folder or Storage._STORAGE_FOLDER
+        self._connection = None
+        self._lock = threading.RLock()
+
+    def _get_storage_db_path(self):
+        return os.path.join(self.folder, SqliteStorage._STORAGE_DB)
+
+    @property
+    def subscribed_chats(self):
+        return _ChatTable(self, 'subscribed_chats')
+
+    @subscribed_chats.setter
+    def subscribed_chats(self, chats):
+        self._replace_chats('subscribed_chats', chats)
+
+    @property
+    def admin_chats(self):
+        return _ChatTable(self, 'admin_chats')
+
+    @admin_chats.setter
+    def admin_chats(self, chats):
+        self._replace_chats('admin_chats', chats)
+
+    @property
+    def chats_to_notify(self):
+        return _ChatsToNotify(self)
+
+    # Assigning chats_to_notify starts a new notification campaign
+    @chats_to_notify.setter
+    def chats_to_notify(self, chats):
+        with self._lock, self._connection:
+            campaign = int(self._get_setting('notify_campaign') or 0) + 1
+            self._connection.executemany('INSERT INTO notify_state (campaign, chat_id) VALUES (?, ?)',
+                                         ((campaign, chat_id) for chat_id in set(chats)))
+            self._connection.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)',
+                                     ('notify_campaign', json.dumps(campaign)))
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchall()
+
+    # Returns the number of changed rows
+    def _execute(self, sql, params=()):
+        with metrics.STORAGE_FLUSH_SECONDS.time(), self._lock, self._connection:
+            return self._connection.execute(sql, params).rowcount
+
+    def _get_setting(self, name):
+        rows = self._query('SELECT value FROM settings WHERE name = ?', (name,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def _set_setting(self, name, value):
+        self._execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', (name, json.dumps(value)))
+
+    # Tables of chats are named as the fields
+    def _add_chat(self, field, chat_id):
+        return self._execute('INSERT OR IGNORE INTO {} (chat_id) VALUES (?)'.format(field), (chat_id,)) == 1
+
+    def _remove_chat(self, field, chat_id):
+        return self._execute('DELETE FROM {} WHERE chat_id = ?'.format(field), (chat_id,)) == 1
+
+    def reset_chats_to_notify(self):
+        with self._lock, self._connection:
+            campaign = int(self._get_setting('notify_campaign') or 0) + 1
+            self._connection.execute('INSERT INTO notify_state (campaign, chat_id) SELECT ?, chat_id '
+                                     'FROM subscribed_chats', (campaign,))
+            self._connection.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)',
+                                     ('notify_campaign', json.dumps(campaign)))
+
+    def remove_chat_to_notify(self, chat_id):
+        return self._execute('UPDATE notify_state SET changed_at = ? WHERE {} AND chat_id = ?'.format(
+            self.chats_to_notify._where()), (time.time(), chat_id)) == 1
+
+    def add_chat_to_notify(self, chat_id):
+        chats_to_notify = self.chats_to_notify
+        if chat_id in chats_to_notify:
+            return False
+        chats_to_notify.append(chat_id)
+        return True
+
+    def _replace_chats(self, table, chats):
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM {}'.format(table))
+            self._connection.executemany('INSERT OR IGNORE INTO {} (chat_id) VALUES (?)'.format(table),
+                                         ((chat_id,) for chat_id in chats))
+
+    def load(self):
+        Storage._create_storage_folder_if_needed(self.folder)
+        with self._lock:
+            self._connection = sqlite3.connect(self._get_storage_db_path(), check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            schema_version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+            if schema_version < SqliteStorage._SCHEMA_VERSION:
+                with self._connection:
+                    for statement in SqliteStorage._SCHEMA:
+                        self._connection.execute(statement)
+                    self._connection.execute('PRAGMA user_version = {}'.format(SqliteStorage._SCHEMA_VERSION))
+                if schema_version == 0:
+                    self._migrate_from_json()
+
+    def _migrate_from_json(self):
+        json_path = self._get_storage_json_path()
+        if not os.path.exists(json_path):
+            return
+        legacy = Storage(folder=self.folder)
+        legacy.load()
+        self.subscribed_chats = legacy.subscribed_chats
+        self.admin_chats = legacy.admin_chats
+        self.chats_to_notify = legacy.chats_to_notify
+        self.time_next_change = legacy.time_next_change
+        self.next_admin_notification_time = legacy.next_admin_notification_time
+        self.notification_timeline = legacy.notification_timeline
+        self.notification_index = legacy.notification_index
+        self.default_times = legacy.default_times
+        for chat_id, locale in legacy.chat_locales.items():
+            self.set_chat_locale(chat_id, locale)
+        for chat_id, schedule in legacy.chat_schedules.items():
+            self.set_chat_schedule(chat_id, schedule)
+        for chat_id, failures in legacy.chat_failures.items():
+            self._execute('INSERT INTO chat_failures (chat_id, failures) VALUES (?, ?)', (chat_id, failures))
+        for chat_id, room in legacy.chat_rooms.items():
+            self.set_chat_room(chat_id, room)
+        for chat_id, dorm in legacy.chat_dorms.items():
+            self.set_chat_dorm(chat_id, dorm)
+        os.replace(json_path, json_path + '.migrated')
+        chats_path = self._get_chats_path()
+        if os.path.exists(chats_path):
+            os.replace(chats_path, chats_path + '.migrated')
+        LOG.info("Storage is migrated from {} to {}".format(Storage._STORAGE_JSON, SqliteStorage._STORAGE_DB))
+
+    def get_chat_locale(self, chat_id):
+        rows = self._query('SELECT locale FROM chat_locales WHERE chat_id = ?', (chat_id,))
+        return rows[0][0] if rows else None
+
+    def set_chat_locale(self, chat_id, locale):
+        self._execute('INSERT OR REPLACE INTO chat_locales (chat_id, locale) VALUES (?, ?)', (chat_id, locale))
+
+    def get_chat_locales(self):
+        return dict(self._query('SELECT chat_id, locale FROM chat_locales'))
+
+    def get_chat_schedule(self, chat_id):
+        rows = self._query('SELECT schedule FROM chat_schedules WHERE chat_id = ?', (chat_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def set_chat_schedule(self, chat_id, schedule):
+        if schedule is None:
+            self._execute('DELETE FROM chat_schedules WHERE chat_id = ?', (chat_id,))
+        else:
+            self._execute('INSERT OR REPLACE INTO chat_schedules (chat_id, schedule) VALUES (?, ?)',
+                          (chat_id, json.dumps(schedule)))
+
+    def get_chat_schedules(self):
+        return {chat_id: json.loads(schedule) for chat_id, schedule in self._query(
+            'SELECT chat_id, schedule FROM chat_schedules')}
+
+    def get_chat_room(self, chat_id):
+        rows = self._query('SELECT room FROM chat_rooms WHERE chat_id = ?', (chat_id,))
+        return rows[0][0] if rows else None
+
+    def set_chat_room(self, chat_id, room):
+        if room is None:
+            self._execute('DELETE FROM chat_rooms WHERE chat_id = ?', (chat_id,))
+        else:
+            self._execute('INSERT OR REPLACE INTO chat_rooms (chat_id, room) VALUES (?, ?)', (chat_id, room))
+
+    def get_room_chats(self, rooms):
+        rooms = list(rooms)
+        room_chats = {}
+        for i in range(0, len(rooms), _MAX_QUERY_PARAMETERS):
+            chunk = rooms[i:i + _MAX_QUERY_PARAMETERS]
+            for chat_id, room in self._query('SELECT chat_id, room FROM chat_rooms WHERE room IN ({})'.format(
+                    ', '.join('?' * len(chunk))), chunk):
+                room_chats.setdefault(room, []).append(chat_id)
+        return room_chats
+
+    def get_chat_dorm(self, chat_id):
+        rows = self._query('SELECT dorm FROM chat_dorms WHERE chat_id = ?', (chat_id,))
+        return rows[0][0] if rows else None
+
+    def set_chat_dorm(self, chat_id, dorm):
+        if dorm is None:
+            self._execute('DELETE FROM chat_dorms WHERE chat_id = ?', (chat_id,))
+        else:
+            self._execute('INSERT OR REPLACE INTO chat_dorms (chat_id, dorm) VALUES (?, ?)', (chat_id, dorm))
+
+    # Looks up only the given chats, so the cost doesn't depend on the number of all chats
+    def filter_chats_to_notify(self, chat_ids):
+        chat_ids = list(chat_ids)
+        result = []
+        for i in range(0, len(chat_ids), _MAX_QUERY_PARAMETERS):
+            chunk = chat_ids[i:i + _MAX_QUERY_PARAMETERS]
+            result.extend(row[0] for row in self._query(
+                'SELECT chat_id FROM notify_state WHERE {} AND chat_id IN ({})'.format(
+                    self.chats_to_notify._where(), ', '.join('?' * len(chunk))), chunk))
+        return result
+
+    def add_chat_failures(self, chat_ids):
+        chat_ids = list(chat_ids)
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR IGNORE INTO chat_failures (chat_id, failures) VALUES (?, 0)',
+                                         ((chat_id,) for chat_id in chat_ids))
+            self._connection.executemany('UPDATE chat_failures SET failures = failures + 1 WHERE chat_id = ?',
+                                         ((chat_id,) for chat_id in chat_ids))
+        failures = {}
+        for i in range(0, len(chat_ids), _MAX_QUERY_PARAMETERS):
+            chunk = chat_ids[i:i + _MAX_QUERY_PARAMETERS]
+            failures.update(self._query('SELECT chat_id, failures FROM chat_failures WHERE chat_id IN ({})'.format(
+                ', '.join('?' * len(chunk))), chunk))
+        return failures
+
+    # Few chats have failures, so only those are deleted rather than every delivered chat of a broadcast
+    def clear_chat_failures(self, chat_ids):
+        failing_chats = {chat_id for chat_id, in self._query('SELECT chat_id FROM chat_failures')}
+        chat_ids = [chat_id for chat_id in chat_ids if chat_id in failing_chats]
+        if not chat_ids:
+            return
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM chat_failures WHERE chat_id = ?',
+                                         ((chat_id,) for chat_id in chat_ids))
+
+    def remove_subscribed_chats(self, chat_ids):
+        with self._lock, self._connection:
+            self._connection.executemany('DELETE FROM subscribed_chats WHERE chat_id = ?',
+                                         ((chat_id,) for chat_id in chat_ids))
+            self._connection.executemany('DELETE FROM notify_state WHERE chat_id = ? AND changed_at IS NULL',
+                                         ((chat_id,) for chat_id in chat_ids))
+
+    # Every change is already committed
+    def save(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,123 @@
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+from telebot import apihelper
+from urllib3.exceptions import NewConnectionError
+from slumometer import metrics
+
+LOG = logging.getLogger("slumometer.transport")
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.INFO)
+
+API_URL = apihelper.API_URL
+DEFAULT_POOL_SIZE = 16
+DEFAULT_CONNECT_TIMEOUT = 3.5
+DEFAULT_READ_TIMEOUT = 30.0
+DEFAULT_RETRIES = 2
+
+_BACKOFF_BASE = 0.1  # Seconds: the longest wait before the first retry. It doubles with every next retry
+_BACKOFF_MAX = 2.0
+_POLLING_TIMEOUT_MARGIN = 10  # getUpdates waits up to its `timeout` parameter for updates before it answers
+_SERVER_ERRORS = frozenset((500, 502, 503, 504))
+# Methods which leave the same state when they are repeated, so they are repeated after any transient error
+_IDEMPOTENT_METHODS = frozenset(('setWebhook', 'deleteWebhook'))
+
+
+def _is_idempotent(method_name):
+    return method_name.startswith('get') or method_name in _IDEMPOTENT_METHODS
+
+
+# True if the request surely didn't reach the server, so even sendMessage can be repeated without a duplicate message
+def _is_not_sent(error):
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+# HTTP transport of pyTelegramBotAPI with one pool of keep-alive connections for all threads. pyTelegramBotAPI gives
+# every thread its own session, so every broadcast, whose workers are new threads, connects and shakes hands with
+# Telegram again. Here every thread still has its own session, but all sessions share the connections of one adapter.
+# A thread waits for a free connection when all pool_size connections are busy instead of opening one more.
+# Every call has a connect and a read timeout, and transient errors are repeated after a jittered exponential backoff:
+# errors before the request was sent always, server errors and timeouts only for idempotent methods
+class Transport:
+    def __init__(self, api_url=API_URL, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, retries=DEFAULT_RETRIES):
+        self.api_url = api_url
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self._adapter = None
+        self._local = None
+        self.reset()
+
+    # Replaces the requests of pyTelegramBotAPI with this transport
+    def install(self):
+        apihelper._make_request = self.make_request
+        apihelper._get_req_session = self.get_session
+
+    # Drops all connections, e.g. in a forked process which must not use the sockets of its parent
+    def reset(self):
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True, max_retries=0)
+        self._local = threading.local()
+
+    # Returns the session of the current thread. `reset` has the meaning of apihelper._get_req_session
+    def get_session(self, reset=False):
+        session = getattr(self._local, 'session', None)
+        if session is None or reset:
+            session = self._local.session = requests.Session()
+            session.mount('https://', self._adapter)
+            session.mount('http://', self._adapter)
+        return session
+
+    # Returns the number of connections opened since the last reset
+    def connections_opened(self):
+        pools = self._adapter.poolmanager.pools
+        opened = 0
+        for key in pools.keys():
+            try:
+                opened += pools[key].num_connections
+            except KeyError:  # The pool was dropped meanwhile
+                pass
+        return opened
+
+    # The same as apihelper._make_request. `base_url` is the URL template of API methods, api_url by default
+    def make_request(self, token, method_name, method='get', params=None, files=None, base_url=None):
+        url = (base_url or self.api_url).format(token, method_name)
+        connect_timeout = self.connect_timeout
+        read_timeout = self.read_timeout
+        if params:
+            if 'timeout' in params:
+                read_timeout = params['timeout'] + _POLLING_TIMEOUT_MARGIN
+            if 'connect-timeout' in params:
+                connect_timeout = params['connect-timeout'] + _POLLING_TIMEOUT_MARGIN
+        if files and apihelper.format_header_param:
+            apihelper.fields.format_header_param = apihelper._no_encode(apihelper.format_header_param)
+        idempotent = _is_idempotent(method_name)
+
+        for attempt in range(self.retries + 1):
+            is_last_attempt = attempt == self.retries
+            started = time.perf_counter()
+            try:
+                result = self.get_session().request(method, url, params=params, files=files,
+                                                    timeout=(connect_timeout, read_timeout), proxies=apihelper.proxy)
+            except (ConnectionError, Timeout) as e:
+                metrics.API_REQUEST_SECONDS.observe(time.perf_counter() - started, method=method_name)
+                reason = 'connect' if _is_not_sent(e) else 'network'
+                if is_last_attempt or (reason == 'network' and not idempotent):
+                    raise
+                LOG.warning("{} failed, retrying: {}".format(method_name, e))
+            else:
+                metrics.API_REQUEST_SECONDS.observe(time.perf_counter() - started, method=method_name)
+                if is_last_attempt or result.status_code not in _SERVER_ERRORS or not idempotent:
+                    return apihelper._check_result(method_name, result)['result']
+                reason = 'server'
+                LOG.warning("{} failed with HTTP {}, retrying".format(method_name, result.status_code))
+            metrics.API_RETRIES.inc(reason=reason)
+            time.sleep(random.uniform(0, min(_BACKOFF_MAX, _BACKOFF_BASE * 2 ** attempt)))
@@ -0,0 +1,105 @@
+import hmac
+import json
+import logging
+import queue
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telebot import apihelper, types
+
+LOG = logging.getLogger("slumometer.webhook")
+LOG.addHandler(logging.StreamHandler())
+LOG.setLevel(logging.INFO)
+
+_SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+_MAX_BATCH_SIZE = 100
+_MAX_BODY_SIZE = 1024 * 1024
+
+
+# pyTelegramBotAPI 3.6.6 can't pass secret_token to setWebhook, so call the method directly
+def set_webhook(bot, url, secret_token):
+    apihelper._make_request(bot.token, 'setWebhook', params={'url': url, 'secret_token': secret_token},
+                            method='post')
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        secret_token = self.headers.get(_SECRET_TOKEN_HEADER, '')
+        if not hmac.compare_digest(secret_token, self.server.secret_token):
+            self.send_error(403)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = 0
+        if length <= 0 or length > _MAX_BODY_SIZE:
+            self.send_error(400)
+            return
+        try:
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+            # Telegram sends one update per request. A list of updates is accepted to replay recorded updates
+            updates = [types.Update.de_json(update) for update in (body if isinstance(body, list) else [body])]
+        except (ValueError, KeyError, TypeError) as e:
+            LOG.warning("Bad update received: {}".format(e))
+            self.send_error(400)
+            return
+
+        for update in updates:
+            self.server.updates.put(update)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        LOG.debug(format % args)
+
+
+# Several processes may listen on the same port, the kernel spreads connections between them
+class _ReusePortHTTPServer(ThreadingHTTPServer):
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+# Accepts updates from Telegram and feeds them to bot.process_new_updates in batches
+class WebhookServer:
+    def __init__(self, bot, host, port, secret_token, reuse_port=False):
+        self._bot = bot
+        self._server = (_ReusePortHTTPServer if reuse_port else ThreadingHTTPServer)((host, port), _RequestHandler)
+        self._server.daemon_threads = True
+        self._server.secret_token = secret_token
+        self._server.updates = queue.Queue()
+        self._dispatcher = threading.Thread(target=self._dispatch_updates, name='webhook-dispatcher', daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def _dispatch_updates(self):
+        updates = self._server.updates
+        while True:
+            batch = [updates.get()]
+            while len(batch) < _MAX_BATCH_SIZE:
+                try:
+                    batch.append(updates.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._bot.process_new_updates(batch)
+            except Exception:
+                LOG.exception("Failed to process {} updates".format(len(batch)))
+
+    def start(self):
+        self._dispatcher.start()
+        threading.Thread(target=self._server.serve_forever, name='webhook-server', daemon=True).start()
+        LOG.info('Listening for webhook updates on port {}'.format(self.port))
+
+    def serve_forever(self):
+        self._dispatcher.start()
+        LOG.info('Listening for webhook updates on port {}'.format(self.port))
+        self._server.serve_forever()
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The bot imports its modules both as `slumometer.x` and as top-level `common`, like bot.py run from its folder
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [_ROOT, os.path.join(_ROOT, 'slumometer')]
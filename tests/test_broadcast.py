@@ -0,0 +1,29 @@
+from telebot.apihelper import ApiException
+
+from slumometer import broadcast
+
+
+def _send(chat_id, text, **kwargs):
+    if chat_id < 0:
+        raise ApiException('Forbidden', 'sendMessage', {'error_code': 403, 'description': 'Forbidden: bot was blocked'})
+
+
+def _make_broadcaster():
+    return broadcast.Broadcaster(_send, workers=4, rate=10000, chat_interval=0)
+
+
+def test_report_lists_delivered_and_unavailable_chats():
+    report = _make_broadcaster().broadcast('campaign', [1, -2, 3], 'text')
+
+    assert (report.total, report.sent, report.failed) == (3, 2, 1)
+    assert sorted(report.delivered_chats) == [1, 3]
+    assert report.unavailable_chats == [-2]
+
+
+def test_only_last_reports_are_kept():
+    broadcaster = _make_broadcaster()
+    for i in range(broadcast.KEPT_REPORTS + 5):
+        broadcaster.broadcast('campaign:{}'.format(i), [1], 'text')
+
+    assert len(broadcaster.last_reports) == broadcast.KEPT_REPORTS
+    assert broadcaster.last_reports[-1].campaign == 'campaign:{}'.format(broadcast.KEPT_REPORTS + 4)
@@ -0,0 +1,76 @@
+from datetime import time
+
+import pytest
+
+from slumometer import dorms, scheduler
+from slumometer.history import History
+from slumometer.storage import SqliteStorage, Storage
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def served_dorms(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    storage_factory = Storage if request.param == 'json' else SqliteStorage
+    storage = storage_factory()
+    storage.load()
+    history = History(storage.get_history_db_path())
+    history.open()
+    served = dorms.Dorms(storage, history, 'key', dorms.parse('2ka,3ka'), storage_factory)
+    served.open()
+    scheduler.init(storage)
+    for dorm in served.others():
+        scheduler.add_tenant(dorm.tenant, dorm.storage)
+    yield served
+    scheduler.shutdown()
+    served.close()
+    history.close()
+    storage.close()
+
+
+def test_chat_is_not_moved_to_its_own_dorm(served_dorms):
+    assert not served_dorms.move_chat(1, served_dorms.main)
+    assert served_dorms.of_chat(1) is served_dorms.main
+
+
+def test_chat_moves_with_its_subscription_and_campaign(served_dorms):
+    main, other = served_dorms.main, served_dorms.get('3ka')
+    main.storage.add_subscribed_chat(1)
+    main.storage.add_subscribed_chat(2)
+    main.storage.reset_chats_to_notify()
+    other.storage.reset_chats_to_notify()
+
+    assert served_dorms.move_chat(1, other)
+
+    assert served_dorms.of_chat(1) is other
+    assert 1 not in main.storage.subscribed_chats and 1 not in main.storage.chats_to_notify
+    assert 1 in other.storage.subscribed_chats and 1 in other.storage.chats_to_notify
+    assert 2 in main.storage.chats_to_notify
+
+
+def test_chat_which_changed_linen_is_not_reminded_after_the_move(served_dorms):
+    main, other = served_dorms.main, served_dorms.get('3ka')
+    main.storage.add_subscribed_chat(1)
+    main.storage.reset_chats_to_notify()
+    main.storage.remove_chat_to_notify(1)
+
+    served_dorms.move_chat(1, other)
+
+    assert 1 in other.storage.subscribed_chats and 1 not in other.storage.chats_to_notify
+
+
+def test_unsubscribed_chat_stays_unsubscribed(served_dorms):
+    other = served_dorms.get('3ka')
+
+    served_dorms.move_chat(1, other)
+
+    assert 1 not in other.storage.subscribed_chats
+
+
+def test_chat_moves_with_its_reminder_times(served_dorms):
+    other = served_dorms.get('3ka')
+    scheduler.set_chat_reminder_times(1, [time(10, 0)])
+
+    served_dorms.move_chat(1, other)
+
+    assert served_dorms.main.storage.get_chat_schedule(1) is None
+    assert scheduler.get_chat_reminder_times(1, other.tenant) == [time(10, 0)]
@@ -0,0 +1,123 @@
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from common import MOSCOW_TIMEZONE
+from slumometer import history as history_module
+from slumometer.history import History
+from slumometer.scheduler import USER_NOTIFY_TYPE_1HOUR_TO_END, USER_NOTIFY_TYPE_LAST, USER_NOTIFY_TYPE_USUAL
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'history.sqlite')
+
+
+@pytest.fixture
+def history(path):
+    history = History(path)
+    history.open()
+    yield history
+    history.close()
+
+
+def _timestamp(moscow_datetime):
+    return MOSCOW_TIMEZONE.localize(datetime.strptime(moscow_datetime, '%Y-%m-%d %H:%M')).timestamp()
+
+
+# Records an alarm at a Moscow time like the bot does: usual alarms are counted in the slot of their minute
+def _record_alarm(history, alarm_type, moscow_datetime, recipients):
+    alarm_time = _timestamp(moscow_datetime)
+    minute = None
+    if alarm_type == USER_NOTIFY_TYPE_USUAL:
+        moscow_time = datetime.fromtimestamp(alarm_time, MOSCOW_TIMEZONE)
+        minute = moscow_time.hour * 60 + moscow_time.minute
+    history.record_alarm(alarm_type, alarm_time, minute, recipients)
+
+
+def _record_two_campaigns(history):
+    history.start_campaign(_timestamp('2019-09-30 10:50'), 5)
+    _record_alarm(history, USER_NOTIFY_TYPE_USUAL, '2019-09-30 10:50', 5)
+    history.record_linen_changed(1)
+    _record_alarm(history, USER_NOTIFY_TYPE_USUAL, '2019-09-30 10:50', 5)  # Fired again after a restart
+    _record_alarm(history, USER_NOTIFY_TYPE_USUAL, '2019-09-30 12:15', 4)
+    history.record_linen_changed(2)
+    history.record_linen_changed(3)
+    _record_alarm(history, USER_NOTIFY_TYPE_1HOUR_TO_END, '2019-09-30 14:00', 2)
+    history.record_linen_changed(4)
+    _record_alarm(history, USER_NOTIFY_TYPE_LAST, '2019-09-30 15:00', 1)
+
+    history.start_campaign(_timestamp('2019-10-14 10:50'), 3)
+    history.start_campaign(_timestamp('2019-10-14 10:50'), 3)
+    _record_alarm(history, USER_NOTIFY_TYPE_USUAL, '2019-10-14 10:50', 3)
+    history.record_linen_changed(1)
+
+
+# Counts campaigns and slots from the events table alone
+def _recount(path):
+    connection = sqlite3.connect(path)
+    events = connection.execute('SELECT kind, campaign, alarm_type, alarm_time, recipients FROM events '
+                                'ORDER BY id').fetchall()
+    connection.close()
+    campaigns = {}
+    slots = {}
+    last_slots = {}
+    for kind, campaign, alarm_type, alarm_time, recipients in events:
+        counters = campaigns.setdefault(campaign, {'alarms': 0, 'messages': 0, 'confirmations': 0})
+        if kind == history_module.CAMPAIGN_STARTED:
+            counters['subscribers'] = recipients
+        elif kind == history_module.ALARM_FIRED:
+            minute = None
+            if alarm_type == USER_NOTIFY_TYPE_USUAL:
+                moscow_time = datetime.fromtimestamp(alarm_time, MOSCOW_TIMEZONE)
+                minute = moscow_time.hour * 60 + moscow_time.minute
+            slot = last_slots[campaign] = (alarm_type, minute)
+            counters['alarms'] += 1
+            counters['messages'] += recipients
+            slot_counters = slots.setdefault(slot, [0, 0, 0])
+            slot_counters[0] += 1
+            slot_counters[1] += recipients
+        elif kind == history_module.LINEN_CHANGED:
+            counters['confirmations'] += 1
+            slots[last_slots[campaign]][2] += 1
+    return campaigns, sorted(slot + tuple(counters) for slot, counters in slots.items())
+
+
+def test_counters_match_the_events(history, path):
+    _record_two_campaigns(history)
+
+    campaigns, slots = _recount(path)
+
+    assert history.get_slots() == slots
+    last_campaign = history.get_last_campaign()
+    assert last_campaign == dict(campaigns[last_campaign['id']], id=last_campaign['id'],
+                                 first_alarm_time=_timestamp('2019-10-14 10:50'))
+
+
+def test_an_alarm_fired_twice_is_recorded_once(history):
+    _record_two_campaigns(history)
+
+    assert history.get_slots()[0] == (USER_NOTIFY_TYPE_USUAL, 10 * 60 + 50, 2, 8, 2)
+
+
+def test_confirmations_count_towards_the_last_alarm(history):
+    _record_two_campaigns(history)
+
+    assert history.get_slots() == [
+        (USER_NOTIFY_TYPE_USUAL, 10 * 60 + 50, 2, 8, 2),
+        (USER_NOTIFY_TYPE_USUAL, 12 * 60 + 15, 1, 4, 2),
+        (USER_NOTIFY_TYPE_1HOUR_TO_END, None, 1, 2, 1),
+        (USER_NOTIFY_TYPE_LAST, None, 1, 1, 0),
+    ]
+    assert history.get_last_campaign() == {'id': 2, 'first_alarm_time': _timestamp('2019-10-14 10:50'),
+                                            'subscribers': 3, 'alarms': 1, 'messages': 3, 'confirmations': 1}
+
+
+def test_nothing_is_recorded_before_the_first_campaign(history, path):
+    _record_alarm(history, USER_NOTIFY_TYPE_USUAL, '2019-09-30 10:50', 5)
+    history.record_linen_changed(1)
+
+    assert history.get_last_campaign() is None
+    assert history.get_slots() == []
+    assert _recount(path) == ({}, [])
@@ -0,0 +1,93 @@
+import pickle
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.interval import IntervalTrigger
+from pytz import timezone, utc
+
+from slumometer import jobstore
+from slumometer.jobstore import SqliteJobStore
+from slumometer.scheduler import _TimelineTrigger
+
+
+def _job_function(*args):
+    pass
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'jobs.sqlite')
+
+
+def _start(path):
+    scheduler = BackgroundScheduler(jobstores={'default': SqliteJobStore(path)}, timezone=utc)
+    scheduler.start(paused=True)
+    return scheduler
+
+
+def test_tagged_values_survive_json():
+    moscow = timezone('Europe/Moscow')
+    value = {'start': moscow.localize(datetime(2019, 9, 30, 12, 15, 30, 250000)), 'naive': datetime(2019, 9, 30),
+             'interval': timedelta(hours=1, microseconds=5), 'timezone': moscow, 'list': [1, 'a', None]}
+
+    decoded = jobstore._decode(jobstore._encode(value))
+
+    assert decoded == value
+    assert decoded['start'].tzinfo.zone == 'Europe/Moscow'
+    assert decoded['naive'].tzinfo is None
+    assert decoded['timezone'] is moscow
+
+
+def test_jobs_survive_reopening(path):
+    now = datetime.now(utc).timestamp()
+    timestamps = [now + 3600.25, now + 7200.5]
+    scheduler = _start(path)
+    scheduler.add_job(_job_function, _TimelineTrigger(timestamps), args=['user_notifier', 'dorm'], id='timeline')
+    scheduler.add_job(_job_function, 'interval', minutes=5, id='interval')
+    scheduler.shutdown()
+
+    scheduler = _start(path)
+    try:
+        timeline_job = scheduler.get_job('timeline')
+        assert timeline_job.func is _job_function
+        assert timeline_job.args == ('user_notifier', 'dorm')
+        assert timeline_job.trigger.timestamps == timestamps
+        assert timeline_job.next_run_time == datetime.fromtimestamp(timestamps[0], utc)
+        interval_job = scheduler.get_job('interval')
+        assert isinstance(interval_job.trigger, IntervalTrigger)
+        assert interval_job.trigger.interval == timedelta(minutes=5)
+        assert [job.id for job in scheduler.get_jobs()] == ['interval', 'timeline']
+    finally:
+        scheduler.shutdown()
+
+
+def test_legacy_jobs_are_migrated(path):
+    memory_scheduler = BackgroundScheduler(timezone=utc)
+    memory_scheduler.start(paused=True)
+    job = memory_scheduler.add_job(_job_function, 'interval', hours=1, args=['admin_notifier'], id='admin_notifier',
+                                   start_date=datetime(2030, 1, 1, tzinfo=utc))
+    job_state = pickle.dumps(job.__getstate__(), pickle.HIGHEST_PROTOCOL)
+    memory_scheduler.shutdown()
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute('CREATE TABLE apscheduler_jobs (id VARCHAR(191) NOT NULL PRIMARY KEY, '
+                           'next_run_time FLOAT, job_state BLOB NOT NULL)')
+        connection.execute('INSERT INTO apscheduler_jobs VALUES (?, ?, ?)',
+                           ('admin_notifier', job.next_run_time.timestamp(), job_state))
+        connection.execute('INSERT INTO apscheduler_jobs VALUES (?, ?, ?)', ('broken', None, b'not a pickle'))
+    connection.close()
+
+    scheduler = _start(path)
+    try:
+        migrated_job = scheduler.get_job('admin_notifier')
+        assert migrated_job.args == ('admin_notifier',)
+        assert migrated_job.trigger.interval == timedelta(hours=1)
+        assert migrated_job.next_run_time == job.next_run_time
+        assert [job.id for job in scheduler.get_jobs()] == ['admin_notifier']
+    finally:
+        scheduler.shutdown()
+    connection = sqlite3.connect(path)
+    assert connection.execute("SELECT name FROM sqlite_master WHERE name = 'apscheduler_jobs'").fetchall() == []
+    connection.close()
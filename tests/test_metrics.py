@@ -0,0 +1,56 @@
+import pytest
+
+from slumometer import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(metrics, '_metrics', [])
+
+
+def test_label_values_are_escaped():
+    counter = metrics.Counter('test_total', 'Test counter', ('path',))
+    counter.inc(path='C:\\dorm "2ka"\nroom')
+
+    assert metrics.render() == ('# HELP test_total Test counter\n'
+                                '# TYPE test_total counter\n'
+                                'test_total{path="C:\\\\dorm \\"2ka\\"\\nroom"} 1.0\n')
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = metrics.Histogram('test_seconds', 'Test histogram', ('job',), buckets=(1, 0.5))
+    for value in (0.2, 0.5, 0.7, 3):
+        histogram.observe(value, job='notifier')
+
+    assert metrics.render().splitlines() == [
+        '# HELP test_seconds Test histogram',
+        '# TYPE test_seconds histogram',
+        'test_seconds_bucket{job="notifier",le="0.5"} 2.0',
+        'test_seconds_bucket{job="notifier",le="1.0"} 3.0',
+        'test_seconds_bucket{job="notifier",le="+Inf"} 4.0',
+        'test_seconds_sum{job="notifier"} 4.4',
+        'test_seconds_count{job="notifier"} 4.0',
+    ]
+    assert histogram.count(job='notifier') == 4
+    assert histogram.mean(job='notifier') == pytest.approx(1.1)
+
+
+def test_metrics_without_labels_are_rendered():
+    metrics.Gauge('test_chats', 'Test gauge', function=lambda: 7)
+    histogram = metrics.Histogram('test_seconds', 'Test histogram', buckets=(1,))
+    histogram.observe(2)
+
+    lines = metrics.render().splitlines()
+
+    assert 'test_chats 7.0' in lines
+    assert 'test_seconds_bucket{le="1.0"} 0.0' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 1.0' in lines
+    assert 'test_seconds_sum 2.0' in lines
+    assert 'test_seconds_count 1.0' in lines
+
+
+def test_labels_must_match():
+    counter = metrics.Counter('test_total', 'Test counter', ('result',))
+
+    with pytest.raises(ValueError):
+        counter.inc(reason='flood')
@@ -0,0 +1,74 @@
+import pytest
+from telebot import types
+
+from slumometer import middleware
+
+
+def _update(update_id, text, chat_id=1):
+    return types.Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': text}})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(middleware.time, 'monotonic', lambda: clock[0])
+    return clock
+
+
+def _ids(updates):
+    return [update.update_id for update in updates]
+
+
+def test_duplicate_updates_are_dropped(clock):
+    update_filter = middleware.UpdateFilter()
+
+    assert _ids(update_filter.filter([_update(1, 'hi'), _update(1, 'hi')])) == [1]
+    assert update_filter.filter([_update(1, 'hi')]) == []
+
+
+def test_repeated_idempotent_commands_are_collapsed(clock):
+    update_filter = middleware.UpdateFilter()
+
+    assert _ids(update_filter.filter([_update(1, '/status'), _update(2, '/status')])) == [1]
+    clock[0] += middleware.COLLAPSE_WINDOW
+    assert _ids(update_filter.filter([_update(3, '/status')])) == [3]
+
+
+def test_alternating_commands_are_not_collapsed(clock):
+    update_filter = middleware.UpdateFilter()
+
+    updates = [_update(1, '/subscribe'), _update(2, '/unsubscribe'), _update(3, '/subscribe')]
+    assert _ids(update_filter.filter(updates)) == [1, 2, 3]
+
+
+def test_chats_are_throttled_after_a_burst(clock):
+    throttled = []
+    update_filter = middleware.UpdateFilter(on_throttled=throttled.append, burst=2, command_interval=5)
+
+    updates = [_update(update_id, '/time {}'.format(update_id)) for update_id in range(1, 5)]
+    assert _ids(update_filter.filter(updates + [_update(5, '/time', chat_id=2)])) == [1, 2, 5]
+    assert [message.message_id for message in throttled] == [3]
+
+    clock[0] += 5
+    assert _ids(update_filter.filter([_update(6, '/time 6'), _update(7, '/time 7')])) == [6]
+    assert [message.message_id for message in throttled] == [3]
+
+
+def test_installed_filter_skips_dropped_updates_when_polling(clock):
+    class _Bot:
+        last_update_id = 0
+
+        def __init__(self):
+            self.processed = []
+
+        def process_new_updates(self, updates):
+            self.processed.extend(updates)
+
+    bot = _Bot()
+    middleware.UpdateFilter().install(bot)
+
+    bot.process_new_updates([_update(1, '/status'), _update(2, '/status')])
+
+    assert _ids(bot.processed) == [1]
+    assert bot.last_update_id == 2
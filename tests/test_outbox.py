@@ -0,0 +1,63 @@
+import pytest
+
+from slumometer import cluster
+from slumometer.outbox import Outbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = Outbox(str(tmp_path / 'outbox.sqlite'))
+    outbox.open()
+    yield outbox
+    outbox.close()
+
+
+def _pending_chats(outbox, batch_id, partition=None):
+    return sorted(chat_id for chat_id, text, kwargs in outbox.pending_messages(batch_id, partition))
+
+
+def test_marked_messages_are_not_pending(outbox):
+    batch_id = outbox.create_batch('campaign', [(chat_id, 'text', None) for chat_id in range(1, 6)])
+
+    outbox.mark(batch_id, 1, True)
+    outbox.mark_many(batch_id, [(2, True), (3, False)])
+
+    assert _pending_chats(outbox, batch_id) == [4, 5]
+
+
+def test_a_campaign_is_written_once(outbox):
+    batch_id = outbox.create_batch('campaign', [(1, 'text', 'HTML'), (2, 'text', 'HTML')])
+
+    assert outbox.create_batch('campaign', [(3, 'other', None)]) == batch_id
+    assert outbox.get_campaign(batch_id) == 'campaign'
+    assert outbox.pending_messages(batch_id) == [(1, 'text', {'parse_mode': 'HTML'}),
+                                                 (2, 'text', {'parse_mode': 'HTML'})]
+
+
+def test_unfinished_batches_survive_reopening(tmp_path):
+    path = str(tmp_path / 'outbox.sqlite')
+    outbox = Outbox(path)
+    outbox.open()
+    first_batch = outbox.create_batch('first', [(1, 'text', None)])
+    second_batch = outbox.create_batch('second', [(1, 'text', None), (2, 'text', None)])
+    outbox.mark(second_batch, 1, True)
+    outbox.finish_batch(first_batch)
+    outbox.close()
+
+    outbox = Outbox(path)
+    outbox.open()
+    assert outbox.unfinished_batches() == [second_batch]
+    assert _pending_chats(outbox, second_batch) == [2]
+    outbox.close()
+
+
+def test_partitions_split_a_batch_like_cluster(outbox):
+    chat_ids = list(range(-20, 21))
+    batch_id = outbox.create_batch('campaign', [(chat_id, 'text', None) for chat_id in chat_ids])
+
+    partitions = [_pending_chats(outbox, batch_id, (index, 3)) for index in range(3)]
+
+    assert sorted(sum(partitions, [])) == chat_ids
+    for index, partition in enumerate(partitions):
+        assert all(cluster.get_partition(chat_id, 3) == index for chat_id in partition)
+        assert outbox.has_pending_messages(batch_id, (index, 3))
@@ -0,0 +1,149 @@
+import pickle
+import random
+from datetime import datetime, time, timedelta
+
+import pytest
+from pytz import utc
+
+from common import MOSCOW_TIMEZONE
+from slumometer import scheduler
+from slumometer.scheduler import _TimelineTrigger
+from slumometer.simulation import VirtualClock, VirtualScheduler, _MemoryStorage
+from slumometer.storage import Storage
+
+
+def _fire_times(trigger, now):
+    fire_times = []
+    fire_time = trigger.get_next_fire_time(None, now)
+    while fire_time is not None:
+        assert len(fire_times) <= len(trigger.timestamps), 'the trigger repeats fire times'
+        fire_times.append(fire_time)
+        fire_time = trigger.get_next_fire_time(fire_time, now)
+    return fire_times
+
+
+def test_timeline_trigger_fires_every_fractional_timestamp_once():
+    start = 1790000000.0
+    rng = random.Random(6)
+    timestamps = sorted(start + i * 0.1 + rng.random() for i in range(1000))
+    trigger = _TimelineTrigger(timestamps)
+
+    fire_times = _fire_times(trigger, datetime.now(utc))
+
+    assert len(fire_times) == len(timestamps)
+    assert fire_times == sorted(set(fire_times))
+
+
+def test_timeline_trigger_skips_fired_times():
+    trigger = _TimelineTrigger([100.5, 200.25, 300.125])
+
+    assert trigger.get_next_fire_time(datetime.fromtimestamp(200.25, utc), None) == \
+        datetime.fromtimestamp(300.125, utc)
+    assert trigger.get_next_fire_time(datetime.fromtimestamp(300.125, utc), None) is None
+
+
+def test_timeline_trigger_survives_pickling():
+    timestamps = [1790000000.123456789, 1790000100.987654321]
+    trigger = pickle.loads(pickle.dumps(_TimelineTrigger(timestamps)))
+
+    assert trigger.timestamps == timestamps
+    assert _fire_times(trigger, None) == [datetime.fromtimestamp(timestamp, utc) for timestamp in timestamps]
+
+
+def test_sensor_job_is_removed_when_sensors_are_off(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    storage = Storage()
+    storage.load()
+    scheduler.init(storage)
+    scheduler.watch_sensors(None, 60)
+    scheduler.shutdown()
+
+    scheduler.init(storage)
+    try:
+        assert scheduler._scheduler.get_job(scheduler._JOB_SENSOR_CHECK) is not None
+        scheduler.unwatch_sensors()
+        scheduler.unwatch_sensors()
+        assert scheduler._scheduler.get_job(scheduler._JOB_SENSOR_CHECK) is None
+    finally:
+        scheduler.shutdown()
+        storage.close()
+
+
+def _local_datetime(moscow_time):
+    moscow_datetime = MOSCOW_TIMEZONE.localize(datetime.strptime('2019-09-30 ' + moscow_time, '%Y-%m-%d %H:%M'))
+    return datetime.fromtimestamp(moscow_datetime.timestamp())  # Local time, as the scheduler expects
+
+
+@pytest.fixture
+def job_scheduler():
+    clock = VirtualClock(_local_datetime('10:00') - timedelta(days=1))
+    storage = _MemoryStorage()
+    storage.subscribed_chats = [1, 2, 3, 4]
+    storage.chats_to_notify = []
+    storage.chat_schedules = {}
+    job_scheduler = VirtualScheduler(clock)
+    scheduler.init_simulation(storage, job_scheduler, clock.now)
+    yield job_scheduler
+    scheduler.shutdown()
+
+
+def _set_change(start, end):
+    scheduler.update_time_of_next_change([_local_datetime(start).timestamp(), _local_datetime(end).timestamp()])
+
+
+def _usual_alarm_times():
+    return [datetime.fromtimestamp(timestamp, MOSCOW_TIMEZONE).time() for alarm_type, timestamp
+            in scheduler.get_remaining_alarms() if alarm_type == scheduler.USER_NOTIFY_TYPE_USUAL]
+
+
+def test_reminder_times_are_rounded_to_slots(job_scheduler):
+    scheduler.set_chat_reminder_times(1, [time(10, 54), time(7, 0)])
+
+    assert scheduler.get_chat_reminder_times(1) == [time(7, 0), time(10, 50)]
+    assert scheduler.get_chat_reminder_times(2) == list(scheduler._USER_NOTIFICATION_TIMES_TO_SEND)
+
+
+def test_quiet_hours_drop_reminder_times(job_scheduler):
+    scheduler.set_chat_quiet_hours(1, (time(12, 0), time(14, 0)))
+    scheduler.set_chat_quiet_hours(2, (time(19, 0), time(9, 0)))
+
+    default_times = scheduler._USER_NOTIFICATION_TIMES_TO_SEND
+    assert scheduler.get_chat_reminder_times(1) == [t for t in default_times if not time(12, 0) <= t < time(14, 0)]
+    assert scheduler.get_chat_reminder_times(2) == [time(10, 50), time(12, 15), time(13, 50), time(15, 25),
+                                                    time(17, 0), time(18, 30)]
+
+
+def test_usual_alarms_go_to_the_chats_of_their_slot(job_scheduler):
+    scheduler.set_chat_reminder_times(1, [time(12, 0)])
+    scheduler.set_chat_quiet_hours(2, (time(10, 0), time(13, 0)))
+    _set_change('10:00', '15:00')
+    tenant = scheduler._tenants[scheduler.DEFAULT_TENANT]
+    tenant.storage.reset_chats_to_notify()
+    timeline = tenant.storage.notification_timeline
+
+    recipients = [sorted(chat_id for chat_id, next_alarm_datetime in scheduler._get_recipients(tenant, timeline, index))
+                  for index in range(len(timeline))]
+
+    assert _usual_alarm_times() == [time(10, 50), time(12, 0), time(12, 15), time(13, 50)]
+    assert recipients == [[3, 4], [1], [3, 4], [2, 3, 4]] + [[1, 2, 3, 4]] * 4
+
+
+def test_timeline_is_rebuilt_only_when_occupied_slots_change(job_scheduler):
+    _set_change('10:00', '15:00')
+    job = job_scheduler.get_job(scheduler._JOB_USER_NOTIFIER)
+
+    scheduler.set_chat_reminder_times(1, [time(10, 50), time(12, 15)])
+    scheduler.set_chat_quiet_hours(2, (time(10, 0), time(13, 0)))
+    assert job_scheduler.get_job(scheduler._JOB_USER_NOTIFIER) is job
+
+    scheduler.set_chat_reminder_times(3, [time(11, 0)])
+    assert job_scheduler.get_job(scheduler._JOB_USER_NOTIFIER) is not job
+    assert _usual_alarm_times() == [time(10, 50), time(11, 0), time(12, 15), time(13, 50)]
+    job = job_scheduler.get_job(scheduler._JOB_USER_NOTIFIER)
+
+    scheduler.set_chat_reminder_times(4, [time(11, 0)])
+    assert job_scheduler.get_job(scheduler._JOB_USER_NOTIFIER) is job
+
+    scheduler.set_chat_reminder_times(3, None)
+    scheduler.set_chat_reminder_times(4, None)
+    assert _usual_alarm_times() == [time(10, 50), time(12, 15), time(13, 50)]
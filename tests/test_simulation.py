@@ -0,0 +1,69 @@
+from datetime import datetime, time, timedelta
+
+from common import MOSCOW_TIMEZONE
+from slumometer import scheduler
+from slumometer.simulation import Simulation
+
+
+def _local_datetime(moscow_time):
+    moscow_datetime = MOSCOW_TIMEZONE.localize(datetime.strptime('2019-09-30 ' + moscow_time, '%Y-%m-%d %H:%M'))
+    return datetime.fromtimestamp(moscow_datetime.timestamp())  # Local time, as the scheduler expects
+
+
+# Records the chats which got every alarm besides their number
+class _RecordingSimulation(Simulation):
+    def __init__(self, *args, **kwargs):
+        self.recipients = []
+        super().__init__(*args, **kwargs)
+
+    def on_alarm(self, alarm_type, alarm_datetime, recipients):
+        self.recipients.append(sorted(chat_id for chat_id, next_alarm_datetime in recipients))
+        super().on_alarm(alarm_type, alarm_datetime, recipients)
+
+
+def _run(reply_rate, seed=0, chat_times=None):
+    simulation = _RecordingSimulation(6, reply_rate=reply_rate, seed=seed, start=_local_datetime('10:00') -
+                                      timedelta(days=1))
+    try:
+        for chat_id, times in (chat_times or {}).items():
+            scheduler.set_chat_reminder_times(chat_id, times)
+        results = simulation.run(_local_datetime('10:00'), _local_datetime('15:00'))
+        assert simulation.storage.time_next_change is None
+        assert simulation.storage.notification_timeline is None
+        assert simulation._job_scheduler.get_job(scheduler._JOB_USER_NOTIFIER) is None
+    finally:
+        simulation.shutdown()
+    del results['seconds']
+    return results, simulation.recipients
+
+
+def test_change_day_fires_the_planned_alarms():
+    results, recipients = _run(0, chat_times={1: [time(12, 15)], 2: [time(10, 50), time(13, 50)]})
+
+    assert [(alarm['type'], alarm['time']) for alarm in results['alarms']] == [
+        (scheduler.USER_NOTIFY_TYPE_USUAL, '2019-09-30T10:50:00+03:00'),
+        (scheduler.USER_NOTIFY_TYPE_USUAL, '2019-09-30T12:15:00+03:00'),
+        (scheduler.USER_NOTIFY_TYPE_USUAL, '2019-09-30T13:50:00+03:00'),
+        (scheduler.USER_NOTIFY_TYPE_1HOUR_TO_END, '2019-09-30T14:00:00+03:00'),
+        (scheduler.USER_NOTIFY_TYPE_30MIN_TO_END, '2019-09-30T14:30:00+03:00'),
+        (scheduler.USER_NOTIFY_TYPE_15MIN_TO_END, '2019-09-30T14:45:00+03:00'),
+        (scheduler.USER_NOTIFY_TYPE_LAST, '2019-09-30T15:00:00+03:00'),
+    ]
+    everybody = [1, 2, 3, 4, 5, 6]
+    assert recipients == [[2, 3, 4, 5, 6], [1, 3, 4, 5, 6], [2, 3, 4, 5, 6]] + [everybody] * 4
+    assert results['messages'] == 39
+    assert results['changed'] == 0
+
+
+def test_replies_stop_reminders():
+    results, recipients = _run(0.5, seed=3)
+
+    # A reply may come after the next alarm, so only the chats which have changed linen drop out
+    for alarm_recipients, next_recipients in zip(recipients, recipients[1:]):
+        assert set(next_recipients) <= set(alarm_recipients)
+    assert len(recipients[0]) > len(recipients[-1])
+    assert results['changed'] == sum(alarm['replies'] for alarm in results['alarms'])
+
+
+def test_same_seed_gives_the_same_day():
+    assert _run(0.5, seed=7) == _run(0.5, seed=7)
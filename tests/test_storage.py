@@ -0,0 +1,186 @@
+import json
+import threading
+import time
+
+import pytest
+
+from slumometer import storage as storage_module
+from slumometer.storage import SqliteStorage, Storage
+
+
+@pytest.fixture(params=['json', 'sqlite'])
+def storage(request, tmp_path):
+    storage = Storage(folder=str(tmp_path)) if request.param == 'json' else SqliteStorage(folder=str(tmp_path))
+    storage.load()
+    yield storage
+    storage.close()
+
+
+def test_chat_failures_are_counted(storage):
+    assert storage.add_chat_failures([1, 2]) == {1: 1, 2: 1}
+    assert storage.add_chat_failures([2]) == {2: 2}
+
+
+def test_cleared_chat_failures_count_from_zero(storage):
+    storage.add_chat_failures([1, 2])
+    storage.add_chat_failures([1, 2])
+
+    storage.clear_chat_failures([2, 3])
+
+    assert storage.add_chat_failures([1, 2]) == {1: 3, 2: 1}
+
+
+def test_json_storage_is_migrated_to_sqlite(tmp_path):
+    legacy = Storage(folder=str(tmp_path))
+    legacy.load()
+    legacy.add_subscribed_chat(1)
+    legacy.add_subscribed_chat(2)
+    legacy.add_admin_chat(1)
+    legacy.reset_chats_to_notify()
+    legacy.remove_chat_to_notify(2)
+    legacy.time_next_change = [1000, 2000]
+    legacy.set_chat_locale(1, 'en')
+    legacy.add_chat_failures([2])
+    legacy.set_chat_dorm(2, '3ka')
+    legacy.save()
+    legacy.close()
+
+    storage = SqliteStorage(folder=str(tmp_path))
+    storage.load()
+    try:
+        assert sorted(storage.subscribed_chats) == [1, 2]
+        assert list(storage.admin_chats) == [1]
+        assert list(storage.chats_to_notify) == [1]
+        assert storage.time_next_change == [1000, 2000]
+        assert storage.get_chat_locale(1) == 'en'
+        assert storage.add_chat_failures([2]) == {2: 2}
+        assert storage.get_chat_dorm(2) == '3ka'
+    finally:
+        storage.close()
+    assert not (tmp_path / Storage._STORAGE_JSON).exists()
+    assert (tmp_path / (Storage._STORAGE_JSON + '.migrated')).exists()
+
+
+def test_changes_leave_snapshots_intact(tmp_path):
+    storage = Storage(folder=str(tmp_path))
+    storage.load()
+    storage.add_subscribed_chat(1)
+    storage.set_chat_locale(1, 'en')
+    subscribed_chats = storage.subscribed_chats
+    chat_locales = storage.chat_locales
+
+    storage.add_subscribed_chat(2)
+    storage.remove_subscribed_chat(1)
+    storage.set_chat_locale(2, 'ru')
+
+    assert list(subscribed_chats) == [1]
+    assert chat_locales == {1: 'en'}
+    assert list(storage.subscribed_chats) == [2]
+    storage.close()
+
+
+def test_concurrent_changes_are_not_lost(storage):
+    def subscribe(first_chat):
+        for chat_id in range(first_chat, first_chat + 200):
+            storage.add_subscribed_chat(chat_id)
+
+    threads = [threading.Thread(target=subscribe, args=(first_chat,)) for first_chat in range(0, 800, 200)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(storage.subscribed_chats) == list(range(800))
+
+
+def test_chats_are_read_back_from_chats_bin(tmp_path):
+    storage = Storage(folder=str(tmp_path))
+    storage.load()
+    for chat_id in (3, -5, 1):
+        storage.add_subscribed_chat(chat_id)
+    storage.reset_chats_to_notify()
+    storage.remove_chat_to_notify(3)
+    storage.save()
+    storage.close()
+
+    storage = Storage(folder=str(tmp_path))
+    storage.load()
+    assert sorted(storage.subscribed_chats) == [-5, 1, 3]
+    assert sorted(storage.chats_to_notify) == [-5, 1]
+    storage.close()
+
+
+def test_every_save_is_written_without_a_delay(tmp_path):
+    storage = Storage(folder=str(tmp_path))
+    storage.load()
+    storage.add_subscribed_chat(1)
+    storage.save()
+    storage.save()
+
+    assert (storage.flush_count, storage.flushed_changes) == (2, 2)
+    assert (tmp_path / Storage._STORAGE_JSON).exists()
+
+
+def test_saves_are_written_after_the_delay(tmp_path):
+    storage = Storage(save_delay=0.1, folder=str(tmp_path))
+    storage.load()
+    for _ in range(3):
+        storage.save()
+    assert storage.flush_count == 0
+    assert not (tmp_path / Storage._STORAGE_JSON).exists()
+
+    deadline = time.monotonic() + 5
+    while storage.flush_count == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert (storage.flush_count, storage.flushed_changes) == (1, 3)
+    storage.close()
+    assert storage.flush_count == 1
+
+
+def test_saves_are_written_when_too_many_are_pending(tmp_path):
+    storage = Storage(save_delay=60, max_pending_changes=3, folder=str(tmp_path))
+    storage.load()
+    storage.save()
+    storage.save()
+    assert storage.flush_count == 0
+
+    storage.save()
+    assert (storage.flush_count, storage.flushed_changes) == (1, 3)
+    storage.save()
+    storage.close()
+    assert (storage.flush_count, storage.flushed_changes) == (2, 4)
+
+
+def test_failed_write_leaves_storage_json_intact(tmp_path, monkeypatch):
+    storage = Storage(folder=str(tmp_path))
+    storage.load()
+    storage.time_next_change = [1000, 2000]
+    storage.save()
+    json_path = tmp_path / Storage._STORAGE_JSON
+    content = json_path.read_text()
+
+    # The disk fills up halfway through the new content
+    class _FullDiskFile:
+        def __init__(self, file):
+            self._file = file
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            self._file.close()
+
+        def write(self, content):
+            self._file.write(content[:len(content) // 2])
+            raise OSError('No space left on device')
+
+    def open_on_full_disk(path, mode='r'):
+        file = open(path, mode)
+        return _FullDiskFile(file) if path.startswith(str(json_path)) and 'w' in mode else file
+    monkeypatch.setattr(storage_module, 'open', open_on_full_disk, raising=False)
+    storage.time_next_change = [3000, 4000]
+    with pytest.raises(OSError):
+        storage.save()
+
+    assert json_path.read_text() == content
+    assert json.loads(content)['time_next_change'] == [1000, 2000]
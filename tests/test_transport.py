@@ -0,0 +1,106 @@
+import threading
+
+import pytest
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, ReadTimeout
+from telebot import apihelper
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from bench.fake_telegram import FakeTelegramServer
+from slumometer import transport
+from slumometer.transport import Transport
+
+
+# Answers requests with the given outcomes in turn: an exception to raise or an HTTP status
+class _StubAdapter(BaseAdapter):
+    def __init__(self, outcomes):
+        super().__init__()
+        self.outcomes = list(outcomes)
+        self.requests = 0
+
+    def send(self, request, **kwargs):
+        self.requests += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = Response()
+        response.status_code = outcome
+        response._content = b'{"ok": true, "result": true}' if outcome == 200 else \
+            b'{"ok": false, "error_code": %d, "description": "Error"}' % outcome
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(transport.time, 'sleep', lambda seconds: None)
+
+
+def _transport(outcomes, retries=transport.DEFAULT_RETRIES):
+    api = Transport(api_url='http://telegram.invalid/bot{0}/{1}', retries=retries)
+    api._adapter = _StubAdapter(outcomes)
+    return api
+
+
+def _not_sent_error():
+    return ConnectionError(MaxRetryError(None, '/', NewConnectionError(None, 'Connection refused')))
+
+
+@pytest.mark.parametrize('error', [ConnectTimeout(), _not_sent_error()])
+def test_errors_before_sending_are_retried_for_every_method(error):
+    api = _transport([error, 200])
+
+    assert api.make_request('token', 'sendMessage', 'post') is True
+    assert api._adapter.requests == 2
+
+
+@pytest.mark.parametrize('method_name', ['getUpdates', 'setWebhook'])
+@pytest.mark.parametrize('outcome', [500, ReadTimeout(), ConnectionError('Connection reset')])
+def test_idempotent_methods_are_retried_after_sending(method_name, outcome):
+    api = _transport([outcome, 200])
+
+    assert api.make_request('token', method_name) is True
+    assert api._adapter.requests == 2
+
+
+@pytest.mark.parametrize('outcome', [500, ReadTimeout(), ConnectionError('Connection reset')])
+def test_send_message_is_not_repeated_after_sending(outcome):
+    api = _transport([outcome, 200])
+
+    with pytest.raises((apihelper.ApiException, ReadTimeout, ConnectionError)):
+        api.make_request('token', 'sendMessage', 'post')
+    assert api._adapter.requests == 1
+
+
+def test_retries_are_limited():
+    api = _transport([ConnectTimeout()] * 4, retries=2)
+
+    with pytest.raises(ConnectTimeout):
+        api.make_request('token', 'getMe')
+    assert api._adapter.requests == 3
+
+    api = _transport([503, 503, 503, 200], retries=2)
+    with pytest.raises(apihelper.ApiException):
+        api.make_request('token', 'getMe')
+    assert api._adapter.requests == 3
+
+
+def test_threads_wait_for_a_connection_of_the_pool():
+    server = FakeTelegramServer(latency=0.05).start()
+    api = Transport(api_url=server.api_url, pool_size=2)
+    try:
+        threads = [threading.Thread(target=api.make_request, args=('token', 'getMe')) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert server.stats()['requests'] == {'getMe': 8}
+        assert api.connections_opened() == 2
+        assert server.stats()['connections'] == 2
+    finally:
+        server.stop()
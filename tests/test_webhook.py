@@ -0,0 +1,79 @@
+import http.client
+import json
+import queue
+
+import pytest
+
+from slumometer import webhook
+from slumometer.webhook import WebhookServer
+
+_SECRET_TOKEN = 'secret'
+
+
+class _Bot:
+    def __init__(self):
+        self.batches = queue.Queue()
+
+    def process_new_updates(self, updates):
+        self.batches.put([update.update_id for update in updates])
+
+
+@pytest.fixture
+def bot():
+    return _Bot()
+
+
+@pytest.fixture
+def server(bot):
+    server = WebhookServer(bot, '127.0.0.1', 0, _SECRET_TOKEN)
+    server.start()
+    yield server
+    server.shutdown()
+
+
+def _post(server, body, headers=None):
+    headers = {'Content-Type': 'application/json', webhook._SECRET_TOKEN_HEADER: _SECRET_TOKEN,
+               **(headers or {})}
+    headers = {name: value for name, value in headers.items() if value is not None}
+    connection = http.client.HTTPConnection('127.0.0.1', server.port, timeout=5)
+    try:
+        connection.request('POST', '/', body=body, headers=headers)
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+def _update(update_id):
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'date': 0,
+                                                'chat': {'id': 1, 'type': 'private'}, 'text': '/status'}}
+
+
+@pytest.mark.parametrize('secret_token', [None, '', 'wrong'])
+def test_requests_without_the_secret_token_are_forbidden(server, bot, secret_token):
+    status = _post(server, json.dumps(_update(1)), {webhook._SECRET_TOKEN_HEADER: secret_token})
+
+    assert status == 403
+    assert bot.batches.empty()
+
+
+def test_an_update_is_processed(server, bot):
+    assert _post(server, json.dumps(_update(1))) == 200
+
+    assert bot.batches.get(timeout=5) == [1]
+
+
+def test_a_list_of_updates_is_processed_in_one_batch(server, bot):
+    assert _post(server, json.dumps([_update(update_id) for update_id in range(1, 6)])) == 200
+
+    assert bot.batches.get(timeout=5) == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.parametrize('body, headers', [
+    ('{"update_id": ', None),
+    ('', None),
+    (json.dumps(_update(1)), {'Content-Length': 'many'}),
+    (json.dumps(_update(1)), {'Content-Length': str(webhook._MAX_BODY_SIZE + 1)}),
+])
+def test_bad_requests_are_rejected(server, bot, body, headers):
+    assert _post(server, body, headers) == 400
+    assert bot.batches.empty()